@@ -4,101 +4,130 @@ import os
 import shutil
 import io
 import sys
-from ultralytics import YOLO
-import pandas as pd
+import time
+import uuid
+from collections import deque
 import librosa
 import matplotlib.pyplot as plt
 import numpy as np
-from pydub import AudioSegment
+import soundfile as sf
 from PIL import Image, ImageDraw, ImageFont
 import zipfile
 
-def save_spectrogram_from_audio(audio_file):
+# Shared detection structure of the pipeline in Code/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Code"))
+from detections import Detections
+from inference_service import MODEL_PATH, load_detector
+from spectrogram_cache import cache_from_env, model_version
+
+# Spectrograms and detections of files already analysed are reused when SPECTROGRAM_CACHE is set
+cache = cache_from_env()
+
+# Long recordings are processed window by window, the model was trained on one-minute spectrograms
+SR = 16000
+WINDOW_SECONDS = float(os.getenv("APP_WINDOW_SECONDS", "60"))
+# Windows overlap so that a song cut by a window boundary is whole in the next window
+WINDOW_OVERLAP = float(os.getenv("APP_WINDOW_OVERLAP", "2"))
+# Only the spectrograms of the last windows are kept on disk and shown
+MAX_TILES = 12
+# Only the last detections are listed while a long recording is processed
+MAX_LINES = 200
+
+_model = None
+
+def load_local_model():
+    from ultralytics import YOLO
+    return YOLO(MODEL_PATH)
+
+def get_model():
+    """Load the YOLO model once for all the requests, or use the detector daemon when BIRD_DETECTOR_SOCKET is set."""
+    global _model
+    if _model is None:
+        _model = load_detector(load_local_model)
+    return _model
+
+def save_spectrogram_image(D, sr, output_image_path):
     """
-    Generate a spectrogram image from an audio file and save it to the Images folder."
+    Render a dB spectrogram the way the detector was trained and save it as an image.
     """
-
-    y, sr = librosa.load(audio_file, sr=16000)
-    
-    # Create the output path for the image
-    output_image_path = audio_file.replace('Audios', 'Images').replace(".WAV", ".PNG")
-    
     # Ensure the output folder exists
     os.makedirs(os.path.dirname(output_image_path), exist_ok=True)
-    
+
     # Define the frequency range
     fmin = 1
     fmax = 16000
 
     fig, ax = plt.subplots(figsize=(12, 6))  # Set the background color to black
-    D = librosa.amplitude_to_db(librosa.stft(y), ref=np.max)
     librosa.display.specshow(D, sr=sr, x_axis="time", y_axis="log", fmin=fmin, fmax=fmax, ax=ax)  # Specify frequency range
     ax.axis('off')  # Remove axes
 
     # Save the figure using the output_image_path
     fig.savefig(output_image_path, bbox_inches='tight', pad_inches=0, transparent=True)
-    
+
     # Close the figure to release memory resources
     plt.close(fig)
 
     return output_image_path
 
-def transform_coordinates_to_seconds(audio_path, prediccion_txt_path):
-    image_path = audio_path.replace('Audios', 'Images').replace(".WAV", ".PNG")
+def iter_windows(audio_path, window=WINDOW_SECONDS, overlap=WINDOW_OVERLAP, sr=SR):
+    """
+    Read an audio file one window at a time, so that memory does not grow with the length of the recording.
 
-    # Read image size
-    with Image.open(image_path) as img:
-        WIDTH, HEIGHT = img.size
-    
-    # Read predictions file
-    with open(prediccion_txt_path, 'r') as file:
-        predictions = file.readlines()
-    
-    # Load original audio
-    audio = AudioSegment.from_wav(audio_path)
-    
-    # Audio duration in ms
-    audio_duration_ms = len(audio)
-    # To seconds
-    audio_duration_sec = audio_duration_ms / 1000
-
-    df = pd.DataFrame(columns=["x_center", "width", "IMG_WIDTH", "IMG_HEIGHT", "Start Time", "End Time", "Score"])
-    
-    # Process each prediction
-    for i, line in enumerate(predictions):
-        _, x_center, _, width, _, score = map(float, line.split())
-        
-        # Denormalize coordinates
-        x_center_desnorm = x_center * WIDTH
-        width_desnorm = width * WIDTH
-
-        # Convert image coordinates to audio seconds
-        start_sec = (x_center_desnorm - width_desnorm / 2) * 60 / WIDTH
-        end_sec = (x_center_desnorm + width_desnorm / 2) * 60 / WIDTH
-        
-        # Ensure the segment is within the audio duration
-        start_sec = max(0, min(start_sec, audio_duration_sec))
-        end_sec = max(0, min(end_sec, audio_duration_sec))
-
-        df.loc[i] = [x_center, width, WIDTH, HEIGHT, start_sec, end_sec, score]
-
-    return df
-
-def draw_bounding_boxes(image_path, df):
+    Yields:
+        start (float): Start of the window in seconds.
+        y (np.ndarray): Mono audio of the window resampled to sr.
+        last (bool): Whether this is the last window.
+    """
+    with sf.SoundFile(audio_path) as f:
+        size = int(window * f.samplerate)
+        hop = max(1, int((window - overlap) * f.samplerate))
+        start = 0
+        while True:
+            f.seek(start)
+            block = f.read(size, dtype="float32", always_2d=True).mean(axis=1)
+            last = start + size >= f.frames
+            if f.samplerate != sr:
+                block = librosa.resample(block, orig_sr=f.samplerate, target_sr=sr)
+            yield start / f.samplerate, block, last
+            if last:
+                return
+            start += hop
+
+def count_windows(audio_path, window=WINDOW_SECONDS, overlap=WINDOW_OVERLAP):
+    info = sf.info(audio_path)
+    return 1 + max(0, int(np.ceil((info.duration - window) / (window - overlap))))
+
+def detect_window(model, y, start, tile_path, audio_path):
+    """
+    Detect bird songs in one window. Returns the detections of the window, in seconds of the window.
+    """
+    config = {"kind": "app_window", "sr": SR, "start": start, "window": WINDOW_SECONDS, "model": model_version(model)}
+    use_cache = cache is not None and config["model"] is not None
+    cached = cache.get(audio_path, config) if use_cache else None
+    if cached is not None:
+        save_spectrogram_image(cached["D"].astype(np.float32), SR, tile_path)
+        return Detections.from_array(cached["table"], cached["duration"])
+
+    D = librosa.amplitude_to_db(librosa.stft(y), ref=np.max)
+    save_spectrogram_image(D, SR, tile_path)
+    detections = Detections.from_results(model(tile_path, verbose=False), len(y) / SR)
+    if use_cache:
+        cache.put(audio_path, config, D=D.astype(np.float16), table=detections.to_array(), duration=len(y) / SR)
+    return detections
+
+def draw_bounding_boxes(image_path, detections):
     with Image.open(image_path) as img:
         draw = ImageDraw.Draw(img)
         font = ImageFont.load_default()
 
-        for _, row in df.iterrows():
-            x_center = row['x_center'] * img.width
-            width = row['width'] * img.width
+        for x_center, width, score in zip(detections.x_center * img.width, detections.width * img.width, detections.score):
             x1 = x_center - width / 2
             x2 = x_center + width / 2
             y1 = 0
             y2 = img.height
 
             draw.rectangle([x1, y1, x2, y2], outline="red", width=3)
-            draw.text((x1, y1), f"{row['Score']:.2f}", fill="red", font=font, stroke_fill="black", stroke_width=1)
+            draw.text((x1, y1), f"{score:.2f}", fill="red", font=font, stroke_fill="black", stroke_width=1)
 
         output_image_path = image_path.replace(".PNG", "_bbox.PNG")
         img.save(output_image_path)
@@ -109,65 +138,97 @@ def capture_console_output(func, *args, **kwargs):
     """Captures the console output of a function call and returns it as a string."""
     old_stdout = sys.stdout
     sys.stdout = io.StringIO()
-    
+
     try:
         func(*args, **kwargs)
         output = sys.stdout.getvalue()
     finally:
         sys.stdout = old_stdout
-    
+
     return output
 
+def clean_old_tiles(root=os.path.join("runs", "app"), max_age=3600):
+    """Remove the spectrograms of the requests older than max_age seconds."""
+    if not os.path.isdir(root):
+        return
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if time.time() - os.path.getmtime(path) > max_age:
+            shutil.rmtree(path, ignore_errors=True)
+
+def format_time(seconds):
+    return f"{int(seconds // 3600):02d}:{int(seconds % 3600 // 60):02d}:{seconds % 60:05.2f}"
+
+def detection_text(lines, count):
+    """The last detections, with how many earlier ones are not listed."""
+    hidden = count - len(lines)
+    header = [f"... {hidden} earlier detections (all of them are in the segments)"] if hidden else []
+    return "\n".join(header + list(lines))
+
 def process_audio(audio_path):
-    """Processes an uploaded audio file for bird song detection and returns the console output."""
-    # Load YOLO model
-    model = YOLO("../Models/Bird Song Detector/weights/best.pt")
-    
-    # Clean output folder
-    shutil.rmtree('runs', ignore_errors=True)
-    
-    # Convert audio to spectrogram image
-    image_path = save_spectrogram_from_audio(audio_path)
-    
-    # Perform detection
-    model(image_path, save_txt=True, save_conf=True)
-    
-    # Extract predictions
-    audio_name = os.path.basename(audio_path).replace(".WAV", "")
-    predictions_txt = f"runs/detect/predict/labels/{audio_name}.txt"
-    
-    if os.path.exists(predictions_txt):
-        df = transform_coordinates_to_seconds(audio_path, predictions_txt)
-        output_text = ""
-        for i, row in df.iterrows():
-            output_text += f"Detection {i+1}: From {row['Start Time']:.2f} to {row['End Time']:.2f} seconds (Score: {row['Score']:.2f})\n"
-        df.to_csv(f"runs/detect/predict/labels/{audio_name}_segments.csv", index=False)
-        
-        # Draw bounding boxes on the spectrogram
-        bbox_image_path = draw_bounding_boxes(image_path, df)
-        
-        return output_text, bbox_image_path
-    else:
-        return "No detections found.", None
-
-def create_and_download_segments(audio_path):
-    audio_name = os.path.basename(audio_path).replace(".WAV", "")
-    segments_csv = f"runs/detect/predict/labels/{audio_name}_segments.csv"
-    if not os.path.exists(segments_csv):
+    """
+    Processes an uploaded recording window by window for bird song detection.
+    A generator: the detections found so far and the spectrogram of every window are streamed as soon as the
+    window is done. The state holds the detections found so far, so segments can be generated after Cancel.
+    """
+    if not audio_path:
+        yield "Upload an audio file first.", None, [], None, ""
+        return
+
+    model = get_model()
+    clean_old_tiles()
+    # Every request writes its spectrograms to its own folder
+    tiles_dir = os.path.join("runs", "app", uuid.uuid4().hex)
+    total = count_windows(audio_path)
+    tables, tiles = [], []
+    lines, count = deque(maxlen=MAX_LINES), 0
+    duration = 0.0
+
+    for i, (start, y, last) in enumerate(iter_windows(audio_path)):
+        tile_path = os.path.join(tiles_dir, f"window_{i:05d}.PNG")
+        window = detect_window(model, y, start, tile_path, audio_path)
+        duration = start + window.duration
+
+        # Each window keeps the detections centred in its part of the overlaps
+        center = (window.start + window.end) / 2
+        lower = WINDOW_OVERLAP / 2 if start > 0 else -np.inf
+        upper = window.duration - WINDOW_OVERLAP / 2 if not last else np.inf
+        table = window.to_array()[(center >= lower) & (center < upper)]
+        table[:, :2] += start
+        tables.append(table)
+        for s, e, _, score in table[:, :4]:
+            count += 1
+            lines.append(f"Detection {count}: From {format_time(s)} to {format_time(e)} (Score: {score:.2f})")
+
+        tiles.append((draw_bounding_boxes(tile_path, window), f"{format_time(start)} - {format_time(duration)}"))
+        os.remove(tile_path)
+        # Bounded disk and page: drop the spectrograms of the oldest windows
+        while len(tiles) > MAX_TILES:
+            os.remove(tiles.pop(0)[0])
+
+        progress = f"Window {i + 1}/{total} done ({format_time(duration)} analysed), {count} detections"
+        detections = Detections.from_array(np.concatenate(tables), duration)
+        yield detection_text(lines, count) or "No detections yet.", tiles[-1][0], list(reversed(tiles)), detections, progress
+
+    yield detection_text(lines, count) or "No detections found.", tiles[-1][0], list(reversed(tiles)), detections, progress + ", finished"
+
+def create_and_download_segments(audio_path, detections):
+    if detections is None or not len(detections):
         return None
 
-    df = pd.read_csv(segments_csv)
-    audio = AudioSegment.from_wav(audio_path)
+    audio_name = os.path.splitext(os.path.basename(audio_path))[0]
     segment_paths = []
 
-    for i, row in df.iterrows():
-        start_ms = row['Start Time'] * 1000
-        end_ms = row['End Time'] * 1000
-        segment = audio[start_ms:end_ms]
-        segment_path = f"runs/detect/predict/segments/{audio_name}_{row['Start Time']:.2f}_{row['End Time']:.2f}_{row['Score']:.2f}.wav"
-        os.makedirs(os.path.dirname(segment_path), exist_ok=True)
-        segment.export(segment_path, format="wav")
-        segment_paths.append(segment_path)
+    with sf.SoundFile(audio_path) as f:
+        sr = f.samplerate
+        for start, end, _, score in detections:
+            # Read only the segment, not the whole recording
+            f.seek(int(start * sr))
+            segment = f.read(int((end - start) * sr), dtype="float32")
+            segment_path = f"runs/detect/predict/segments/{audio_name}_{start:.2f}_{end:.2f}_{score:.2f}.wav"
+            os.makedirs(os.path.dirname(segment_path), exist_ok=True)
+            sf.write(segment_path, segment, sr)
+            segment_paths.append(segment_path)
 
     zip_path = f"runs/detect/predict/{audio_name}_segments.zip"
     with zipfile.ZipFile(zip_path, 'w') as zipf:  # Use zipfile.ZipFile
@@ -181,22 +242,30 @@ demo = gr.Blocks()
 
 with demo:
     gr.Markdown("# Bird Song Detector")
-    gr.Markdown("Upload an audio file (WAV format) to detect bird songs using the Bird Song Detector from BIRDeep model.")
-    
+    gr.Markdown("Upload an audio file (WAV or FLAC) to detect bird songs using the Bird Song Detector from BIRDeep model. "
+                f"Long recordings are processed in {WINDOW_SECONDS:.0f} s windows and the results appear as each window is done.")
+
     with gr.Row():
-        audio_input = gr.File(label="Upload WAV File")
-        output_text = gr.Textbox(label="Detection Results")
-    
-    spectrogram_output = gr.Image(label="Spectrogram with Detections")
-    
+        audio_input = gr.File(label="Upload Audio File")
+        output_text = gr.Textbox(label="Detection Results", max_lines=20)
+
+    progress_output = gr.Markdown()
+    spectrogram_output = gr.Image(label="Last Window with Detections")
+    tiles_output = gr.Gallery(label=f"Last {MAX_TILES} Windows", columns=4, height="auto")
+    detections_state = gr.State()
+
     with gr.Row():
         detect_button = gr.Button("Detect Bird Songs", variant="primary")
-        detect_button.click(process_audio, inputs=audio_input, outputs=[output_text, spectrogram_output])
-        
+        cancel_button = gr.Button("Cancel", variant="stop")
         download_button = gr.Button("Generate Segments")
 
+    detect_event = detect_button.click(process_audio, inputs=audio_input,
+                                       outputs=[output_text, spectrogram_output, tiles_output, detections_state, progress_output])
+    # Stops the generator between two windows, the detections found so far stay in the state
+    cancel_button.click(None, cancels=[detect_event])
+
     download_output = gr.File()
-    download_button.click(create_and_download_segments, inputs=audio_input, outputs=download_output)
+    download_button.click(create_and_download_segments, inputs=[audio_input, detections_state], outputs=download_output)
 
 if __name__ == "__main__":
-    demo.launch(share=True)
+    demo.queue().launch(share=True)
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+Smaller detectors for the CPU-only stations: an INT8 version and a distilled nano version of best.pt, with a report.
+
+best.pt is a YOLOv8s (model: yolov8s.pt in Models/Bird_Song_Detector/args.yaml) running in fp32. Three steps, all
+run by default, each writing next to the weights so that BIRD_MODEL_VARIANT picks them up (see model_manager.py):
+
+- int8: post-training static quantization. The model is exported to ONNX at the input shape of the stations (a
+  930x462 spectrogram letterboxed to 640x320, not 640x640), then quantized with ONNX Runtime (QDQ, per-channel
+  int8 weights, uint8 activations) with the activation ranges calibrated on --images. The box decoding of the
+  Detect head stays in float: boxes in pixels and scores in [0, 1] share one output tensor and one scale would
+  not fit both. Writes <weights>_int8.onnx.
+- nano: distillation into a YOLOv8n by pseudo-labelling. The teacher (best.pt) labels --images at
+  --pseudo-conf (a YOLO label file from --labels is used instead when there is one) and the student is trained
+  on these labels with the training settings of args.yaml. Data/Images only has a handful of images: point
+  --images at the training spectrograms (several --images are allowed) for a useful student. Writes
+  <weights>_nano.pt.
+- report: every variant is run over --images in a fresh interpreter (so that the peak RSS is its own) and
+  scored as time intervals like pareto_sweep.py: mAP50 and mAP50-95 against --labels, or otherwise against the
+  detections of best.pt at --reference-conf (the drop is then the disagreement with the current model).
+  Latency is the median inference time per image, after a warm-up. Written to --output (CSV) and printed.
+
+Examples:
+  python compress_model.py --weights ../Models/Bird_Song_Detector/weights/best.pt
+  python compress_model.py int8 report --images ../Data/Images
+  python compress_model.py nano --images /data/birdeep/images/train --epochs 200 --device 0
+  BIRD_MODEL_VARIANT=int8 python predict_on_audio.py
+"""
+
+# Import libraries
+import argparse
+import csv
+import glob
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from model_manager import variant_path
+from inference_service import MODEL_PATH
+from pareto_sweep import average_precision, load_labels, match
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+STEPS = ("int8", "nano", "report")
+
+def parse_args():
+    p = argparse.ArgumentParser(description="INT8 and distilled nano variants of the detector, with an accuracy/latency/RSS report.")
+    p.add_argument("steps", nargs="*", help=f"Steps to run: {', '.join(STEPS)} (default: all)")
+    p.add_argument("--weights", default=MODEL_PATH, help="Current model (env BIRD_MODEL)")
+    p.add_argument("--images", action="append", help="Folder of spectrograms, can be repeated (default: ../Data/Images)")
+    p.add_argument("--labels", help="Folder of YOLO label files of the images (scoring and distillation)")
+    p.add_argument("--imgsz", type=int, default=640, help="Input size of the model, longest side (default: 640)")
+    p.add_argument("--device", default="cpu", help="Device of the distillation and of the report (default: cpu)")
+    p.add_argument("--calibration", type=int, default=200, help="Images used to calibrate the INT8 ranges (default: 200)")
+    p.add_argument("--student", default="yolov8n.pt", help="Student to distil into (default: yolov8n.pt)")
+    p.add_argument("--epochs", type=int, default=100, help="Distillation epochs (default: 100)")
+    p.add_argument("--pseudo-conf", type=float, default=0.25, help="Confidence of the teacher pseudo-labels (default: 0.25)")
+    p.add_argument("--val-fraction", type=float, default=0.2, help="Images held out to validate the student (default: 0.2)")
+    p.add_argument("--reference-conf", type=float, default=0.25, help="Confidence of the best.pt reference (default: 0.25)")
+    p.add_argument("--match-iou", type=float, default=0.5, help="Interval IoU of a true positive for mAP50 (default: 0.5)")
+    p.add_argument("--output", default="compression_report.csv", help="Report (default: compression_report.csv)")
+    p.add_argument("--measure", help=argparse.SUPPRESS)  # worker of the report, one model per interpreter
+    args = p.parse_args()
+    unknown = set(args.steps) - set(STEPS)
+    if unknown:
+        p.error(f"unknown step {', '.join(sorted(unknown))} (choose from {', '.join(STEPS)})")
+    args.steps = args.steps or STEPS
+    args.images = args.images or [os.path.join(HERE, "..", "Data", "Images")]
+    return args
+
+def list_images(folders):
+    return sorted(path for folder in folders for path in glob.glob(os.path.join(folder, "*"))
+                  if path.lower().endswith(IMAGE_EXTENSIONS))
+
+def name_of(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+def input_shape(image_path, imgsz, stride=32):
+    """(height, width) the image is letterboxed to by a .pt model: longest side imgsz, the other padded to stride."""
+    import cv2
+
+    height, width = cv2.imread(image_path).shape[:2]
+    ratio = imgsz / max(height, width)
+    return tuple(int(np.ceil(round(side * ratio) / stride) * stride) for side in (height, width))
+
+class CalibrationReader:
+    """Calibration images for ONNX Runtime, preprocessed like the predictor does (letterbox, RGB, 0-1, NCHW)."""
+
+    def __init__(self, images, shape, input_name):
+        from ultralytics.data.augment import LetterBox
+
+        self.images = iter(images)
+        self.letterbox = LetterBox(shape, auto=False, stride=32)
+        self.input_name = input_name
+
+    def get_next(self):
+        import cv2
+
+        path = next(self.images, None)
+        if path is None:
+            return None
+        image = self.letterbox(image=cv2.imread(path))
+        tensor = image[..., ::-1].transpose(2, 0, 1)[None].astype(np.float32) / 255
+        return {self.input_name: np.ascontiguousarray(tensor)}
+
+def quantize_int8(args, images):
+    """Export to ONNX at the station input shape and quantize with calibration on the images."""
+    import onnx
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+    from ultralytics import YOLO
+
+    output = variant_path(args.weights, "int8")
+    shape = input_shape(images[0], args.imgsz)
+    print(f"Exporting {args.weights} to ONNX at {shape[1]}x{shape[0]}")
+    exported = YOLO(args.weights).export(format="onnx", imgsz=shape, simplify=False, device="cpu")
+
+    graph = onnx.load(exported).graph
+    head = max(int(node.name.split("/")[1].split(".")[1]) for node in graph.node if node.name.startswith("/model."))
+    # Convolutions of the Detect head are quantized, its box decoding (and the DFL convolution) is not
+    keep_float = [node.name for node in graph.node if node.name.startswith(f"/model.{head}/")
+                  and (node.op_type != "Conv" or "/dfl/" in node.name)]
+    calibration = random.Random(42).sample(images, min(args.calibration, len(images)))
+    print(f"Quantizing with {len(calibration)} calibration images, {len(keep_float)} head nodes kept in float")
+    t0 = time.time()
+    quantize_static(exported, output, CalibrationReader(calibration, shape, graph.input[0].name),
+                    quant_format=QuantFormat.QDQ, per_channel=True, weight_type=QuantType.QInt8,
+                    activation_type=QuantType.QUInt8, nodes_to_exclude=keep_float)
+    # The predictor reads the class names, stride and input size from the metadata of the export
+    quantized, original = onnx.load(output), onnx.load(exported)
+    del quantized.metadata_props[:]
+    quantized.metadata_props.extend(original.metadata_props)
+    onnx.save(quantized, output)
+    print(f"INT8 model: {output} ({os.path.getsize(output) / 1e6:.1f} MB, "
+          f"fp32 ONNX {os.path.getsize(exported) / 1e6:.1f} MB) in {time.time() - t0:.0f}s")
+    return output
+
+def distill_nano(args, images):
+    """Pseudo-label the images with the teacher and train the student on them."""
+    from ultralytics import YOLO
+
+    output = variant_path(args.weights, "nano")
+    work_dir = os.path.join(os.path.dirname(os.path.abspath(output)), "distillation")
+    shutil.rmtree(os.path.join(work_dir, "dataset"), ignore_errors=True)
+    teacher = YOLO(args.weights)
+
+    shuffled = random.Random(42).sample(images, len(images))
+    n_val = max(1, int(len(images) * args.val_fraction))
+    pseudo = 0
+    for split, paths in (("val", shuffled[:n_val]), ("train", shuffled[n_val:] or shuffled[:n_val])):
+        image_dir = os.path.join(work_dir, "dataset", "images", split)
+        label_dir = os.path.join(work_dir, "dataset", "labels", split)
+        os.makedirs(image_dir, exist_ok=True)
+        os.makedirs(label_dir, exist_ok=True)
+        for path in paths:
+            shutil.copy2(path, image_dir)
+            label_path = os.path.join(label_dir, name_of(path) + ".txt")
+            if args.labels and os.path.exists(os.path.join(args.labels, name_of(path) + ".txt")):
+                shutil.copy2(os.path.join(args.labels, name_of(path) + ".txt"), label_path)
+                continue
+            result = teacher(path, conf=args.pseudo_conf, device=args.device, verbose=False)[0]
+            with open(label_path, "w") as f:
+                for x, y, w, h in result.boxes.xywhn.cpu().numpy():
+                    f.write(f"0 {x:.6f} {y:.6f} {w:.6f} {h:.6f}\n")
+            pseudo += 1
+    data = os.path.join(work_dir, "dataset.yaml")
+    with open(data, "w") as f:
+        f.write(f"path: {os.path.join(work_dir, 'dataset')}\ntrain: images/train\nval: images/val\n"
+                f"names:\n  0: {teacher.names[0]}\n")
+    print(f"Distillation set: {len(images) - n_val} train / {n_val} val images, {pseudo} pseudo-labelled by the teacher")
+
+    # Same settings as the training of best.pt (args.yaml)
+    student = YOLO(args.student)
+    student.train(data=data, epochs=args.epochs, imgsz=args.imgsz, batch=16, patience=50, single_cls=True,
+                  close_mosaic=0, seed=42, deterministic=True, device=args.device, project=work_dir,
+                  name="student", exist_ok=True, plots=False)
+    shutil.copy2(os.path.join(work_dir, "student", "weights", "best.pt"), output)
+    print(f"Nano model: {output} ({os.path.getsize(output) / 1e6:.1f} MB)")
+    return output
+
+def peak_rss():
+    """Peak RSS of this process in MB (VmHWM: ru_maxrss would carry over the peak of the parent across exec)."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def measure(model_path, images, device):
+    """Worker of the report: latency, peak RSS and all the detections (conf 0.001) of one model."""
+    import cv2
+    from model_manager import result_intervals
+    from ultralytics import YOLO
+
+    rss_before = peak_rss()
+    model = YOLO(model_path, task="detect")
+    arrays = [cv2.imread(path) for path in images]
+    model(arrays[0], device=device, verbose=False)  # warm-up
+    latencies, detections = [], {}
+    for path, array in zip(images, arrays):
+        t0 = time.perf_counter()
+        result = model(array, conf=0.001, device=device, verbose=False)[0]
+        latencies.append((time.perf_counter() - t0) * 1000)
+        scores = result.boxes.conf.cpu().numpy()
+        detections[name_of(path)] = np.column_stack([result_intervals(result), scores]).tolist()
+    return {
+        "latency_ms": statistics.median(latencies),
+        "rss_mb": peak_rss(),
+        "rss_libraries_mb": rss_before,
+        "detections": detections,
+    }
+
+def run_measure(model_path, args):
+    """Measure a model in a fresh interpreter, so that its peak RSS is not mixed with the other models."""
+    command = [sys.executable, os.path.abspath(__file__), "--measure", model_path, "--device", args.device]
+    for folder in args.images:
+        command += ["--images", folder]
+    out = subprocess.run(command, cwd=HERE, capture_output=True, text=True)
+    if out.returncode:
+        raise RuntimeError(out.stderr.strip().splitlines()[-1] if out.stderr.strip() else f"exit code {out.returncode}")
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def mean_ap(detections, reference, thresholds):
+    """Mean over the IoU thresholds of the AP of the intervals of all the images."""
+    n_reference = sum(len(r) for r in reference.values())
+    aps = []
+    for threshold in thresholds:
+        scored = [match(np.array(detections.get(name, [])).reshape(-1, 3), reference[name], threshold)
+                  for name in reference]
+        aps.append(average_precision(np.concatenate(scored) if scored else np.zeros((0, 2)), n_reference))
+    return float(np.mean(aps))
+
+def report(args, images):
+    variants = [("fp32", args.weights)] + [(v, variant_path(args.weights, v)) for v in ("int8", "nano")]
+    measured = {}
+    for variant, path in variants:
+        if not os.path.exists(path):
+            print(f"{variant}: {path} not found, skipped")
+            continue
+        print(f"Measuring {variant} ({os.path.basename(path)}) on {len(images)} images...")
+        try:
+            measured[variant] = run_measure(path, args)
+        except RuntimeError as e:
+            print(f"{variant}: failed: {e}")
+    if "fp32" not in measured:
+        raise SystemExit("The current model could not be measured, nothing to compare with")
+
+    if args.labels:
+        reference = {name_of(p): load_labels(args.labels, name_of(p)) for p in images}
+        against = f"labels of {args.labels}"
+    else:
+        reference = {name: np.array([d[:2] for d in dets if d[2] >= args.reference_conf]).reshape(-1, 2)
+                     for name, dets in measured["fp32"]["detections"].items()}
+        against = f"detections of {os.path.basename(args.weights)} at conf {args.reference_conf}"
+
+    rows = []
+    for variant, path in variants:
+        if variant not in measured:
+            continue
+        m = measured[variant]
+        rows.append({
+            "variant": variant,
+            "model": os.path.basename(path),
+            "size_mb": round(os.path.getsize(path) / 1e6, 2),
+            "map50": round(mean_ap(m["detections"], reference, [args.match_iou]), 4),
+            "map50_95": round(mean_ap(m["detections"], reference, np.arange(0.5, 0.96, 0.05)), 4),
+            "latency_ms": round(m["latency_ms"], 1),
+            "rss_mb": round(m["rss_mb"], 1),
+        })
+    base = rows[0]
+    for row in rows:
+        row["map50_drop"] = round(base["map50"] - row["map50"], 4)
+        row["speedup"] = round(base["latency_ms"] / row["latency_ms"], 2)
+        row["rss_saved_mb"] = round(base["rss_mb"] - row["rss_mb"], 1)
+
+    with open(args.output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print(f"\n{len(images)} images, {sum(len(r) for r in reference.values())} reference intervals ({against}), "
+          f"device {args.device}, peak RSS of a process that only imported the libraries: "
+          f"{measured['fp32']['rss_libraries_mb']:.0f} MB")
+    print(f"{'variant':>8} {'size MB':>8} {'mAP50':>6} {'drop':>7} {'mAP50-95':>9} {'ms/img':>8} {'speedup':>8} {'RSS MB':>7} {'saved':>6}")
+    for r in rows:
+        print(f"{r['variant']:>8} {r['size_mb']:8.1f} {r['map50']:6.3f} {r['map50_drop']:+7.3f} {r['map50_95']:9.3f} "
+              f"{r['latency_ms']:8.1f} {r['speedup']:7.2f}x {r['rss_mb']:7.0f} {r['rss_saved_mb']:6.0f}")
+    print(f"\nReport written to {args.output}")
+
+def main():
+    args = parse_args()
+    images = list_images(args.images)
+    if not images:
+        raise SystemExit(f"No images in {', '.join(args.images)}")
+    if args.measure:
+        print(json.dumps(measure(args.measure, images, args.device)))
+        return
+    if not os.path.exists(args.weights):
+        raise SystemExit(f"Model not found: {args.weights}")
+
+    if "int8" in args.steps:
+        quantize_int8(args, images)
+    if "nano" in args.steps:
+        distill_nano(args, images)
+    if "report" in args.steps:
+        report(args, images)
+
+if __name__ == "__main__":
+    main()
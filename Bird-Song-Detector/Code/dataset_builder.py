@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+Build the training dataset of the detector from production detections, in memory-mapped spectrogram shards.
+
+Workflow:
+1. select: pick the recordings worth labelling from the detections of the stations (the *_detections.txt files
+   they upload) or of reprocess_archive.py (its results store):
+   - uncertainty: the binary entropy of the least confident detection of a recording, highest at a score of 0.5,
+   - diversity: among the --pool most uncertain recordings, each pick is the one with the best mix of uncertainty
+     and distance (features: time of day, station, number and mean score of the detections, acoustic indices)
+     to the recordings already picked, weighted by --diversity.
+   The spectrograms of every channel are rendered like the detector sees them and appended to the shards of a
+   split, with the detections as pre-annotations (full height boxes, the detections have no frequency range).
+   --review also writes them as PNG and YOLO text files for the annotation tool.
+2. labels: replace the pre-annotations with the reviewed YOLO label files.
+3. pack: append an existing dataset (images and YOLO label files, e.g. the one of Data/Images) to a split.
+4. train: train the detector on the shards (see shard_dataset.py), without decoding one PNG per image and epoch.
+
+Examples:
+  python dataset_builder.py select --store runs/reprocess/shard0of1/results.sqlite --audio-root /archive/2025 \\
+      --count 500 --dataset datasets/birdeep --review review/
+  python dataset_builder.py select --detections /data/uploads/AM1 --audio-root /data/uploads/AM1 --count 100
+  python dataset_builder.py labels datasets/birdeep/train review/labels
+  python dataset_builder.py pack ../Data/Images --labels ../Data/Labels --dataset datasets/birdeep --split val
+  python dataset_builder.py train datasets/birdeep --model yolov8s.pt --epochs 100 --device 0
+"""
+
+# Import libraries
+import argparse
+import glob
+import json
+import math
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+import numpy as np
+
+from spectrogram_shards import ShardWriter, read_yolo_labels, write_data_yaml
+
+AUDIO_EXTENSIONS = (".wav", ".flac")
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+CLASS_NAMES = ["bird_song"]
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Training dataset of spectrogram shards from production detections.")
+    sub = p.add_subparsers(dest="command", required=True)
+
+    select = sub.add_parser("select", help="Pick recordings to label and append their spectrograms to a split")
+    source = select.add_mutually_exclusive_group(required=True)
+    source.add_argument("--store", help="Results store of reprocess_archive.py")
+    source.add_argument("--detections", help="Folder tree with the *_detections.txt files of the stations")
+    select.add_argument("--audio-root", required=True, help="Folder the recordings are found in")
+    select.add_argument("--dataset", default="datasets/birdeep", help="Dataset folder (default: datasets/birdeep)")
+    select.add_argument("--split", default="train", help="Split the images are appended to (default: train)")
+    select.add_argument("--count", type=int, default=100, help="Recordings to pick (default: 100)")
+    select.add_argument("--pool", type=int, default=20,
+                        help="The diversity step looks at the pool x count most uncertain recordings (default: 20)")
+    select.add_argument("--diversity", type=float, default=0.5,
+                        help="Weight of the diversity against the uncertainty, 0 to 1 (default: 0.5)")
+    select.add_argument("--imgsz", type=int, default=640, help="Long side of the stored images (default: 640)")
+    select.add_argument("--review", help="Also write PNG images and YOLO pre-annotations here for the annotators")
+
+    labels = sub.add_parser("labels", help="Replace the labels of a split with reviewed YOLO label files")
+    labels.add_argument("split_dir")
+    labels.add_argument("labels_dir")
+
+    pack = sub.add_parser("pack", help="Append images and their YOLO label files to a split")
+    pack.add_argument("images")
+    pack.add_argument("--labels", help="Folder of the label files (default: labels/ next to the images folder)")
+    pack.add_argument("--dataset", default="datasets/birdeep", help="Dataset folder (default: datasets/birdeep)")
+    pack.add_argument("--split", default="train", help="Split the images are appended to (default: train)")
+    pack.add_argument("--imgsz", type=int, default=640, help="Long side of the stored images (default: 640)")
+
+    train = sub.add_parser("train", help="Train the detector on the shards of a dataset")
+    train.add_argument("dataset")
+    train.add_argument("--model", default="yolov8s.pt", help="Starting weights (default: yolov8s.pt)")
+    train.add_argument("--epochs", type=int, default=100)
+    train.add_argument("--imgsz", type=int, default=640)
+    train.add_argument("--batch", type=int, default=16)
+    train.add_argument("--device", help="Device, e.g. 0 or cpu")
+    train.add_argument("--project", default="BIRDeep")
+    train.add_argument("--name", default="shards")
+    args = p.parse_args()
+    if args.command == "select" and not 0 <= args.diversity <= 1:
+        p.error("--diversity must be within [0, 1]")
+    return args
+
+def split_size(height, width, imgsz):
+    """Size of the stored images, the long side at imgsz like ultralytics resizes them."""
+    r = imgsz / max(height, width)
+    return min(math.ceil(height * r), imgsz), min(math.ceil(width * r), imgsz)
+
+def find_audio(audio_root, stem):
+    """Path of the recording called stem (any audio extension, any case) under audio_root, None if not found."""
+    for ext in AUDIO_EXTENSIONS:
+        for candidate in (ext, ext.upper()):
+            path = os.path.join(audio_root, stem + candidate)
+            if os.path.exists(path):
+                return path
+    return None
+
+def load_store(path, audio_root):
+    """
+    Recordings of a results store with their detections (start, end, class, score, channel scores) and the mean of
+    every acoustic index over channels and windows.
+    """
+    conn = sqlite3.connect(path)
+    recordings = {clip: {"source": clip, "audio": os.path.join(audio_root, clip), "duration": duration,
+                         "table": [], "indices": {}}
+                  for clip, duration in conn.execute("SELECT clip, duration FROM clips WHERE status = 'ok'")}
+    for clip, start, end, cls, score, channel_scores in conn.execute(
+            "SELECT clip, start, end, class, score, channel_scores FROM detections"):
+        if clip in recordings:
+            recordings[clip]["table"].append([start, end, cls, score] + json.loads(channel_scores))
+    if conn.execute("SELECT name FROM sqlite_master WHERE name = 'indices'").fetchone():
+        for clip, name, value in conn.execute("SELECT clip, name, AVG(value) FROM indices GROUP BY clip, name"):
+            if clip in recordings:
+                recordings[clip]["indices"][name] = value
+    conn.close()
+    return list(recordings.values())
+
+def load_detection_files(folder, audio_root):
+    """Recordings of the *_detections.txt files of a folder tree (and their *_indices.csv, when there is one)."""
+    from detections import Detections
+
+    recordings = []
+    for path in sorted(glob.glob(os.path.join(folder, "**", "*_detections.txt"), recursive=True)):
+        stem = os.path.basename(path)[:-len("_detections.txt")]
+        audio = find_audio(audio_root, stem)
+        if audio is None:
+            continue
+        detections = Detections.load(path)
+        indices = {}
+        indices_path = path.replace("_detections.txt", "_indices.csv")
+        if os.path.exists(indices_path):
+            with open(indices_path) as f:
+                names = f.readline().strip().split(",")[2:]
+            values = np.loadtxt(indices_path, delimiter=",", skiprows=1, ndmin=2)[:, 2:]
+            indices = dict(zip(names, values.mean(axis=0)))
+        recordings.append({"source": os.path.basename(audio), "audio": audio, "duration": detections.duration,
+                           "table": detections.to_array().tolist(), "indices": indices})
+    return recordings
+
+def uncertainty(scores):
+    """Binary entropy (bits) of the least confident detection: 1 at a score of 0.5, 0 without detections."""
+    p = np.clip(np.asarray(scores, dtype=float), 1e-6, 1 - 1e-6)
+    if not len(p):
+        return 0.0
+    return float(np.max(-(p * np.log2(p) + (1 - p) * np.log2(1 - p))))
+
+def recording_features(recordings):
+    """
+    Standardised features of every recording for the diversity: time of day (on a circle), station (one-hot),
+    number and mean score of the detections and the acoustic indices every recording has.
+    """
+    from recording_catalogue import CLIP_TIME_PATTERNS, recording_station
+
+    hours = []
+    for rec in recordings:
+        hour = np.nan
+        for pattern, fmt in CLIP_TIME_PATTERNS:
+            match = pattern.search(rec["source"])
+            if match:
+                t = datetime.strptime(match.group(1), fmt)
+                hour = t.hour + t.minute / 60
+                break
+        hours.append(hour)
+    angle = np.nan_to_num(np.asarray(hours) / 24 * 2 * np.pi)
+    stations = [recording_station(rec["source"]) for rec in recordings]
+    names = sorted(set(stations))
+    columns = [np.sin(angle), np.cos(angle)]
+    if len(names) > 1:
+        columns += [np.array([station == name for station in stations], dtype=float) for name in names]
+    columns.append(np.log1p([len(rec["table"]) for rec in recordings]))
+    columns.append([np.mean([row[3] for row in rec["table"]]) if rec["table"] else 0.0 for rec in recordings])
+    shared = set.intersection(*(set(rec["indices"]) for rec in recordings)) if recordings else set()
+    columns += [[rec["indices"][name] for rec in recordings] for name in sorted(shared)]
+
+    X = np.column_stack(columns).astype(float)
+    return (X - X.mean(axis=0)) / np.maximum(X.std(axis=0), 1e-9)
+
+def select_recordings(u, X, count, diversity=0.5, pool=20):
+    """
+    Indices of the picked recordings: greedy on (1 - diversity) * uncertainty + diversity * distance to the closest
+    recording already picked (scaled to [0, 1]), among the pool * count most uncertain ones.
+    """
+    candidates = np.argsort(-u, kind="stable")[:pool * count]
+    u, X = u[candidates], X[candidates]
+    picked = []
+    distance = np.full(len(candidates), np.inf)
+    for _ in range(min(count, len(candidates))):
+        # Every recording is as far as can be before the first pick
+        spread = distance / distance.max() if picked and distance.max() > 0 else np.ones(len(candidates))
+        score = (1 - diversity) * u + diversity * spread
+        score[picked] = -np.inf
+        best = int(np.argmax(score))
+        picked.append(best)
+        distance = np.minimum(distance, np.linalg.norm(X - X[best], axis=1))
+    return candidates[picked]
+
+def pre_annotations(table, duration, channel):
+    """YOLO labels of the detections of a channel: full height boxes over the time of every detection."""
+    rows = []
+    for row in table:
+        start, end, cls, channel_scores = row[0], row[1], row[2], row[4:]
+        if channel_scores and channel < len(channel_scores) and channel_scores[channel] <= 0:
+            continue
+        rows.append([cls, (start + end) / (2 * duration), 0.5, (end - start) / duration, 1.0])
+    return np.array(rows, dtype=np.float32).reshape(-1, 5)
+
+def write_review(review, name, image, labels):
+    import cv2
+
+    os.makedirs(os.path.join(review, "images"), exist_ok=True)
+    os.makedirs(os.path.join(review, "labels"), exist_ok=True)
+    cv2.imwrite(os.path.join(review, "images", name), image)
+    np.savetxt(os.path.join(review, "labels", os.path.splitext(name)[0] + ".txt"), labels,
+               fmt=["%d", "%.6f", "%.6f", "%.6f", "%.6f"])
+
+def select(args):
+    from audio_processing import save_channel_spectrograms
+
+    recordings = load_store(args.store, args.audio_root) if args.store else load_detection_files(args.detections, args.audio_root)
+    writer = ShardWriter(os.path.join(args.dataset, args.split))
+    done = writer.sources()
+    recordings = [rec for rec in recordings if rec["source"] not in done]
+    if not recordings:
+        print("No recordings left to pick")
+        return
+
+    u = np.array([uncertainty([row[3] for row in rec["table"]]) for rec in recordings])
+    picked = select_recordings(u, recording_features(recordings), args.count, args.diversity, args.pool)
+    print(f"Picked {len(picked)} of {len(recordings)} recordings, uncertainty {np.mean(u[picked]):.2f} on average "
+          f"({np.mean(u):.2f} over all)")
+
+    t0, images = time.time(), 0
+    try:
+        for i in picked:
+            rec = recordings[i]
+            channels, _, duration, _ = save_channel_spectrograms(rec["audio"], in_memory=True)
+            if writer.height is None:
+                writer.height, writer.width = split_size(*channels[0].shape[:2], args.imgsz)
+            stem = os.path.splitext(rec["source"])[0].replace(os.sep, "_")
+            for channel, image in enumerate(channels):
+                name = f"{stem}_ch{channel}.PNG"
+                labels = pre_annotations(rec["table"], duration, channel)
+                writer.add(name, image, labels, source=rec["source"], channel=channel, uncertainty=u[i])
+                if args.review:
+                    write_review(args.review, name, image, labels)
+                images += 1
+            print(f"{rec['source']}: uncertainty {u[i]:.2f}, {len(rec['table'])} detections, {len(channels)} channels")
+    finally:
+        writer.close()
+        write_data_yaml(args.dataset, CLASS_NAMES)
+    print(f"{images} images added to {os.path.join(args.dataset, args.split)} in {time.time() - t0:.0f}s, "
+          f"{len(writer)} in the split")
+
+def relabel(args):
+    writer = ShardWriter(args.split_dir)
+    labels = {}
+    for path in glob.glob(os.path.join(args.labels_dir, "*.txt")):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        labels.update({f"{stem}{ext}": read_yolo_labels(path) for ext in (".PNG", ".png", ".jpg")})
+    count = writer.relabel(labels)
+    writer.close()
+    print(f"{count} of {len(writer)} images of {args.split_dir} relabelled")
+
+def pack(args):
+    import cv2
+
+    labels_dir = args.labels or os.path.join(os.path.dirname(os.path.abspath(args.images)), "labels")
+    writer = ShardWriter(os.path.join(args.dataset, args.split))
+    known = writer.names()
+    paths = sorted(path for path in glob.glob(os.path.join(args.images, "*")) if path.lower().endswith(IMAGE_EXTENSIONS))
+    added = 0
+    try:
+        for path in paths:
+            name = os.path.basename(path)
+            if name in known:
+                continue
+            image = cv2.imread(path, cv2.IMREAD_COLOR)
+            if writer.height is None:
+                writer.height, writer.width = split_size(*image.shape[:2], args.imgsz)
+            label_path = os.path.join(labels_dir, os.path.splitext(name)[0] + ".txt")
+            writer.add(name, image, read_yolo_labels(label_path), source=name, labelled=os.path.exists(label_path))
+            added += 1
+    finally:
+        writer.close()
+        write_data_yaml(args.dataset, CLASS_NAMES)
+    print(f"{added} images added to {os.path.join(args.dataset, args.split)}, {len(writer)} in the split")
+
+def train(args):
+    from shard_dataset import ShardTrainer
+
+    overrides = {"model": args.model, "data": os.path.join(args.dataset, "data.yaml"), "epochs": args.epochs,
+                 "imgsz": args.imgsz, "batch": args.batch, "project": args.project, "name": args.name,
+                 "single_cls": True, "cache": False}
+    if args.device:
+        overrides["device"] = args.device
+    ShardTrainer(overrides=overrides).train()
+
+def main():
+    args = parse_args()
+    {"select": select, "labels": relabel, "pack": pack, "train": train}[args.command](args)
+
+if __name__ == "__main__":
+    main()
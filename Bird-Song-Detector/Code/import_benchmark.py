@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Measure the import time of the entry points with `python -X importtime`, to keep cold starts fast.
+
+Every module is imported in a fresh interpreter --runs times; the median of the total import time is reported with
+the slowest imports (cumulative time, including their own imports). With --baseline the totals are compared to a
+previous run and the exit code is 1 when a module got slower than --threshold, so a heavy top-level import added by
+mistake is caught before it reaches the stations. --save writes the totals of this run as the new baseline.
+
+Examples:
+  python import_benchmark.py
+  python import_benchmark.py predict_on_audio upload_to_s3 --top 15
+  python import_benchmark.py --save import_baseline.json
+  python import_benchmark.py --baseline import_baseline.json --threshold 0.25
+"""
+
+# Import libraries
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# upload_to_s3.py lives next to Code/ in record/
+SEARCH_PATH = [HERE, os.path.dirname(HERE)]
+DEFAULT_MODULES = ["predict_on_audio", "predict_on_folder", "audio_processing", "upload_to_s3"]
+
+LINE_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Import time of the entry points (python -X importtime).")
+    p.add_argument("modules", nargs="*", help=f"Modules to import (default: {', '.join(DEFAULT_MODULES)} when present)")
+    p.add_argument("--runs", type=int, default=5, help="Fresh interpreters per module, the median is kept (default: 5)")
+    p.add_argument("--top", type=int, default=10, help="Slowest imports shown per module (default: 10)")
+    p.add_argument("--baseline", help="JSON of a previous --save to compare with")
+    p.add_argument("--threshold", type=float, default=0.2, help="Allowed slowdown over the baseline (default: 0.2 = 20%%)")
+    p.add_argument("--save", help="Write the totals of this run to this JSON file")
+    return p.parse_args()
+
+def import_time(module):
+    """
+    Import a module in a fresh interpreter.
+
+    Returns:
+        total (float): Import time of the module and everything it imports, in seconds.
+        imports (list): (cumulative seconds, self seconds, depth, name) of every module imported.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(SEARCH_PATH + [os.getenv("PYTHONPATH", "")]).rstrip(os.pathsep))
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                         cwd=HERE, env=env, capture_output=True, text=True)
+    if out.returncode:
+        raise RuntimeError(out.stderr.strip().splitlines()[-1] if out.stderr.strip() else f"exit code {out.returncode}")
+    imports = []
+    for line in out.stderr.splitlines():
+        match = LINE_RE.match(line)
+        if match:
+            own, cumulative, indent, name = match.groups()
+            imports.append((int(cumulative) / 1e6, int(own) / 1e6, (len(indent) - 1) // 2, name))
+    # Top-level imports (depth 0) add up to the whole import, the interpreter start-up is not counted
+    total = sum(cumulative for cumulative, _, depth, _ in imports if depth == 0)
+    return total, imports
+
+def main():
+    args = parse_args()
+    modules = args.modules or [m for m in DEFAULT_MODULES
+                                if any(os.path.exists(os.path.join(d, m + ".py")) for d in SEARCH_PATH)]
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    totals, regressions = {}, []
+    for module in modules:
+        try:
+            runs = [import_time(module) for _ in range(max(1, args.runs))]
+        except RuntimeError as e:
+            print(f"{module}: import failed: {e}\n")
+            continue
+        total = statistics.median(t for t, _ in runs)
+        totals[module] = round(total, 4)
+        line = f"{module}: {total * 1000:.0f} ms (median of {len(runs)})"
+        if module in baseline:
+            change = total / baseline[module] - 1 if baseline[module] else 0.0
+            line += f", baseline {baseline[module] * 1000:.0f} ms ({change:+.0%})"
+            if change > args.threshold:
+                regressions.append(module)
+                line += "  SLOWER"
+        print(line)
+        # Slowest imports of the last run, nested imports included in their parent
+        for cumulative, own, depth, name in sorted(runs[-1][1], reverse=True)[:args.top]:
+            print(f"  {cumulative * 1000:8.1f} ms  (self {own * 1000:6.1f} ms)  {'  ' * depth}{name}")
+        print()
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(totals, f, indent=2, sort_keys=True)
+        print(f"Saved the totals to {args.save}")
+    if regressions:
+        print(f"Import time over the baseline by more than {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
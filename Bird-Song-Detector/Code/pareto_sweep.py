@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Speed/accuracy sweep of the detector settings, to pick the operating point of every station from data.
+
+Every combination of the grid is run over a folder of recordings (the spectrograms are rendered with each STFT
+setting) or of already rendered spectrograms (--images, the STFT grid is then ignored):
+- STFT: --n-fft and --hop (spectrogram_params of audio_processing.save_channel_spectrograms),
+- model input size: --imgsz (trained at 640, see Models/Bird_Song_Detector/args.yaml),
+- NMS IoU threshold: --iou,
+- confidence threshold: --conf (applied to the detections of one run at the lowest value, which gives the same
+  detections as one run per threshold).
+
+The detections are scored as time intervals (start and end as fractions of the clip, matched at interval
+IoU >= --match-iou) against a reference:
+- --labels DIR: YOLO label files (<name>.txt, "class x_center y_center width height", normalised),
+- --predictions predictions.json: COCO-style predictions of a validation run (bbox in pixels of the image),
+  for the images of --images that are in it,
+- otherwise the detections of the production setting (n_fft 2048, hop 512, imgsz 640, iou 0.7, conf
+  --reference-conf), i.e. what is lost compared with what runs today.
+
+Latency is the median time per clip of the spectrogram rendering (audio only) plus the inference. Every row of
+the grid goes to --output (CSV) with its AP50, precision, recall and F1; the rows on the Pareto frontier of
+latency versus --objective are printed, with the fastest setting within --max-drop of the best.
+
+Examples:
+  python pareto_sweep.py --audios ../Data/Audios --imgsz 640,480,320 --n-fft 2048,1024 --device cpu
+  python pareto_sweep.py --images ../Data/Images --imgsz 640,416,320 --iou 0.5,0.7 --conf 0.1,0.25,0.4
+  python pareto_sweep.py --images val/images --predictions ../Models/Bird_Song_Detector/predictions.json
+"""
+
+# Import libraries
+import argparse
+import csv
+import glob
+import itertools
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+from audio_processing import SPECTROGRAM_PARAMS, save_channel_spectrograms
+from channel_fusion import interval_iou
+from detections import Detections
+from inference_service import MODEL_PATH
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Setting of the pipeline today, the default reference
+PRODUCTION = {"n_fft": SPECTROGRAM_PARAMS["n_fft"], "hop_length": SPECTROGRAM_PARAMS["hop_length"], "imgsz": 640, "iou": 0.7}
+
+def floats(text):
+    return [float(v) for v in text.split(",")]
+
+def ints(text):
+    return [int(v) for v in text.split(",")]
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Speed/accuracy Pareto sweep over input size, thresholds and STFT settings.")
+    source = p.add_mutually_exclusive_group()
+    source.add_argument("--audios", default=os.path.join(HERE, "..", "Data", "Audios"), help="Recordings (default: ../Data/Audios)")
+    source.add_argument("--images", help="Spectrogram images instead of recordings (the STFT grid is ignored)")
+    p.add_argument("--model", default=MODEL_PATH, help="Model weights (env BIRD_MODEL)")
+    p.add_argument("--device", default="cpu", help="Inference device (default: cpu, like the stations)")
+    p.add_argument("--imgsz", type=ints, default=[640, 512, 416, 320], help="Model input sizes (default: 640,512,416,320)")
+    p.add_argument("--iou", type=floats, default=[0.5, 0.7], help="NMS IoU thresholds (default: 0.5,0.7)")
+    p.add_argument("--conf", type=floats, default=[0.1, 0.25, 0.4, 0.5], help="Confidence thresholds (default: 0.1,0.25,0.4,0.5)")
+    p.add_argument("--n-fft", type=ints, default=[2048, 1024], help="STFT sizes (default: 2048,1024)")
+    p.add_argument("--hop", type=ints, default=[512], help="STFT hop lengths (default: 512)")
+    p.add_argument("--fusion", default=os.getenv("CHANNEL_FUSION", "max"), help="Channel fusion policy (default: max)")
+    p.add_argument("--labels", help="Folder of YOLO label files to score against")
+    p.add_argument("--predictions", help="COCO-style predictions.json to score against (with --images)")
+    p.add_argument("--reference-conf", type=float, default=0.25, help="Confidence of the production reference (default: 0.25)")
+    p.add_argument("--match-iou", type=float, default=0.5, help="Interval IoU of a true positive (default: 0.5)")
+    p.add_argument("--objective", choices=("f1", "ap50"), default="f1", help="Accuracy axis of the frontier (default: f1)")
+    p.add_argument("--max-drop", type=float, default=0.05, help="Accuracy loss accepted for the recommendation (default: 0.05)")
+    p.add_argument("--limit", type=int, help="Only the first N clips")
+    p.add_argument("--output", default="pareto_sweep.csv", help="CSV of every setting (default: pareto_sweep.csv)")
+    return p.parse_args()
+
+def load_labels(folder, name):
+    """Intervals of the YOLO label file of a clip, as fractions of the clip."""
+    path = os.path.join(folder, name + ".txt")
+    if not os.path.exists(path):
+        return np.zeros((0, 2))
+    rows = np.loadtxt(path, ndmin=2)
+    if not len(rows):
+        return np.zeros((0, 2))
+    return np.column_stack([rows[:, 1] - rows[:, 3] / 2, rows[:, 1] + rows[:, 3] / 2])
+
+def load_predictions(path, images):
+    """Intervals of predictions.json by image name, as fractions of the width of the image."""
+    from PIL import Image
+
+    boxes = {}
+    with open(path) as f:
+        for prediction in json.load(f):
+            boxes.setdefault(str(prediction["image_id"]), []).append(prediction["bbox"])
+    reference = {}
+    for name, image_path in images.items():
+        if name not in boxes:
+            continue
+        with Image.open(image_path) as img:
+            width = img.width
+        reference[name] = np.array([[x / width, (x + w) / width] for x, _, w, _ in boxes[name]]).reshape(-1, 2)
+    return reference
+
+def match(predicted, reference, iou_threshold):
+    """
+    Greedy matching of predicted intervals (highest score first) to reference intervals.
+
+    Args:
+        predicted (np.ndarray): (N, 3) start, end, score.
+        reference (np.ndarray): (M, 2) start, end.
+
+    Returns:
+        np.ndarray: (N, 2) score and 1 for a true positive, 0 for a false positive.
+    """
+    predicted = predicted[np.argsort(-predicted[:, 2])]
+    if not len(reference) or not len(predicted):
+        return np.column_stack([predicted[:, 2], np.zeros(len(predicted))])
+    iou = interval_iou(predicted[:, :2], reference)
+    used = np.zeros(len(reference), dtype=bool)
+    tp = np.zeros(len(predicted))
+    for i in range(len(predicted)):
+        candidates = np.where(~used & (iou[i] >= iou_threshold))[0]
+        if len(candidates):
+            used[candidates[np.argmax(iou[i, candidates])]] = True
+            tp[i] = 1
+    return np.column_stack([predicted[:, 2], tp])
+
+def average_precision(scored, n_reference):
+    """Area under the precision/recall curve with the precision envelope (all-point interpolation)."""
+    if not n_reference or not len(scored):
+        return 0.0
+    scored = scored[np.argsort(-scored[:, 0], kind="stable")]
+    tp = np.cumsum(scored[:, 1])
+    recall = np.concatenate([[0], tp / n_reference])
+    precision = np.concatenate([[1], tp / np.arange(1, len(tp) + 1)])
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    return float(np.sum(np.diff(recall) * precision[1:]))
+
+def pareto_front(rows, objective):
+    """Rows not dominated by a faster and at least as accurate row."""
+    front, best = [], -1.0
+    for row in sorted(rows, key=lambda r: (r["latency_ms"], -r[objective])):
+        if row[objective] > best:
+            front.append(row)
+            best = row[objective]
+    return front
+
+class Sweep:
+    """Renders and runs every clip once per setting, keeping the normalised detections and the latencies."""
+
+    def __init__(self, model, device, fusion, clips, images_mode):
+        self.model = model
+        self.device = device
+        self.fusion = fusion
+        self.clips = clips
+        self.images_mode = images_mode
+        self.tmp = tempfile.TemporaryDirectory(prefix="pareto_")
+        self.rendered = {}
+
+    def images(self, n_fft, hop):
+        """Spectrograms of every clip with these STFT settings: {name: (image paths, duration)}, render seconds."""
+        key = (n_fft, hop)
+        if key not in self.rendered:
+            if self.images_mode:
+                self.rendered[key] = ({name: ([path], 1.0) for name, path in self.clips.items()}, [0.0])
+            else:
+                out, seconds = {}, []
+                folder = os.path.join(self.tmp.name, f"nfft{n_fft}_hop{hop}")
+                # The first STFT of the process compiles librosa's kernels, it is not timed
+                save_channel_spectrograms(next(iter(self.clips.values())), os.path.join(folder, "warmup"),
+                                          params={"n_fft": n_fft, "hop_length": hop})
+                for name, path in self.clips.items():
+                    t0 = time.perf_counter()
+                    image_paths, _, duration, _ = save_channel_spectrograms(path, folder, params={"n_fft": n_fft, "hop_length": hop})
+                    seconds.append(time.perf_counter() - t0)
+                    out[name] = (image_paths, duration)
+                self.rendered[key] = (out, seconds)
+        return self.rendered[key]
+
+    def run(self, n_fft, hop, imgsz, iou, conf):
+        """Detections of every clip, {name: (N, 3) start, end, score as fractions}, and the median ms per clip."""
+        images, render_seconds = self.images(n_fft, hop)
+        # The first inference at a new size is slower, it is not timed
+        first = next(iter(images.values()))[0]
+        self.model(first, imgsz=imgsz, conf=conf, iou=iou, device=self.device, verbose=False)
+
+        detections, seconds = {}, []
+        for name, (image_paths, duration) in images.items():
+            t0 = time.perf_counter()
+            results = self.model(image_paths, imgsz=imgsz, conf=conf, iou=iou, device=self.device, verbose=False)
+            seconds.append(time.perf_counter() - t0)
+            found = Detections.from_results(results, duration, fusion=self.fusion)
+            detections[name] = np.column_stack([found.start / duration, found.end / duration, found.score])
+        latency = statistics.median(seconds) + statistics.median(render_seconds)
+        return detections, latency * 1000
+
+def main():
+    args = parse_args()
+    from ultralytics import YOLO
+
+    if args.images:
+        paths = sorted(glob.glob(os.path.join(args.images, "*.png")) + glob.glob(os.path.join(args.images, "*.PNG")))
+    else:
+        paths = sorted(p for p in glob.glob(os.path.join(args.audios, "*")) if p.lower().endswith((".wav", ".flac")))
+    clips = {os.path.splitext(os.path.basename(p))[0]: p for p in paths[:args.limit]}
+    if not clips:
+        raise SystemExit("No clips found")
+    stft_grid = [(SPECTROGRAM_PARAMS["n_fft"], SPECTROGRAM_PARAMS["hop_length"])] if args.images else \
+        list(itertools.product(args.n_fft, args.hop))
+
+    sweep = Sweep(YOLO(args.model), args.device, args.fusion, clips, bool(args.images))
+    if args.labels:
+        reference = {name: load_labels(args.labels, name) for name in clips}
+        source = f"labels in {args.labels}"
+    elif args.predictions:
+        if not args.images:
+            raise SystemExit("--predictions needs --images: its boxes are in pixels of the validation images")
+        reference = load_predictions(args.predictions, clips)
+        if not reference:
+            raise SystemExit(f"None of the {len(clips)} images is in {args.predictions}; use the validation images, "
+                             "--labels, or the production setting as reference (default)")
+        source = f"{args.predictions} ({len(reference)} images)"
+    else:
+        detections, _ = sweep.run(PRODUCTION["n_fft"], PRODUCTION["hop_length"], PRODUCTION["imgsz"],
+                                  PRODUCTION["iou"], args.reference_conf)
+        reference = {name: d[d[:, 2] >= args.reference_conf, :2] for name, d in detections.items()}
+        source = f"production setting {PRODUCTION} at conf {args.reference_conf}"
+    n_reference = sum(len(r) for name, r in reference.items())
+    print(f"{len(clips)} clips, reference: {source}, {n_reference} intervals\n")
+
+    rows = []
+    min_conf = min(args.conf)
+    for (n_fft, hop), imgsz, iou in itertools.product(stft_grid, args.imgsz, args.iou):
+        detections, latency = sweep.run(n_fft, hop, imgsz, iou, min_conf)
+        scored = np.concatenate([match(detections[name], ref, args.match_iou) for name, ref in reference.items()])
+        ap50 = average_precision(scored, n_reference)
+        for conf in args.conf:
+            kept = scored[scored[:, 0] >= conf]
+            tp = kept[:, 1].sum()
+            precision = tp / len(kept) if len(kept) else 0.0
+            recall = tp / n_reference if n_reference else 0.0
+            f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+            rows.append({"n_fft": n_fft, "hop_length": hop, "imgsz": imgsz, "iou": iou, "conf": conf,
+                         "latency_ms": round(latency, 1), "ap50": round(ap50, 4), "precision": round(precision, 4),
+                         "recall": round(recall, 4), "f1": round(f1, 4), "detections": len(kept)})
+        print(f"n_fft {n_fft:5} hop {hop:4} imgsz {imgsz:4} iou {iou:.2f}: {latency:7.1f} ms/clip, AP50 {ap50:.3f}")
+
+    front = pareto_front(rows, args.objective)
+    for row in rows:
+        row["pareto"] = int(row in front)
+    with open(args.output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print(f"\nPareto frontier (latency vs {args.objective}), all settings in {args.output}:")
+    print(f"{'n_fft':>6} {'hop':>5} {'imgsz':>6} {'iou':>5} {'conf':>5} {'ms/clip':>8} {'AP50':>6} {'P':>6} {'R':>6} {'F1':>6}")
+    for r in front:
+        print(f"{r['n_fft']:6} {r['hop_length']:5} {r['imgsz']:6} {r['iou']:5.2f} {r['conf']:5.2f} {r['latency_ms']:8.1f} "
+              f"{r['ap50']:6.3f} {r['precision']:6.3f} {r['recall']:6.3f} {r['f1']:6.3f}")
+    best = max(r[args.objective] for r in rows)
+    pick = min((r for r in front if r[args.objective] >= best - args.max_drop), key=lambda r: r["latency_ms"])
+    print(f"\nFastest within {args.max_drop} {args.objective} of the best ({best:.3f}): n_fft {pick['n_fft']}, "
+          f"hop {pick['hop_length']}, imgsz {pick['imgsz']}, iou {pick['iou']}, conf {pick['conf']} "
+          f"({pick['latency_ms']} ms/clip, {args.objective} {pick[args.objective]:.3f})")
+
+if __name__ == "__main__":
+    main()
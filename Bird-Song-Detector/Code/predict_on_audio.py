@@ -19,70 +19,76 @@ Variables:
 """
 
 # Import libraries
-from ultralytics import YOLO
+# Only light modules at import time: ultralytics, librosa, matplotlib... are imported by the functions that need them
 import os
-import numpy as np
-import pandas as pd
-from ultralytics.utils.ops import Profile
-from audio_processing import save_spectrogram_from_audio, transform_coordinates_to_seconds, transform_predictions_save_segment
-import librosa
-import soundfile as sf
-from zipfile import ZipFile
-import tempfile
 import sys
 import time 
 import glob
 
-model = YOLO("/opt/bird-files/Bird-Song-Detector/Models/Bird Song Detector/weights/best.pt")
-brank = np.zeros((320, 640, 3), dtype=np.uint8)
-_ = model(brank)
-model.to("cuda")
-print("Model device:", next(model.model.parameters()).device)
+# Folder watched for new checkpoints that are swapped in without restarting (the weights are BIRD_MODEL, see
+# inference_service.py)
+MODEL_DIR = os.getenv("BIRD_MODEL_DIR")
+# Fraction of the clips a new checkpoint runs on in shadow mode before it is promoted (0 = swap immediately)
+SHADOW_FRACTION = float(os.getenv("BIRD_SHADOW_FRACTION", "0"))
+SHADOW_PROMOTE_AFTER = int(os.getenv("BIRD_SHADOW_PROMOTE_AFTER", "0"))
 
-def extract_segments_and_save_zip_from_txt(audio_path: str, segments_txt_path: str, output_zip_path: str = None):
+# Loaded by load_model(), the slowest part of a cold start. With BIRD_DETECTOR_SOCKET set, the model of the detector
+# daemon shared with the other entry points is used instead (see inference_service.py)
+model = None
+
+def load_local_model():
+    from inference_service import MODEL_PATH
+    from model_manager import ModelManager
+    return ModelManager(MODEL_PATH, watch_dir=MODEL_DIR, device="cuda", shadow_fraction=SHADOW_FRACTION, promote_after=SHADOW_PROMOTE_AFTER)
+
+def load_model():
+    global model
+    if model is None:
+        from inference_service import load_detector
+        model = load_detector(load_local_model)
+    return model
+
+# How the detections of the channels of a recording are merged: max, union or snr (see channel_fusion.py)
+CHANNEL_FUSION = os.getenv("CHANNEL_FUSION", "max")
+
+# Spectrograms and detections of files already processed are reused when SPECTROGRAM_CACHE is set (see main())
+cache = None
+
+def extract_segments_and_save_zip(audio_path: str, detections, output_zip_path: str = None):
     """
-    Extracts audio segments based on a .txt file containing start_second, end_second, class, and confidence.
-    Saves all extracted segments as .wav files in a zip archive.
+    Extracts the audio segment of every detection and saves them as .wav files in a zip archive.
 
     Args:
         audio_path (str): Path to the original audio file.
-        segments_txt_path (str): Path to the TXT file with transformed predictions.
+        detections (Detections): Detections of the audio file (start_second, end_second, class, confidence).
         output_zip_path (str, optional): Path to the output ZIP file. Defaults to <audio_name>_segments.zip.
     """
+    import tempfile
+    from zipfile import ZipFile
+
+    import librosa
+    import soundfile as sf
+
     if not os.path.exists(audio_path):
         print(f"Audio file not found: {audio_path}")
         return
-    if not os.path.exists(segments_txt_path):
-        print(f"Prediction TXT file not found: {segments_txt_path}")
+    if not len(detections):
+        print("No valid segments found.")
         return
 
     audio_name = os.path.basename(audio_path).rsplit('.', 1)[0]
     output_zip_path = output_zip_path or f"/opt/bird-files/Bird-Song-Detector/runs/detect/predict/{audio_name}_segments.zip"
 
-    # Load audio
-    y, sr = librosa.load(audio_path, sr=None)
-
-    # Read segments
-    segments = []
-    with open(segments_txt_path, 'r') as f:
-        for idx, line in enumerate(f):
-            parts = line.strip().split()
-            if len(parts) < 4:
-                continue  # Skip malformed lines
-            start, end, cls, conf = map(float, parts[:4])
-            segments.append((idx, start, end, int(cls), conf))
-
-    if not segments:
-        print("No valid segments found.")
-        return
+    # Load audio, keeping every channel
+    y, sr = librosa.load(audio_path, sr=None, mono=False)
 
     with tempfile.TemporaryDirectory() as tmpdir:
         wav_paths = []
-        for idx, start, end, cls, conf in segments:
-            segment = y[int(start * sr):int(end * sr)]
+        for idx, (start, end, cls, conf) in enumerate(detections):
+            segment = y[..., int(start * sr):int(end * sr)]
             filename = f"{audio_name}_segment_{idx}_class{cls}_conf{conf:.2f}.wav"
             out_path = os.path.join(tmpdir, filename)
-            sf.write(out_path, segment, sr)
+            sf.write(out_path, segment.T, sr)
             wav_paths.append(out_path)
 
         with ZipFile(output_zip_path, 'w') as zipf:
@@ -91,36 +97,35 @@ def extract_segments_and_save_zip_from_txt(audio_path: str, segments_txt_path: s
 
     print(f"Extracted {len(wav_paths)} segments and saved to: {output_zip_path}")
 
-def run(audio_path):
-    # Load model (Bird Song Detector from BIRDeep)
-    
+def run(audio_path, fusion=CHANNEL_FUSION):
+    from audio_processing import detect_channels, transform_predictions_save_segment
+
     # Clean the output folder
     import shutil
 
     # Clean the output folder
     shutil.rmtree('runs', ignore_errors=True)
 
-    audio_name = os.path.basename(audio_path).replace(".wav", "")
-    # Audio has to be converted to spectrogram and saved as image
-    with Profile() as dt:
-        image_path = save_spectrogram_from_audio(audio_path)
-    print("Spectrogram extraction: ",dt)
+    # Every channel is converted to a spectrogram, detected in one batch and the channels are fused
+    detections = detect_channels(load_model(), audio_path, fusion=fusion, cache=cache)
 
-    with Profile() as dtmodel:
-        model(image_path, save_txt=True, save_conf=True)
-    print("Model extraction: ",dtmodel)
-    # Read txt in the output folder
-    predictions_txt = f"/opt/bird-files/Bird-Song-Detector/runs/detect/predict/labels/{audio_name}.txt"
-
-    if os.path.exists(predictions_txt):
-        # Convert to start_second, end_second, class, confidence score:
-        transform_predictions_save_segment(audio_path, predictions_txt)
-        extract_segments_and_save_zip_from_txt(audio_path, predictions_txt)
+    if len(detections):
+        transform_predictions_save_segment(audio_path, detections)
+        extract_segments_and_save_zip(audio_path, detections)
 
     else:
         print(f"No detections for {audio_path}")
 
-if __name__ == "__main__":
+    return detections
+
+def main():
+    global cache
+    from spectrogram_cache import cache_from_env
+
+    cache = cache_from_env()
+    t0 = time.perf_counter()
+    load_model().start()
+    print(f"Model ready in {time.perf_counter() - t0:.1f}s")
     target_dir = "/opt/bird-files/record/data_temp/Audios"
     while True:
         files = os.listdir(target_dir)
@@ -154,4 +159,5 @@ if __name__ == "__main__":
 
         run("/opt/bird-files/Bird-Song-Detector/Data/Audios/AM1_20230511_090000.wav")
 
-
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,524 @@
+"""
+This script keeps a catalogue of the recordings of an archive, built from the file headers only, to answer questions
+such as "which minutes do we have for station AM1 on 2023-05-12" without listing folders or decoding audio.
+
+Workflow:
+1. Walk a directory tree (.wav/.flac, any case). Files whose size and modification time did not change since the
+   last pass are skipped without being opened.
+2. Read the header of the new and changed files: the RIFF (or RF64) chunks of a WAV up to the data chunk, or the
+   STREAMINFO and Vorbis comment blocks of a FLAC. The audio itself is never read.
+   - sample rate, channels, bits per sample and duration (frames in the header, not the 60 s the names suggest)
+   - device metadata: the GUANO chunk, or the comment AudioMoth writes in the LIST/INFO chunk
+   - start of the recording: GUANO Timestamp, the time in the AudioMoth comment, the time in the name
+     (AM1_20230512_083000.WAV, 2025-08-14_22-15-01.wav, local time like fleet_sync.py) or the modification time
+3. Store one row per recording in SQLite (station, start, duration, ...), indexed by station and start, and remove
+   the rows of the files that are gone. The station is the part of the name before the time, or the folder name.
+4. "watch" keeps the catalogue up to date from file system notifications (inotify) as recordings are copied in.
+
+Queries use the index: on a season of one-minute recordings of six stations (a million rows), the recordings of a
+station on a day take about 10 ms and the gaps of a month about 50 ms. "gaps" lists the gaps and overlaps between
+consecutive recordings of a station.
+
+Examples:
+  python recording_catalogue.py index /archive/2023
+  python recording_catalogue.py watch /archive/2023 --rescan 3600
+  python recording_catalogue.py query --station AM1 --day 2023-05-12
+  python recording_catalogue.py gaps --station AM1 --from 2023-05-01 --to 2023-06-01 --tolerance 2
+  python recording_catalogue.py stations
+"""
+
+# Import libraries
+import argparse
+import ctypes
+import json
+import os
+import re
+import select
+import sqlite3
+import struct
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+AUDIO_EXTENSIONS = (".wav", ".flac")
+DEFAULT_CATALOGUE = "catalogue.sqlite"
+
+# Times in the recording names, the same names as in fleet_sync.clip_start_time
+CLIP_TIME_PATTERNS = [
+    (re.compile(r"(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})"), "%Y-%m-%d_%H-%M-%S"),
+    (re.compile(r"(\d{8}_\d{6})"), "%Y%m%d_%H%M%S"),
+]
+# "Recorded at 07:30:00 10/05/2023 (UTC) by AudioMoth 24F3190361DA5F95 at medium gain while battery was 4.8V ..."
+AUDIOMOTH_COMMENT = re.compile(r"Recorded at (\d{2}:\d{2}:\d{2} \d{2}/\d{2}/\d{4}) \(UTC(?:([+-])(\d{1,2})(?::(\d{2}))?)?\)"
+                               r"(?: during deployment \S+)? by (AudioMoth [0-9A-F]+)")
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Catalogue of the recordings of an archive, from the file headers.")
+    p.add_argument("--catalogue", default=os.getenv("RECORDING_CATALOGUE", DEFAULT_CATALOGUE),
+                   help=f"SQLite catalogue (env RECORDING_CATALOGUE, default: {DEFAULT_CATALOGUE})")
+    commands = p.add_subparsers(dest="command", required=True)
+
+    index = commands.add_parser("index", help="Add the new and changed recordings of a directory tree")
+    index.add_argument("root", help="Directory tree with the recordings")
+
+    watch = commands.add_parser("watch", help="Index a directory tree, then follow its changes")
+    watch.add_argument("root", help="Directory tree with the recordings")
+    watch.add_argument("--rescan", type=float, default=3600,
+                       help="Seconds between two full passes, the only updates without inotify (default: 3600)")
+
+    for name, help_text in (("query", "List the recordings of a station"), ("gaps", "List the gaps and overlaps of a station")):
+        q = commands.add_parser(name, help=help_text)
+        q.add_argument("--station", required=True, help="Station, e.g. AM1")
+        q.add_argument("--day", help="Day, YYYY-MM-DD (local time)")
+        q.add_argument("--from", dest="start", help="Start, YYYY-MM-DD or YYYY-MM-DDTHH:MM (local time)")
+        q.add_argument("--to", dest="end", help="End, YYYY-MM-DD or YYYY-MM-DDTHH:MM (local time)")
+        if name == "gaps":
+            q.add_argument("--tolerance", type=float, default=1.0,
+                           help="Seconds between two recordings not reported as a gap or an overlap (default: 1)")
+
+    commands.add_parser("stations", help="Recordings, first and last recording and hours of every station")
+    return p.parse_args()
+
+class HeaderError(ValueError):
+    """The file is not a WAV or FLAC file this script can read the header of."""
+
+def parse_guano(text):
+    """GUANO metadata ("Key: Value" lines, https://github.com/riggsd/guano-spec) as a dict."""
+    fields = {}
+    for line in text.splitlines():
+        key, sep, value = line.partition(":")
+        if sep:
+            fields[key.strip()] = value.strip()
+    return fields
+
+def read_wav_header(f, file_size):
+    """Format, duration and metadata chunks of a RIFF/RF64 WAV file, reading the chunk headers only."""
+    riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+    if riff not in (b"RIFF", b"RF64") or wave != b"WAVE":
+        raise HeaderError("not a RIFF WAVE file")
+    info, fmt, data_size, data_offset, ds64_size = {}, None, None, None, None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        chunk, size = struct.unpack("<4sI", header)
+        if chunk == b"data":
+            data_size, data_offset = size, f.tell()
+            break
+        body = f.read(size)
+        if chunk == b"fmt ":
+            fmt = struct.unpack("<HHIIHH", body[:16])
+        elif chunk == b"ds64":
+            ds64_size = struct.unpack("<Q", body[8:16])[0]
+        elif chunk == b"guan":
+            info["guano"] = parse_guano(body.decode("utf-8", "replace"))
+        elif chunk == b"LIST" and body[:4] == b"INFO":
+            # INFO subchunks: ICMT (comment), IART (artist), ...
+            pos = 4
+            while pos + 8 <= len(body):
+                key, length = struct.unpack("<4sI", body[pos:pos + 8])
+                info[key.decode("ascii", "replace")] = body[pos + 8:pos + 8 + length].split(b"\0")[0].decode("utf-8", "replace")
+                pos += 8 + length + (length & 1)
+        f.seek(size & 1, os.SEEK_CUR)  # chunks are word aligned
+    if fmt is None or data_offset is None:
+        raise HeaderError("no fmt or data chunk")
+    _, channels, sample_rate, _, block_align, bits = fmt
+    if ds64_size is not None and data_size == 0xFFFFFFFF:
+        data_size = ds64_size
+    # A recording still being written (or cut short) has a size of 0 or larger than the file
+    data_size = min(data_size, file_size - data_offset) if data_size else file_size - data_offset
+    frames = data_size // block_align if block_align else 0
+    return {"format": "wav", "sample_rate": sample_rate, "channels": channels, "bits": bits,
+            "duration": frames / sample_rate if sample_rate else 0.0, "info": info}
+
+def read_flac_header(f):
+    """STREAMINFO and Vorbis comments of a FLAC file, the metadata blocks before the first audio frame."""
+    if f.read(4) != b"fLaC":
+        raise HeaderError("not a FLAC file")
+    stream, info = None, {}
+    last = False
+    while not last:
+        header = f.read(4)
+        if len(header) < 4:
+            break
+        last, kind, size = header[0] & 0x80, header[0] & 0x7F, int.from_bytes(header[1:], "big")
+        if kind == 0:
+            stream = int.from_bytes(f.read(size)[10:18], "big")
+        elif kind == 4:
+            body = f.read(size)
+            vendor_length = struct.unpack("<I", body[:4])[0]
+            pos = 4 + vendor_length
+            count = struct.unpack("<I", body[pos:pos + 4])[0]
+            pos += 4
+            for _ in range(count):
+                length = struct.unpack("<I", body[pos:pos + 4])[0]
+                key, _, value = body[pos + 4:pos + 4 + length].decode("utf-8", "replace").partition("=")
+                info[key.upper()] = value
+                pos += 4 + length
+        else:
+            f.seek(size, os.SEEK_CUR)
+    if stream is None:
+        raise HeaderError("no STREAMINFO block")
+    # 20 bits sample rate, 3 bits channels - 1, 5 bits bits per sample - 1, 36 bits total samples
+    sample_rate, channels, bits = stream >> 44, (stream >> 41 & 0x7) + 1, (stream >> 36 & 0x1F) + 1
+    frames = stream & 0xFFFFFFFFF
+    if "COMMENT" in info:
+        info["ICMT"] = info.pop("COMMENT")
+    if "GUANO" in info:
+        info["guano"] = parse_guano(info.pop("GUANO"))
+    return {"format": "flac", "sample_rate": sample_rate, "channels": channels, "bits": bits,
+            "duration": frames / sample_rate if sample_rate else 0.0, "info": info}
+
+def read_header(path):
+    """Header of a WAV or FLAC file (see read_wav_header), whatever its extension."""
+    with open(path, "rb") as f:
+        magic = f.read(4)
+        f.seek(0)
+        if magic == b"fLaC":
+            return read_flac_header(f)
+        return read_wav_header(f, os.fstat(f.fileno()).st_size)
+
+def recording_start(path, header, mtime):
+    """
+    Start of a recording in epoch seconds and where it comes from: the GUANO Timestamp, the time in the AudioMoth
+    comment, the time in the name (local time) or the modification time minus the duration.
+    """
+    info = header["info"]
+    timestamp = info.get("guano", {}).get("Timestamp")
+    if timestamp:
+        try:
+            return datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp(), "guano"
+        except ValueError:
+            pass
+    match = AUDIOMOTH_COMMENT.search(info.get("ICMT", ""))
+    if match:
+        sign, hours, minutes = match.group(2), int(match.group(3) or 0), int(match.group(4) or 0)
+        tz = timezone((-1 if sign == "-" else 1) * timedelta(hours=hours, minutes=minutes))
+        return datetime.strptime(match.group(1), "%H:%M:%S %d/%m/%Y").replace(tzinfo=tz).timestamp(), "comment"
+    name = os.path.basename(path)
+    for pattern, fmt in CLIP_TIME_PATTERNS:
+        match = pattern.search(name)
+        if match:
+            return datetime.strptime(match.group(1), fmt).timestamp(), "name"
+    return mtime - header["duration"], "mtime"
+
+def recording_device(header):
+    """Device of a recording: Make Model Serial of GUANO, or the AudioMoth ID of the comment."""
+    guano = header["info"].get("guano", {})
+    device = " ".join(guano[k] for k in ("Make", "Model", "Serial") if guano.get(k))
+    if device:
+        return device
+    match = AUDIOMOTH_COMMENT.search(header["info"].get("ICMT", ""))
+    return match.group(5) if match else header["info"].get("IART")
+
+def recording_station(path):
+    """Station of a recording: the part of the name before its time (AM1 of AM1_20230512_083000.WAV), or the folder."""
+    name = os.path.basename(path)
+    for pattern, _ in CLIP_TIME_PATTERNS:
+        match = pattern.search(name)
+        if match and match.start() > 0:
+            return name[:match.start()].rstrip("_-. ")
+    return os.path.basename(os.path.dirname(path))
+
+class RecordingCatalogue:
+    """
+    SQLite catalogue of recordings, one row per file. The files whose header could not be read are kept with their
+    error in a table of their own, so that they are not read again until they change.
+    """
+
+    COLUMNS = ("path", "station", "start", "duration", "end", "sample_rate", "channels", "bits", "format", "device",
+               "start_source", "metadata", "size", "mtime", "indexed_at")
+
+    def __init__(self, path=DEFAULT_CATALOGUE):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60)
+        with self.conn:
+            self.conn.executescript("""
+                PRAGMA journal_mode = WAL;
+                CREATE TABLE IF NOT EXISTS recordings (
+                    path TEXT PRIMARY KEY, station TEXT, start REAL, duration REAL, end REAL, sample_rate INTEGER,
+                    channels INTEGER, bits INTEGER, format TEXT, device TEXT, start_source TEXT, metadata TEXT,
+                    size INTEGER, mtime REAL, indexed_at REAL
+                );
+                CREATE TABLE IF NOT EXISTS unreadable (
+                    path TEXT PRIMARY KEY, error TEXT, size INTEGER, mtime REAL
+                );
+                -- Covers the coverage queries (gaps, stations) without reading the rows
+                CREATE INDEX IF NOT EXISTS recordings_coverage ON recordings (station, start, end, duration);
+                -- Longest recording of a station, see recordings()
+                CREATE INDEX IF NOT EXISTS recordings_duration ON recordings (station, duration);
+            """)
+        self._insert = f"INSERT OR REPLACE INTO recordings VALUES ({', '.join('?' * len(self.COLUMNS))})"
+
+    @staticmethod
+    def _under(root):
+        """Range of the paths under a folder: path >= low AND path < high."""
+        prefix = os.path.join(root, "")
+        return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+    def _known(self, root):
+        """(size, mtime) of the files already catalogued under root, readable or not."""
+        rows = self.conn.execute("""
+            SELECT path, size, mtime FROM recordings WHERE path >= ?1 AND path < ?2
+            UNION ALL SELECT path, size, mtime FROM unreadable WHERE path >= ?1 AND path < ?2
+        """, self._under(root))
+        return {path: (size, mtime) for path, size, mtime in rows}
+
+    def _read(self, path, stat):
+        """Row of the recordings table of a file, or the row of the unreadable table."""
+        try:
+            header = read_header(path)
+        except (OSError, HeaderError, struct.error) as e:
+            return None, (path, str(e), stat.st_size, stat.st_mtime)
+        start, source = recording_start(path, header, stat.st_mtime)
+        return (path, recording_station(path), start, header["duration"], start + header["duration"],
+                header["sample_rate"], header["channels"], header["bits"], header["format"], recording_device(header),
+                source, json.dumps(header["info"]) if header["info"] else None, stat.st_size, stat.st_mtime,
+                time.time()), None
+
+    def _store(self, rows, errors):
+        with self.conn:
+            self.conn.executemany("DELETE FROM unreadable WHERE path = ?", [row[:1] for row in rows])
+            self.conn.executemany(self._insert, rows)
+            self.conn.executemany("DELETE FROM recordings WHERE path = ?", [row[:1] for row in errors])
+            self.conn.executemany("INSERT OR REPLACE INTO unreadable VALUES (?, ?, ?, ?)", errors)
+
+    def update(self, path, stat=None):
+        """Catalogue one file, unless it did not change. Returns True when its header was read."""
+        path = os.path.abspath(path)
+        stat = stat or os.stat(path)
+        known = self.conn.execute("""
+            SELECT size, mtime FROM recordings WHERE path = ?1 UNION ALL SELECT size, mtime FROM unreadable WHERE path = ?1
+        """, (path,)).fetchone()
+        if known == (stat.st_size, stat.st_mtime):
+            return False
+        row, error = self._read(path, stat)
+        self._store([row] if row else [], [error] if error else [])
+        return True
+
+    def remove(self, path):
+        """Remove a file, or every file under a folder, from the catalogue."""
+        path = os.path.abspath(path)
+        with self.conn:
+            for table in ("recordings", "unreadable"):
+                self.conn.execute(f"DELETE FROM {table} WHERE path = ? OR (path >= ? AND path < ?)", (path, *self._under(path)))
+
+    def scan(self, root, batch_size=1000):
+        """
+        Catalogue the new and changed recordings of a directory tree and remove the ones that are gone.
+
+        Returns:
+            dict: Files read, unchanged, removed and unreadable.
+        """
+        root = os.path.abspath(root)
+        known = self._known(root)
+        counts = {"read": 0, "unchanged": 0, "removed": 0, "errors": 0}
+        rows, errors = [], []
+
+        stack = [root]
+        while stack:
+            try:
+                entries = list(os.scandir(stack.pop()))
+            except OSError as e:
+                print(f"[WARN] {e}")
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(AUDIO_EXTENSIONS):
+                    stat = entry.stat()
+                    if known.pop(entry.path, None) == (stat.st_size, stat.st_mtime):
+                        counts["unchanged"] += 1
+                        continue
+                    row, error = self._read(entry.path, stat)
+                    (rows if row else errors).append(row or error)
+                    counts["read" if row else "errors"] += 1
+                    if len(rows) + len(errors) >= batch_size:
+                        self._store(rows, errors)
+                        rows, errors = [], []
+        self._store(rows, errors)
+        # What is left of the known files is gone
+        with self.conn:
+            for table in ("recordings", "unreadable"):
+                self.conn.executemany(f"DELETE FROM {table} WHERE path = ?", [(path,) for path in known])
+        counts["removed"] = len(known)
+        return counts
+
+    def recordings(self, station, start=None, end=None):
+        """Recordings of a station overlapping [start, end) (epoch seconds), in order."""
+        start = start if start is not None else float("-inf")
+        end = end if end is not None else float("inf")
+        # The recordings starting before start that reach into it are found from the longest duration
+        longest = self.conn.execute("SELECT MAX(duration) FROM recordings WHERE station = ?", (station,)).fetchone()[0] or 0
+        rows = self.conn.execute(f"""
+            SELECT {', '.join(self.COLUMNS)} FROM recordings
+            WHERE station = ? AND start >= ? AND start < ? AND end > ? ORDER BY start
+        """, (station, start - longest, end, start))
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+
+    def gaps(self, station, start=None, end=None, tolerance=1.0):
+        """
+        Gaps and overlaps of more than tolerance seconds between consecutive recordings of a station starting in
+        [start, end), as (kind, from, to) in epoch seconds: a gap from the end of the recordings before to the start
+        of the next one, an overlap from the start of a recording to the end of the recordings before.
+        """
+        rows = self.conn.execute("SELECT start, end FROM recordings WHERE station = ? AND start >= ? AND start < ? ORDER BY start",
+                                 (station, start if start is not None else float("-inf"),
+                                  end if end is not None else float("inf"))).fetchall()
+        if len(rows) < 2:
+            return []
+        starts, ends = np.array(rows).T
+        # Latest end of the recordings before each one, a long recording can cover several short ones
+        previous_end = np.maximum.accumulate(ends)[:-1]
+        starts = starts[1:]
+        found = np.flatnonzero(np.abs(starts - previous_end) > tolerance)
+        return [("gap", previous_end[i], starts[i]) if starts[i] > previous_end[i] else ("overlap", starts[i], previous_end[i])
+                for i in found]
+
+    def stations(self):
+        rows = self.conn.execute("""
+            SELECT station, COUNT(*), MIN(start), MAX(end), SUM(duration) FROM recordings GROUP BY station ORDER BY station
+        """)
+        return [dict(zip(("station", "recordings", "first", "last", "seconds"), row)) for row in rows]
+
+    def errors(self):
+        return self.conn.execute("SELECT path, error FROM unreadable ORDER BY path").fetchall()
+
+class Inotify:
+    """
+    Minimal inotify watch of a directory tree (Linux), through libc: events(timeout) yields (mask, path) of the
+    files written, moved or deleted. New folders are watched as they are created.
+    """
+
+    CLOSE_WRITE, MOVED_FROM, MOVED_TO, CREATE, DELETE, DELETE_SELF = 0x8, 0x40, 0x80, 0x100, 0x200, 0x400
+    Q_OVERFLOW, IGNORED, ISDIR = 0x4000, 0x8000, 0x40000000
+    MASK = CLOSE_WRITE | MOVED_FROM | MOVED_TO | CREATE | DELETE | DELETE_SELF
+
+    def __init__(self, root):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self.folders = {}
+        self.add_tree(root)
+
+    def add_tree(self, root):
+        for folder, _, _ in os.walk(root):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), self.MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch {folder} (see fs.inotify.max_user_watches)")
+            self.folders[wd] = folder
+
+    def events(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return
+        data = os.read(self.fd, 1 << 16)
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = struct.unpack_from("iIII", data, pos)
+            name = data[pos + 16:pos + 16 + length].split(b"\0")[0].decode()
+            pos += 16 + length
+            if mask & self.IGNORED:
+                self.folders.pop(wd, None)
+                continue
+            folder = self.folders.get(wd)
+            if mask & self.Q_OVERFLOW or folder is None:
+                yield mask, None
+                continue
+            path = os.path.join(folder, name)
+            if mask & self.ISDIR and mask & (self.CREATE | self.MOVED_TO):
+                self.add_tree(path)
+            yield mask, path
+
+def watch(catalogue, root, rescan=3600):
+    """Keep the catalogue of root up to date: inotify events as they come, and a full pass every rescan seconds."""
+    root = os.path.abspath(root)
+    try:
+        inotify = Inotify(root)
+    except (OSError, AttributeError) as e:
+        print(f"[WARN] No file system notifications ({e}), full pass every {rescan:g} s")
+        inotify = None
+    print(f"Indexed {root}: {catalogue.scan(root)}")
+    next_scan = time.time() + rescan
+    while True:
+        if inotify is None:
+            time.sleep(max(0.0, next_scan - time.time()))
+        else:
+            for mask, path in inotify.events(max(0.0, next_scan - time.time())):
+                if path is None:
+                    next_scan = 0  # events lost, a full pass catches up
+                elif mask & Inotify.ISDIR:
+                    if mask & (Inotify.CREATE | Inotify.MOVED_TO):
+                        print(f"Indexed {path}: {catalogue.scan(path)}")
+                    elif mask & (Inotify.DELETE | Inotify.MOVED_FROM):
+                        catalogue.remove(path)
+                elif path.lower().endswith(AUDIO_EXTENSIONS):
+                    if mask & (Inotify.DELETE | Inotify.MOVED_FROM):
+                        catalogue.remove(path)
+                        print(f"Removed {path}")
+                    elif mask & (Inotify.CLOSE_WRITE | Inotify.MOVED_TO) and os.path.exists(path):
+                        if catalogue.update(path):
+                            print(f"Indexed {path}")
+        if time.time() >= next_scan:
+            print(f"Indexed {root}: {catalogue.scan(root)}")
+            next_scan = time.time() + rescan
+
+def parse_time(value):
+    return datetime.fromisoformat(value).timestamp() if value else None
+
+def query_range(args):
+    """[start, end) of --day or --from/--to, in epoch seconds."""
+    if args.day:
+        day = datetime.strptime(args.day, "%Y-%m-%d")
+        return day.timestamp(), (day + timedelta(days=1)).timestamp()
+    return parse_time(args.start), parse_time(args.end)
+
+def format_time(t):
+    return datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S")
+
+def main():
+    args = parse_args()
+    catalogue = RecordingCatalogue(args.catalogue)
+
+    if args.command == "index":
+        t0 = time.perf_counter()
+        counts = catalogue.scan(args.root)
+        print(f"Indexed {args.root} in {time.perf_counter() - t0:.1f}s: {counts}")
+        for path, error in catalogue.errors():
+            print(f"[WARN] {path}: {error}")
+
+    elif args.command == "watch":
+        try:
+            watch(catalogue, args.root, args.rescan)
+        except KeyboardInterrupt:
+            print("\nStopped.")
+
+    elif args.command == "query":
+        t0 = time.perf_counter()
+        start, end = query_range(args)
+        rows = catalogue.recordings(args.station, start, end)
+        elapsed = time.perf_counter() - t0
+        for row in rows:
+            print(f"{format_time(row['start'])}  {row['duration']:8.2f}s  {row['sample_rate']:6d} Hz  {row['channels']} ch  "
+                  f"{row['bits']:2d} bit  {row['device'] or '-':28s}  {row['path']}")
+        seconds = sum(row["duration"] for row in rows)
+        print(f"{len(rows)} recordings, {seconds / 60:.1f} min recorded ({elapsed * 1000:.1f} ms)")
+
+    elif args.command == "gaps":
+        t0 = time.perf_counter()
+        start, end = query_range(args)
+        rows = catalogue.gaps(args.station, start, end, args.tolerance)
+        elapsed = time.perf_counter() - t0
+        for kind, begin, finish in rows:
+            print(f"{kind:7s}  {format_time(begin)} -> {format_time(finish)}  {finish - begin:10.1f}s")
+        print(f"{sum(k == 'gap' for k, _, _ in rows)} gaps, {sum(k == 'overlap' for k, _, _ in rows)} overlaps "
+              f"({elapsed * 1000:.1f} ms)")
+
+    elif args.command == "stations":
+        for row in catalogue.stations():
+            print(f"{row['station']:12s}  {row['recordings']:8d} recordings  {format_time(row['first'])} -> "
+                  f"{format_time(row['last'])}  {row['seconds'] / 3600:9.1f} h")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+This script reprocesses an archive of recordings with the Bird Song Detector, e.g. a whole season after a model update.
+
+Workflow:
+1. List the clips of a directory tree (.wav/.flac, any case) or of a manifest file with one path per line.
+2. Keep the clips of this shard: a clip belongs to shard crc32(path) % shard_count, so several machines can
+   split the same archive without talking to each other.
+3. Skip the clips already processed with the same model weights according to the results store (SQLite).
+4. Process the remaining clips with N worker processes, each with its own model and output folder.
+5. Save the detections and the acoustic indices of every clip in the results store and print the aggregate
+   throughput. The indices come from the STFT of the spectrograms, no second pass over the archive.
+6. With --segment-index, add the embedding of every detection to the k-NN index of the segments (see
+   segment_index.py).
+
+Examples:
+  python reprocess_archive.py --input /archive/2025 --workers 4
+  python reprocess_archive.py --manifest season.txt --shard-index 0 --shard-count 3 --workers 2 --segments
+  python reprocess_archive.py --input /archive/2025 --indices aci,ndsi
+  python reprocess_archive.py --input /archive/2025 --segment-index runs/segment_index
+"""
+
+# Import libraries
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import sqlite3
+import sys
+import time
+import zlib
+
+from acoustic_indices import INDEX_PARAMS, parse_indices
+from inference_service import MODEL_PATH
+from segment_index import SegmentIndex
+
+AUDIO_EXTENSIONS = (".wav", ".flac")
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Reprocess an archive of recordings in parallel, sharded across machines.")
+    source = p.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", help="Directory tree with the recordings")
+    source.add_argument("--manifest", help="Text file with one recording path per line")
+    p.add_argument("--output", default="runs/reprocess", help="Output folder (default: runs/reprocess)")
+    p.add_argument("--store", help="Results store (default: <output>/shard<i>of<n>/results.sqlite)")
+    p.add_argument("--model", default=MODEL_PATH, help="Model weights (env BIRD_MODEL)")
+    p.add_argument("--fusion", default=os.getenv("CHANNEL_FUSION", "max"), help="Channel fusion policy: max, union or snr")
+    p.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="Worker processes")
+    p.add_argument("--shard-index", type=int, default=0, help="Index of this machine's shard (default: 0)")
+    p.add_argument("--shard-count", type=int, default=1, help="Number of shards the archive is split into (default: 1)")
+    p.add_argument("--segments", action="store_true", help="Also save the audio segment of every detection")
+    p.add_argument("--indices", default=os.getenv("ACOUSTIC_INDICES", "aci,ndsi,bi,entropy"),
+                   help="Acoustic indices saved for every minute, comma separated, empty for none (env ACOUSTIC_INDICES)")
+    p.add_argument("--force", action="store_true", help="Reprocess clips already in the results store")
+    p.add_argument("--segment-index", default=os.getenv("SEGMENT_INDEX"),
+                   help="Also add the embedding of every detection to this segment index (env SEGMENT_INDEX)")
+    p.add_argument("--cache", default=os.getenv("SPECTROGRAM_CACHE"),
+                   help="Spectrogram/detection cache folder shared by the workers (env SPECTROGRAM_CACHE)")
+    p.add_argument("--cache-bytes", type=float, default=float(os.getenv("SPECTROGRAM_CACHE_BYTES", 2 * 1024**3)),
+                   help="Size budget of the cache in bytes (default: 2 GiB)")
+    p.add_argument("--report-every", type=int, default=20, help="Print the throughput every N clips (default: 20)")
+    args = p.parse_args()
+    if not 0 <= args.shard_index < args.shard_count:
+        p.error("--shard-index must be in [0, --shard-count)")
+    try:
+        args.indices = parse_indices(args.indices)
+    except ValueError as e:
+        p.error(str(e))
+    return args
+
+def list_clips(input_dir=None, manifest=None):
+    """
+    Clips to process, as paths relative to input_dir (or as written in the manifest) so that the shard of a clip
+    does not depend on where each machine mounts the archive.
+    """
+    if manifest:
+        with open(manifest) as f:
+            clips = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    else:
+        clips = []
+        for root, _, files in os.walk(input_dir):
+            for name in files:
+                if name.lower().endswith(AUDIO_EXTENSIONS):
+                    clips.append(os.path.relpath(os.path.join(root, name), input_dir))
+    return sorted(clips)
+
+def in_shard(clip, shard_index, shard_count):
+    return zlib.crc32(clip.encode()) % shard_count == shard_index
+
+def model_version(model_path):
+    """Short content hash of the weights, so that a model update reprocesses everything."""
+    digest = hashlib.sha256()
+    with open(model_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+class ResultsStore:
+    """
+    SQLite store with one row per processed clip, one row per detection and one row per acoustic index of every
+    channel and window (start second within the clip).
+    Only the parent process writes to it; workers send their results back through the pool.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS clips (
+                clip TEXT, model TEXT, status TEXT, error TEXT,
+                duration REAL, elapsed REAL, detections INTEGER, processed_at REAL,
+                PRIMARY KEY (clip, model)
+            );
+            CREATE TABLE IF NOT EXISTS detections (
+                clip TEXT, model TEXT, start REAL, end REAL, class INTEGER, score REAL, channel_scores TEXT
+            );
+            CREATE INDEX IF NOT EXISTS detections_clip ON detections (clip, model);
+            CREATE TABLE IF NOT EXISTS indices (
+                clip TEXT, model TEXT, channel INTEGER, start REAL, name TEXT, value REAL
+            );
+            CREATE INDEX IF NOT EXISTS indices_clip ON indices (clip, model);
+        """)
+
+    def processed(self, model):
+        rows = self.conn.execute("SELECT clip FROM clips WHERE model = ? AND status = 'ok'", (model,))
+        return {clip for clip, in rows}
+
+    def add(self, result, model):
+        with self.conn:
+            self.conn.execute("DELETE FROM detections WHERE clip = ? AND model = ?", (result["clip"], model))
+            self.conn.execute("DELETE FROM indices WHERE clip = ? AND model = ?", (result["clip"], model))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO clips VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (result["clip"], model, result["status"], result.get("error"), result.get("duration"),
+                 result["elapsed"], len(result.get("detections", [])), time.time()),
+            )
+            self.conn.executemany(
+                "INSERT INTO detections VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(result["clip"], model, row[0], row[1], int(row[2]), row[3], json.dumps(row[4:]))
+                 for row in result.get("detections", [])],
+            )
+            self.conn.executemany(
+                "INSERT INTO indices VALUES (?, ?, ?, ?, ?, ?)",
+                [(result["clip"], model, channel, window * INDEX_PARAMS["window"], name, value)
+                 for name, values in result.get("indices", {}).items()
+                 for channel, row in enumerate(values) for window, value in enumerate(row)],
+            )
+
+    def close(self):
+        self.conn.close()
+
+class Throughput:
+    """Aggregate throughput of all the workers of this run."""
+
+    def __init__(self, total):
+        self.total = total
+        self.clips = self.errors = self.detections = 0
+        self.audio_sec = 0.0
+        self.t0 = time.time()
+
+    def update(self, result):
+        self.clips += 1
+        self.errors += result["status"] != "ok"
+        self.detections += len(result.get("detections", []))
+        self.audio_sec += result.get("duration") or 0.0
+
+    def __str__(self):
+        elapsed = max(time.time() - self.t0, 1e-9)
+        rate = self.clips / elapsed
+        eta = (self.total - self.clips) / rate if rate else float("inf")
+        return (f"[{self.clips}/{self.total}] {rate:.2f} clips/s, {self.audio_sec / elapsed:.1f}x real time, "
+                f"{self.detections} detections, {self.errors} errors, elapsed {elapsed:.0f}s, ETA {eta:.0f}s")
+
+# Per-worker state, set by _init_worker in every worker process
+_worker = {}
+
+def _init_worker(model_path, input_dir, namespace, fusion, segments, cache_dir, cache_bytes, indices, embed):
+    from ultralytics import YOLO
+    from segment_index import SegmentEmbedder
+    from spectrogram_cache import SpectrogramCache
+
+    # Each worker writes its images and segments to its own folder
+    output_dir = os.path.join(namespace, f"worker{os.getpid()}")
+    model = YOLO(model_path)
+    _worker.update(
+        model=model,
+        embedder=SegmentEmbedder(model) if embed else None,
+        input_dir=input_dir,
+        images_dir=os.path.join(output_dir, "Images"),
+        segments_dir=os.path.join(output_dir, "Segments"),
+        fusion=fusion,
+        segments=segments,
+        indices=indices,
+        cache=SpectrogramCache(cache_dir, max_bytes=int(cache_bytes)) if cache_dir else None,
+    )
+
+def _process_clip(clip):
+    from audio_processing import detect_channels, transform_predictions_save_segment
+
+    audio_path = os.path.join(_worker["input_dir"], clip) if _worker["input_dir"] else clip
+    t0 = time.time()
+    try:
+        detections = detect_channels(_worker["model"], audio_path, fusion=_worker["fusion"], output_dir=_worker["images_dir"],
+                                     cache=_worker["cache"], indices=_worker["indices"])
+        if _worker["segments"] and len(detections):
+            transform_predictions_save_segment(audio_path, detections, output_dir=_worker["segments_dir"])
+        result = {"clip": clip, "status": "ok", "duration": detections.duration, "elapsed": time.time() - t0,
+                  "detections": detections.to_array().tolist(),
+                  "indices": {name: values.tolist() for name, values in detections.indices.items()}}
+        if _worker["embedder"] and len(detections):
+            result["embeddings"], result["segment_keys"] = _worker["embedder"].embed_detections(audio_path, detections)
+        return result
+    except Exception as e:
+        return {"clip": clip, "status": "error", "error": repr(e), "elapsed": time.time() - t0}
+    finally:
+        # Spectrograms are only an intermediate step, do not let them pile up over a season
+        for image in glob.glob(os.path.join(_worker["images_dir"], "*.PNG")):
+            os.remove(image)
+
+def main():
+    args = parse_args()
+
+    namespace = os.path.join(args.output, f"shard{args.shard_index}of{args.shard_count}")
+    store = ResultsStore(args.store or os.path.join(namespace, "results.sqlite"))
+    version = model_version(args.model)
+
+    clips = [clip for clip in list_clips(args.input, args.manifest) if in_shard(clip, args.shard_index, args.shard_count)]
+    done = set() if args.force else store.processed(version)
+    todo = [clip for clip in clips if clip not in done]
+    print(f"Shard {args.shard_index}/{args.shard_count}: {len(clips)} clips, {len(clips) - len(todo)} already processed "
+          f"with model {version}, {len(todo)} to go on {args.workers} workers")
+    if not todo:
+        return
+
+    meter = Throughput(len(todo))
+    ctx = mp.get_context("spawn")  # torch does not survive fork() reliably
+    initargs = (args.model, args.input, namespace, args.fusion, args.segments, args.cache, args.cache_bytes, args.indices,
+                bool(args.segment_index))
+    # Written by this process only, like the results store
+    segment_index = SegmentIndex(args.segment_index) if args.segment_index else None
+    try:
+        with ctx.Pool(max(1, args.workers), initializer=_init_worker, initargs=initargs) as pool:
+            for result in pool.imap_unordered(_process_clip, todo):
+                store.add(result, version)
+                if segment_index is not None and "embeddings" in result:
+                    segment_index.add(result["embeddings"], result["segment_keys"])
+                meter.update(result)
+                if result["status"] != "ok":
+                    print(f"[ERR] {result['clip']}: {result['error']}", file=sys.stderr)
+                if meter.clips % args.report_every == 0:
+                    print(meter)
+    except KeyboardInterrupt:
+        print("\nInterrupted, processed clips are kept in the results store.", file=sys.stderr)
+    finally:
+        store.close()
+        if segment_index is not None:
+            segment_index.close()
+
+    print(f"\nDone. {meter}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+On-demand sampling profiler of the pipeline, to find where the time of a slow station goes without redeploying.
+
+Installed by the entry points (install()), it does nothing until it is asked to profile the next clips, by SIGUSR2
+(PROFILE_CLIPS clips) or by writing a number of clips to the request file of its folder:
+
+    kill -USR2 <pid of predict_on_audio.py>
+    echo 5 > /opt/bird-files/record/metrics/profiles/request
+
+From the next clip on (metrics.set_clip()), a thread samples the stack of the thread processing the clip every
+PROFILE_INTERVAL seconds, under the pipeline stages it is in (metrics.trace()). Every clip is written to
+<folder>/<clip>.folded in the collapsed-stack format read by flamegraph.pl, inferno and speedscope:
+
+    stage:clip;stage:extraction;stage:render;main (predict_on_audio.py:296);...;savefig (figure.py:3303) 42
+
+Samples taken outside any stage (waiting for the recorder) are dropped. Time spent in native code (numpy, torch, a
+subprocess waited on) is counted in the Python function that called it. While no profile is asked for, the cost is
+one stat() of the request file per clip and a list append per stage.
+
+Examples:
+  flamegraph.pl profiles/AM1_20230511_060000.folded > AM1_20230511_060000.svg
+  python sampling_profiler.py profiles/*.folded --top 15
+"""
+
+# Import libraries
+import argparse
+import collections
+import os
+import signal
+import sys
+import threading
+import time
+
+import metrics
+
+# Clips profiled on SIGUSR2 or an empty request file, and seconds between two samples
+PROFILE_CLIPS = int(os.getenv("PROFILE_CLIPS", "5"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+# The last clip of a profile is written once its thread has been out of any stage for that long
+IDLE_SECONDS = 1.0
+
+class SamplingProfiler:
+    """
+    Stack sampler driven by the clips and stages of metrics: set_clip() calls clip(), trace() calls push() and pop().
+
+    Args:
+        output_dir (str): Folder of the <clip>.folded files and of the request file, checked at every clip and
+            holding the number of clips to profile.
+        interval (float): Seconds between two samples.
+        clips (int): Clips profiled by request() without a number (SIGUSR2, empty request file).
+    """
+
+    def __init__(self, output_dir, interval=PROFILE_INTERVAL, clips=PROFILE_CLIPS):
+        self.output_dir = output_dir
+        self.request_path = os.path.join(output_dir, "request")
+        self.interval = interval
+        self.default_clips = clips
+        self.stages = {}  # thread id -> stages it is in, innermost last
+        self.request_mtime = None  # of the request file last read
+        self.requested = 0  # clips asked for, from the next clip on
+        self.remaining = 0
+        self.thread_id = None  # thread of the clip being profiled
+        self.current = None
+        self.samples = collections.Counter()
+        self.sampler = None
+        self.lock = threading.Lock()
+
+    def request(self, clips=None):
+        """Profile the next clips. Only sets an attribute, so it is safe in a signal handler."""
+        self.requested = clips or self.default_clips
+
+    def push(self, stage):
+        self.stages.setdefault(threading.get_ident(), []).append(stage)
+
+    def pop(self):
+        stack = self.stages.get(threading.get_ident())
+        if stack:
+            stack.pop()
+
+    def clip(self, name):
+        """A thread starts a clip: write the previous one, and profile this one if asked for."""
+        self._check_request()
+        if not (self.requested or self.remaining or self.thread_id):
+            return
+        with self.lock:
+            if self.thread_id == threading.get_ident() and name == self.current:
+                return  # another part of the same clip, e.g. the batches of the detector daemon
+            self._flush()
+            if self.requested:
+                self.remaining, self.requested = self.requested, 0
+                print(f"[PROFILE] Profiling the next {self.remaining} clips to {self.output_dir}")
+            if not self.remaining:
+                self.thread_id = self.current = None
+                return
+            self.remaining -= 1
+            self.thread_id, self.current = threading.get_ident(), name
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self._sample, name="sampling-profiler", daemon=True)
+                self.sampler.start()
+
+    def _check_request(self):
+        try:
+            mtime = os.stat(self.request_path).st_mtime
+        except OSError:
+            return
+        if mtime == self.request_mtime:
+            return  # already read, and could not be removed
+        self.request_mtime = mtime
+        try:
+            with open(self.request_path) as f:
+                text = f.read().strip()
+        except OSError:
+            return
+        try:
+            os.remove(self.request_path)
+        except OSError:
+            pass
+        self.request(int(text) if text.isdigit() else None)
+
+    def _sample(self):
+        idle_since = None
+        while True:
+            time.sleep(self.interval)
+            thread_id = self.thread_id
+            stages = tuple(self.stages.get(thread_id) or ())
+            if not stages:
+                # Between two stages, or done with the last clip of the profile
+                idle_since = idle_since or time.monotonic()
+                if time.monotonic() - idle_since < IDLE_SECONDS or self.remaining or self.requested:
+                    continue
+            idle_since = None
+            frame = sys._current_frames().get(thread_id)
+            with self.lock:
+                if self.thread_id is None:
+                    self.sampler = None
+                    return
+                if thread_id != self.thread_id:
+                    continue  # a clip of another thread started meanwhile
+                if not stages:
+                    self._flush()
+                    self.thread_id = self.current = None
+                    self.sampler = None
+                    return
+                if frame is not None:
+                    self.samples[";".join([f"stage:{stage}" for stage in stages] + frame_names(frame))] += 1
+
+    def _flush(self):
+        """Write the samples of the current clip (lock held)."""
+        if not self.samples:
+            return
+        os.makedirs(self.output_dir, exist_ok=True)
+        # The clips of a batch of the detector daemon are joined with +
+        name = "+".join(os.path.splitext(clip)[0] for clip in os.path.basename(str(self.current or "clip")).split("+"))
+        path = os.path.join(self.output_dir, f"{name}.folded")
+        with open(path, "w") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in sorted(self.samples.items()))
+        print(f"[PROFILE] {sum(self.samples.values())} samples of {self.current} in {path}")
+        self.samples.clear()
+
+def frame_names(frame):
+    """Functions of a stack, outermost first, as function (file:first line)."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return names[::-1]
+
+def install(output_dir, interval=PROFILE_INTERVAL, clips=PROFILE_CLIPS):
+    """Hook a SamplingProfiler into metrics, asked for the next clips by SIGUSR2 or <output_dir>/request."""
+    os.makedirs(output_dir, exist_ok=True)
+    profiler = SamplingProfiler(output_dir, interval, clips)
+    if hasattr(signal, "SIGUSR2") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.request())
+    metrics.profiler = profiler
+    return profiler
+
+def summary(paths, top=20):
+    """Samples of every stage, and the functions the most samples were taken in, over .folded files."""
+    stages, functions = collections.Counter(), collections.Counter()
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                stack, _, count = line.rstrip().rpartition(" ")
+                frames = stack.split(";")
+                tags = [frame[6:] for frame in frames if frame.startswith("stage:")]
+                stages["/".join(tags)] += int(count)
+                functions[frames[-1]] += int(count)
+    total = sum(stages.values()) or 1
+    print(f"{'samples':>8} {'share':>6}  stage")
+    for stage, count in stages.most_common():
+        print(f"{count:>8} {count / total:>6.1%}  {stage}")
+    print(f"\n{'samples':>8} {'share':>6}  function (self)")
+    for function, count in functions.most_common(top):
+        print(f"{count:>8} {count / total:>6.1%}  {function}")
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Summary of the profiles written by the sampling profiler.")
+    p.add_argument("profiles", nargs="+", help="<clip>.folded files")
+    p.add_argument("--top", type=int, default=20, help="Functions listed (default: 20)")
+    return p.parse_args()
+
+def main():
+    args = parse_args()
+    summary(args.profiles, args.top)
+
+if __name__ == "__main__":
+    main()
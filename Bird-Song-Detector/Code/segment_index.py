@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""
+Find the songs most similar to a given one across the archive of detected segments, for annotation triage and to
+group unknown calls.
+
+Every segment (the audio of a detection, see audio_processing.transform_predictions_save_segment) gets a compact
+embedding from the backbone of the detector: the spectrogram of a fixed --seconds window centred on the segment,
+rendered like the detector input, and the output of the SPPF layer averaged over the image (256 values for the
+nano model). The embeddings are kept in memory-mapped shards and in an IVF index: k-means lists of the centred and
+normalised embeddings, appended to on every insert, of which a query only scans the --nprobe lists closest to it.
+
+Layout of an index folder:
+- segments.sqlite: one row per segment (key = name of the segment file, clip, start, end, score, IVF list)
+- shards/<n>.f16: raw embeddings as float16, SHARD_ROWS rows per file, the row of a segment is its id
+- quantizer.npz: mean and centroids of the IVF lists, once the index is trained
+- lists/<k>.f16 and lists/<k>.ids: the centred and normalised embeddings of list k and their ids
+
+Until min_train segments are indexed a query compares all of them. The lists are trained then, and trained again
+every time the index has grown regrow times since.
+
+Examples:
+  python segment_index.py add ../Segments
+  python segment_index.py search ../Segments/AM1_20230510_073000_12.34_14.02_0.81.WAV -k 20
+  python segment_index.py search --id 1234 -k 20 --nprobe 32
+  python segment_index.py train --nlist 4096
+  python reprocess_archive.py --input /archive/2025 --segment-index runs/segment_index
+"""
+
+# Import libraries
+import argparse
+import os
+import re
+import shutil
+import sqlite3
+import time
+
+import numpy as np
+
+DEFAULT_INDEX = os.getenv("SEGMENT_INDEX", "runs/segment_index")
+AUDIO_EXTENSIONS = (".wav", ".flac")
+
+# Rows of float16 embeddings per shard file
+SHARD_ROWS = 1 << 16
+
+# <clip>_<start>_<end>_<score>.<ext>, the names of transform_predictions_save_segment
+SEGMENT_PATTERN = re.compile(r"^(?P<clip>.+)_(?P<start>\d+\.\d{2})_(?P<end>\d+\.\d{2})_(?P<score>\d+\.\d{2})\.\w+$")
+
+def segment_key(audio_path, start, end, score):
+    """Name of the segment file of a detection, the key of the segment in the index."""
+    from audio_processing import segment_path
+    return os.path.basename(segment_path(audio_path, start, end, score))
+
+def segment_row(key):
+    """(key, clip, start, end, score) of a segment from the name of its file, only the key for other names."""
+    match = SEGMENT_PATTERN.match(key)
+    if not match:
+        return key, os.path.splitext(key)[0], None, None, None
+    return key, match["clip"], float(match["start"]), float(match["end"]), float(match["score"])
+
+class SegmentEmbedder:
+    """
+    Embeddings of segments from the backbone of the detector (a local ultralytics YOLO model).
+
+    Every segment is cut or zero padded to a window of seconds around its centre so that all the spectrograms
+    have the same time scale, the STFT of a batch is computed in one call and the images are rendered with one
+    figure (audio_processing.SpectrogramRenderer).
+    """
+
+    def __init__(self, model, layer=9, seconds=3.0, batch=32):
+        from audio_processing import SPECTROGRAM_PARAMS, SpectrogramRenderer
+
+        self.model = model
+        self.layer = layer
+        self.params = SPECTROGRAM_PARAMS
+        self.samples = int(seconds * self.params["sr"])
+        self.batch = batch
+        self.renderer = SpectrogramRenderer(self.params["sr"])
+
+    def embed(self, segments):
+        """
+        Embeddings of audio segments (1-D arrays at SPECTROGRAM_PARAMS["sr"]), shape (n, dim) float32 of unit
+        length (the scale of the activations depends on the weights, float16 shards need it bounded).
+        """
+        import librosa
+
+        out = []
+        for i in range(0, len(segments), self.batch):
+            windows = np.zeros((len(segments[i:i + self.batch]), self.samples), dtype=np.float32)
+            for row, y in zip(windows, segments[i:i + self.batch]):
+                y = y[max(0, (len(y) - self.samples) // 2):][:self.samples]
+                offset = (self.samples - len(y)) // 2
+                row[offset:offset + len(y)] = y
+            S = np.abs(librosa.stft(windows, n_fft=self.params["n_fft"], hop_length=self.params["hop_length"]))
+            # Every segment normalised to its own maximum, like the spectrograms of the detector
+            D = librosa.amplitude_to_db(S / np.maximum(S.max(axis=(-2, -1), keepdims=True), 1e-10), ref=1.0)
+            images = [self.renderer.render(d) for d in D]
+            embeddings = self.model.embed(images, embed=[self.layer], verbose=False)
+            X = np.stack([e.cpu().numpy() for e in embeddings]).astype(np.float32)
+            out.append(X / np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-30))
+        return np.concatenate(out) if out else np.zeros((0, 0), dtype=np.float32)
+
+    def embed_files(self, paths):
+        """Embeddings of segment files."""
+        from audio_processing import load_audio
+
+        return self.embed([load_audio(path, sr=self.params["sr"])[0] for path in paths])
+
+    def embed_detections(self, audio_path, detections):
+        """
+        Embeddings of the detections of a recording, cut from the recording instead of from the segment files, and
+        the keys of the segments (the names transform_predictions_save_segment gives them).
+        """
+        from audio_processing import load_audio
+
+        y, sr = load_audio(audio_path, sr=self.params["sr"])
+        segments = [y[int(start * sr):int(end * sr)] for start, end, _, _ in detections]
+        keys = [segment_key(audio_path, start, end, score) for start, end, _, score in detections]
+        return self.embed(segments), keys
+
+def spherical_kmeans(X, nlist, iterations=10, seed=0):
+    """Centroids (nlist, dim) of unit vectors X by cosine similarity, each a unit vector."""
+    rng = np.random.default_rng(seed)
+    centroids = X[rng.choice(len(X), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = nearest(X, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, X)
+        empty = ~sums.any(axis=1)
+        sums[empty] = X[rng.choice(len(X), int(empty.sum()), replace=False)]
+        centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+    return centroids
+
+def nearest(X, centroids, chunk=16384):
+    """Index of the most similar centroid of every row of X."""
+    return np.concatenate([np.argmax(X[i:i + chunk] @ centroids.T, axis=1) for i in range(0, len(X), chunk)])
+
+class SegmentIndex:
+    """
+    Embeddings of segments in memory-mapped shards with an IVF index for k-NN queries by cosine similarity.
+    One process writes to an index at a time, any number can query it.
+    """
+
+    def __init__(self, path, min_train=10000, regrow=8):
+        self.path = path
+        self.min_train = min_train
+        self.regrow = regrow
+        os.makedirs(os.path.join(path, "shards"), exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(path, "segments.sqlite"))
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS segments (
+                id INTEGER PRIMARY KEY, key TEXT UNIQUE, clip TEXT, start REAL, end REAL, score REAL, list INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS segments_clip ON segments (clip);
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value);
+        """)
+        self.dim = self._meta("dim")
+        self._shards = {}
+        self._lists = {}
+        self._load_quantizer()
+        self._recover()
+
+    def _meta(self, name, value=None):
+        if value is not None:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (name, value))
+            return value
+        row = self.conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def _load_quantizer(self):
+        try:
+            with np.load(os.path.join(self.path, "quantizer.npz")) as npz:
+                self.mean, self.centroids = npz["mean"], npz["centroids"]
+        except OSError:
+            self.mean = self.centroids = None
+
+    def _recover(self):
+        """Drop the list rows of an insert interrupted before its segments were committed."""
+        count = len(self)
+        if self.centroids is None:
+            return
+        for k in range(len(self.centroids)):
+            ids = self._list_ids(k)
+            if len(ids) and ids[-1] >= count:
+                keep = int(np.searchsorted(ids, count))
+                for ext, size in ((".ids", 8), (".f16", 2 * self.dim)):
+                    with open(self._list_path(k, ext), "r+b") as f:
+                        f.truncate(keep * size)
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM segments").fetchone()[0]
+
+    def missing(self, keys):
+        """The keys that are not in the index yet."""
+        known = set()
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self.conn.execute(f"SELECT key FROM segments WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            known.update(key for key, in rows)
+        return [key for key in keys if key not in known]
+
+    def _shard(self, shard, write=False):
+        """Memory map of a shard, created (sparse) by the first write to it."""
+        path = os.path.join(self.path, "shards", f"{shard:06d}.f16")
+        shard_map = self._shards.get(shard)
+        if shard_map is None or (write and shard_map.mode == "r"):
+            mode = ("r+" if os.path.exists(path) else "w+") if write else "r"
+            shard_map = self._shards[shard] = np.memmap(path, dtype=np.float16, mode=mode, shape=(SHARD_ROWS, self.dim))
+        return shard_map
+
+    def vectors(self, ids):
+        """Raw embeddings of segments, shape (n, dim) float32."""
+        ids = np.asarray(ids, dtype=np.int64)
+        out = np.empty((len(ids), self.dim), dtype=np.float32)
+        for shard in np.unique(ids // SHARD_ROWS):
+            rows = ids // SHARD_ROWS == shard
+            out[rows] = self._shard(int(shard))[ids[rows] % SHARD_ROWS]
+        return out
+
+    def _all_vectors(self):
+        """Raw embeddings of every segment, shard by shard: (first id, (n, dim) float32)."""
+        count = len(self)
+        for first in range(0, count, SHARD_ROWS):
+            yield first, np.asarray(self._shard(first // SHARD_ROWS)[:min(SHARD_ROWS, count - first)], dtype=np.float32)
+
+    def normalise(self, X, mean=None):
+        """Centred on the mean of the trained index (or on mean) and scaled to unit length."""
+        X = np.atleast_2d(X) - (self.mean if mean is None else mean)
+        return X / np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-12)
+
+    def _list_path(self, k, ext):
+        return os.path.join(self.path, "lists", f"{k:06d}{ext}")
+
+    def _list_ids(self, k):
+        path = self._list_path(k, ".ids")
+        return np.fromfile(path, dtype=np.int64) if os.path.exists(path) else np.zeros(0, dtype=np.int64)
+
+    def _list(self, k):
+        """ids and normalised embeddings of list k, memory-mapped again when the list has grown."""
+        path = self._list_path(k, ".ids")
+        size = os.path.getsize(path) // 8 if os.path.exists(path) else 0
+        if k not in self._lists or self._lists[k][0] != size:
+            if size:
+                self._lists[k] = (size, np.memmap(path, dtype=np.int64, mode="r", shape=(size,)),
+                                  np.memmap(self._list_path(k, ".f16"), dtype=np.float16, mode="r", shape=(size, self.dim)))
+            else:
+                self._lists[k] = (0, np.zeros(0, dtype=np.int64), np.zeros((0, self.dim), dtype=np.float16))
+        return self._lists[k][1:]
+
+    def _append_lists(self, ids, X, assign, folder="lists"):
+        os.makedirs(os.path.join(self.path, folder), exist_ok=True)
+        order = np.argsort(assign, kind="stable")
+        bounds = np.flatnonzero(np.diff(assign[order])) + 1
+        for rows in np.split(order, bounds):
+            k = int(assign[rows[0]])
+            with open(os.path.join(self.path, folder, f"{k:06d}.f16"), "ab") as f:
+                f.write(X[rows].astype(np.float16).tobytes())
+            with open(os.path.join(self.path, folder, f"{k:06d}.ids"), "ab") as f:
+                f.write(ids[rows].astype(np.int64).tobytes())
+
+    def add(self, vectors, keys):
+        """
+        Add the embeddings of segments (one key each, see segment_row). Segments already in the index are skipped.
+
+        Returns:
+            int: Number of segments added.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        new = set(self.missing(list(keys)))
+        rows = [i for i, key in enumerate(keys) if key in new]
+        if not rows:
+            return 0
+        vectors, keys = vectors[rows], [keys[i] for i in rows]
+        if self.dim is None:
+            self.dim = int(self._meta("dim", vectors.shape[1]))
+
+        first = len(self)
+        ids = np.arange(first, first + len(keys))
+        for shard in np.unique(ids // SHARD_ROWS):
+            rows = ids // SHARD_ROWS == shard
+            shard_map = self._shard(int(shard), write=True)
+            shard_map[ids[rows] % SHARD_ROWS] = vectors[rows]
+            shard_map.flush()
+
+        assign = np.full(len(ids), -1)
+        if self.centroids is not None:
+            X = self.normalise(vectors)
+            assign = nearest(X, self.centroids)
+            self._append_lists(ids, X, assign)
+        with self.conn:
+            self.conn.executemany("INSERT INTO segments VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  [(int(i), *segment_row(key), int(k)) for i, key, k in zip(ids, keys, assign)])
+
+        count = len(self)
+        if count >= max(self.min_train, self.regrow * (self._meta("trained") or 0)):
+            self.train()
+        return len(keys)
+
+    def train(self, nlist=None, sample=64):
+        """
+        Train the IVF lists (spherical k-means on up to sample points per list) and rebuild them from the shards.
+        nlist defaults to 4 * sqrt(number of segments).
+        """
+        count = len(self)
+        nlist = min(count, nlist or max(1, int(4 * np.sqrt(count))))
+        t0 = time.time()
+        mean = sum(X.sum(axis=0) for _, X in self._all_vectors()) / count
+        rng = np.random.default_rng(0)
+        ids = np.sort(rng.choice(count, min(count, sample * nlist), replace=False))
+        centroids = spherical_kmeans(self.normalise(self.vectors(ids), mean), nlist)
+
+        # The new lists are built next to the old ones, which queries keep using until the swap
+        shutil.rmtree(os.path.join(self.path, "lists.new"), ignore_errors=True)
+        lists = []
+        for first, X in self._all_vectors():
+            X = self.normalise(X, mean)
+            assign = nearest(X, centroids)
+            self._append_lists(np.arange(first, first + len(X)), X, assign, folder="lists.new")
+            lists.append(assign)
+        np.savez(os.path.join(self.path, "quantizer.new.npz"), mean=mean, centroids=centroids)
+        if os.path.exists(os.path.join(self.path, "lists")):
+            os.replace(os.path.join(self.path, "lists"), os.path.join(self.path, "lists.old"))
+        os.replace(os.path.join(self.path, "lists.new"), os.path.join(self.path, "lists"))
+        os.replace(os.path.join(self.path, "quantizer.new.npz"), os.path.join(self.path, "quantizer.npz"))
+        shutil.rmtree(os.path.join(self.path, "lists.old"), ignore_errors=True)
+        self.mean, self.centroids = mean, centroids
+        self._lists = {}
+
+        assign = np.concatenate(lists)
+        with self.conn:
+            self.conn.executemany("UPDATE segments SET list = ? WHERE id = ?", zip(assign.tolist(), range(count)))
+            self._meta("trained", count)
+        print(f"Trained {nlist} lists on {len(ids)} of {count} segments in {time.time() - t0:.1f}s")
+
+    def search(self, vector, k=10, nprobe=16):
+        """
+        The k segments most similar to an embedding.
+
+        Returns:
+            ids (np.ndarray): Ids of the segments, the most similar first.
+            similarity (np.ndarray): Cosine similarity of each (centred embeddings).
+        """
+        if self.centroids is None:
+            # Few segments: all of them, centred on their mean
+            ids = np.arange(len(self))
+            X = self.vectors(ids)
+            mean = X.mean(axis=0) if len(X) else 0
+            similarity = self.normalise(X, mean) @ self.normalise(vector, mean)[0]
+        else:
+            q = self.normalise(vector)[0]
+            probes = np.argsort(self.centroids @ q)[::-1][:nprobe]
+            found = [self._list(int(p)) for p in probes]
+            ids = np.concatenate([list_ids for list_ids, _ in found])
+            similarity = np.concatenate([np.asarray(X, dtype=np.float32) @ q for _, X in found])
+        top = np.argsort(similarity)[::-1][:k] if len(similarity) <= k else np.argpartition(similarity, -k)[-k:]
+        top = top[np.argsort(similarity[top])[::-1]]
+        return ids[top], similarity[top]
+
+    def rows(self, ids):
+        """key, clip, start, end and score of segments, in the order of ids."""
+        found = {}
+        for i in range(0, len(ids), 500):
+            chunk = [int(j) for j in ids[i:i + 500]]
+            query = f"SELECT id, key, clip, start, end, score FROM segments WHERE id IN ({','.join('?' * len(chunk))})"
+            found.update((row[0], row[1:]) for row in self.conn.execute(query, chunk))
+        return [found[int(i)] for i in ids]
+
+    def stats(self):
+        """Number of segments, of lists and the size of the largest list."""
+        sizes = self.conn.execute("SELECT COUNT(*) FROM segments WHERE list >= 0 GROUP BY list").fetchall()
+        return {"segments": len(self), "lists": 0 if self.centroids is None else len(self.centroids),
+                "largest list": max((n for n, in sizes), default=0), "trained on": self._meta("trained") or 0}
+
+    def close(self):
+        self.conn.close()
+
+def load_embedder(args):
+    from ultralytics import YOLO
+
+    model = YOLO(args.model)
+    if args.device:
+        model.to(args.device)
+    return SegmentEmbedder(model, layer=args.layer, seconds=args.seconds)
+
+def parse_args():
+    from inference_service import MODEL_PATH
+
+    p = argparse.ArgumentParser(description="Embeddings of detected segments and k-NN search over them.")
+    p.add_argument("--index", default=DEFAULT_INDEX, help="Index folder (env SEGMENT_INDEX, default: runs/segment_index)")
+    p.add_argument("--model", default=MODEL_PATH, help="Detector weights (env BIRD_MODEL)")
+    p.add_argument("--device", help="Device of the model, e.g. cpu or 0")
+    p.add_argument("--layer", type=int, default=9, help="Layer of the model the embeddings are taken from (default: 9, SPPF)")
+    p.add_argument("--seconds", type=float, default=3.0, help="Window around every segment (default: 3 s)")
+    sub = p.add_subparsers(dest="command", required=True)
+
+    add = sub.add_parser("add", help="Index the segment files of a folder tree, the ones already indexed are skipped")
+    add.add_argument("folder")
+    add.add_argument("--batch", type=int, default=256, help="Files read per batch (default: 256)")
+
+    search = sub.add_parser("search", help="Segments most similar to a segment file or to an indexed segment")
+    search.add_argument("query", nargs="?", help="Segment file")
+    search.add_argument("--id", type=int, help="Id of an indexed segment instead of a file")
+    search.add_argument("-k", type=int, default=10, help="Number of neighbours (default: 10)")
+    search.add_argument("--nprobe", type=int, default=16, help="Lists scanned (default: 16)")
+
+    train = sub.add_parser("train", help="Train the IVF lists again")
+    train.add_argument("--nlist", type=int, help="Number of lists (default: 4 * sqrt(segments))")
+
+    sub.add_parser("stats", help="Size of the index")
+    args = p.parse_args()
+    if args.command == "search" and (args.query is None) == (args.id is None):
+        p.error("search needs either a segment file or --id")
+    return args
+
+def main():
+    args = parse_args()
+    index = SegmentIndex(args.index)
+
+    if args.command == "add":
+        paths = sorted(os.path.join(root, name) for root, _, files in os.walk(args.folder)
+                       for name in files if name.lower().endswith(AUDIO_EXTENSIONS))
+        embedder, added, t0 = None, 0, time.time()
+        for i in range(0, len(paths), args.batch):
+            batch = {os.path.basename(path): path for path in paths[i:i + args.batch]}
+            keys = index.missing(list(batch))
+            if keys:
+                embedder = embedder or load_embedder(args)
+                added += index.add(embedder.embed_files([batch[key] for key in keys]), keys)
+            print(f"[{min(i + args.batch, len(paths))}/{len(paths)}] {added} segments added "
+                  f"({added / max(time.time() - t0, 1e-9):.1f}/s), {len(index)} in the index")
+
+    elif args.command == "search":
+        vector = index.vectors([args.id]) if args.id is not None else load_embedder(args).embed_files([args.query])
+        t0 = time.perf_counter()
+        ids, similarity = index.search(vector[0], k=args.k, nprobe=args.nprobe)
+        elapsed = (time.perf_counter() - t0) * 1000
+        for rank, (i, sim, row) in enumerate(zip(ids, similarity, index.rows(ids)), 1):
+            key, clip, start, end, score = row
+            times = f"{start:.2f}-{end:.2f}s score {score:.2f}" if start is not None else ""
+            print(f"{rank:3d}. {sim:.3f} #{i} {key} {times}")
+        print(f"{len(ids)} neighbours among {len(index)} segments in {elapsed:.1f} ms")
+
+    elif args.command == "train":
+        index.train(args.nlist)
+
+    else:
+        for name, value in index.stats().items():
+            print(f"{name}: {value}")
+    index.close()
+
+if __name__ == "__main__":
+    main()
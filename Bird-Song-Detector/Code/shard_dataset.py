@@ -0,0 +1,79 @@
+# Import libraries
+import math
+
+import cv2
+import numpy as np
+from ultralytics.data.dataset import YOLODataset
+from ultralytics.models.yolo.detect import DetectionTrainer
+from ultralytics.utils import colorstr
+
+from spectrogram_shards import ShardReader
+
+class ShardDataset(YOLODataset):
+    """
+    YOLO dataset of a split written by spectrogram_shards.ShardWriter: every image is copied out of its memory-mapped
+    shard, no file is opened or decoded per image, and the labels come from the label index instead of one text
+    file per image.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # The shards are already a decoded cache, in the page cache of the OS rather than in every worker
+        kwargs["cache"] = False
+        super().__init__(*args, **kwargs)
+
+    def get_img_files(self, img_path):
+        self.shards = ShardReader(img_path)
+        return [f"{img_path}/{name}" for name in self.shards.names]
+
+    def get_labels(self):
+        shape = (self.shards.height, self.shards.width)
+        labels = []
+        for i, im_file in enumerate(self.im_files):
+            boxes = self.shards.labels(i)
+            labels.append({"im_file": im_file, "shape": shape, "cls": boxes[:, :1].copy(), "bboxes": boxes[:, 1:].copy(),
+                           "segments": [], "keypoints": None, "normalized": True, "bbox_format": "xywh"})
+        return labels
+
+    def load_image(self, i, rect_mode=True, **kwargs):
+        """The image of BaseDataset.load_image, from its shard."""
+        im = np.array(self.shards.image(i))
+        h0, w0 = im.shape[:2]
+        if rect_mode:
+            r = self.imgsz / max(h0, w0)
+            if r != 1:
+                w, h = min(math.ceil(w0 * r), self.imgsz), min(math.ceil(h0 * r), self.imgsz)
+                im = cv2.resize(im, (w, h), interpolation=cv2.INTER_LINEAR)
+        elif not (h0 == w0 == self.imgsz):
+            im = cv2.resize(im, (self.imgsz, self.imgsz), interpolation=cv2.INTER_LINEAR)
+
+        # Recently loaded images are kept for the mosaic augmentation, like BaseDataset does
+        if self.augment:
+            self.ims[i], self.im_hw0[i], self.im_hw[i] = im, (h0, w0), im.shape[:2]
+            self.buffer.append(i)
+            if 1 < len(self.buffer) >= self.max_buffer_length:
+                j = self.buffer.pop(0)
+                self.ims[j], self.im_hw0[j], self.im_hw[j] = None, None, None
+        return im, (h0, w0), im.shape[:2]
+
+class ShardTrainer(DetectionTrainer):
+    """DetectionTrainer on a dataset of shards, the train and val entries of data.yaml being split folders."""
+
+    def build_dataset(self, img_path, mode="train", batch=None):
+        model = getattr(self.model, "module", self.model)
+        stride = max(int(model.stride.max()), 32) if model is not None else 32
+        return ShardDataset(
+            img_path=img_path,
+            imgsz=self.args.imgsz,
+            batch_size=batch,
+            augment=mode == "train",
+            hyp=self.args,
+            rect=self.args.rect or mode == "val",
+            single_cls=self.args.single_cls or False,
+            stride=stride,
+            pad=0.0 if mode == "train" else 0.5,
+            prefix=colorstr(f"{mode}: "),
+            task=self.args.task,
+            classes=self.args.classes,
+            data=self.data,
+            fraction=self.args.fraction if mode == "train" else 1.0,
+        )
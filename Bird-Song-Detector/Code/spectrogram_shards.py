@@ -0,0 +1,177 @@
+# Import libraries
+import csv
+import json
+import os
+
+import numpy as np
+
+# Images per shard file, about 1.2 GB of 640x318 spectrograms
+SHARD_IMAGES = 2048
+
+MANIFEST_COLUMNS = ["name", "shard", "row", "source", "channel", "uncertainty", "labelled"]
+
+class ShardWriter:
+    """
+    Spectrogram images of a dataset split in memory-mapped uint8 shards, with a label index.
+
+    Layout of a split folder:
+    - images_<n>.u8: raw BGR images of the same height and width, SHARD_IMAGES per file, appended to
+    - images.csv: one row per image (name, shard, row, source recording, channel, uncertainty, labelled)
+    - labels.npz: YOLO labels of all the images (class x_center y_center width height, normalised) and the offset
+      of the labels of every image
+    - meta.json: height and width of the images and the number of images per shard
+
+    Images are resized to the size of the split (set by the first one, or height and width), which keeps the
+    normalised labels valid. A split is written by one process at a time; rows appended to the shards by a writer
+    that was not closed are dropped when the split is opened again.
+    """
+
+    def __init__(self, folder, height=None, width=None, shard_images=SHARD_IMAGES):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        meta_path = os.path.join(folder, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            height, width, shard_images = meta["height"], meta["width"], meta["shard_images"]
+        self.height, self.width, self.shard_images = height, width, shard_images
+        reader = ShardReader(folder) if os.path.exists(meta_path) else None
+        self.manifest = reader.manifest if reader else []
+        self.labels = [reader.labels(i) for i in range(len(reader))] if reader else []
+        self._truncate()
+
+    def _truncate(self):
+        """Drop the rows appended after the manifest was last written."""
+        if self.height is None:
+            return
+        frame = self.height * self.width * 3
+        rows = {}
+        for item in self.manifest:
+            rows[item["shard"]] = max(rows.get(item["shard"], 0), item["row"] + 1)
+        for name in os.listdir(self.folder):
+            if name.startswith("images_") and name.endswith(".u8"):
+                shard = int(name[7:-3])
+                with open(os.path.join(self.folder, name), "r+b") as f:
+                    f.truncate(rows.get(shard, 0) * frame)
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def names(self):
+        return {item["name"] for item in self.manifest}
+
+    def sources(self):
+        return {item["source"] for item in self.manifest}
+
+    def add(self, name, image, labels, source="", channel=0, uncertainty=None, labelled=False):
+        """
+        Append an image (BGR uint8, any size) and its YOLO labels, shape (n, 5).
+        """
+        import cv2
+
+        if self.height is None:
+            self.height, self.width = image.shape[:2]
+        if image.shape[:2] != (self.height, self.width):
+            # Like ultralytics resizes the images it reads, so training sees the same pixels as from the PNG files
+            image = cv2.resize(image, (self.width, self.height), interpolation=cv2.INTER_LINEAR)
+        index = len(self.manifest)
+        shard, row = divmod(index, self.shard_images)
+        with open(os.path.join(self.folder, f"images_{shard:05d}.u8"), "ab") as f:
+            f.write(np.ascontiguousarray(image, dtype=np.uint8).tobytes())
+        self.manifest.append({"name": name, "shard": shard, "row": row, "source": source, "channel": channel,
+                              "uncertainty": "" if uncertainty is None else round(float(uncertainty), 4),
+                              "labelled": int(labelled)})
+        self.labels.append(np.asarray(labels, dtype=np.float32).reshape(-1, 5))
+
+    def relabel(self, labels_by_name):
+        """
+        Replace the labels of images by name (the reviewed labels of an annotation tool), marking them labelled.
+
+        Returns:
+            int: Number of images relabelled.
+        """
+        count = 0
+        for i, item in enumerate(self.manifest):
+            if item["name"] in labels_by_name:
+                self.labels[i] = np.asarray(labels_by_name[item["name"]], dtype=np.float32).reshape(-1, 5)
+                item["labelled"] = 1
+                count += 1
+        return count
+
+    def close(self):
+        """Write the manifest, the label index and the meta data of the split."""
+        offsets = np.cumsum([0] + [len(labels) for labels in self.labels])
+        labels = np.concatenate(self.labels) if self.labels else np.zeros((0, 5), dtype=np.float32)
+        write_atomic(os.path.join(self.folder, "labels.npz"), lambda f: np.savez(f, labels=labels, offsets=offsets))
+
+        def write_manifest(f):
+            writer = csv.DictWriter(f, fieldnames=MANIFEST_COLUMNS)
+            writer.writeheader()
+            writer.writerows(self.manifest)
+        write_atomic(os.path.join(self.folder, "images.csv"), write_manifest, binary=False)
+
+        meta = {"height": self.height, "width": self.width, "shard_images": self.shard_images}
+        write_atomic(os.path.join(self.folder, "meta.json"), lambda f: json.dump(meta, f), binary=False)
+
+class ShardReader:
+    """Images and labels of a split written by ShardWriter, the images as views of the memory-mapped shards."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, "meta.json")) as f:
+            meta = json.load(f)
+        self.height, self.width = meta["height"], meta["width"]
+        with open(os.path.join(folder, "images.csv"), newline="") as f:
+            self.manifest = [{**item, "shard": int(item["shard"]), "row": int(item["row"]),
+                              "channel": int(item["channel"]), "labelled": int(item["labelled"])}
+                             for item in csv.DictReader(f)]
+        with np.load(os.path.join(folder, "labels.npz")) as npz:
+            self._labels, self._offsets = npz["labels"], npz["offsets"]
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.manifest)
+
+    @property
+    def names(self):
+        return [item["name"] for item in self.manifest]
+
+    def labels(self, i):
+        """YOLO labels of image i, shape (n, 5): class x_center y_center width height."""
+        return self._labels[self._offsets[i]:self._offsets[i + 1]]
+
+    def image(self, i):
+        """Image i, (height, width, 3) BGR uint8, read-only view of its shard."""
+        item = self.manifest[i]
+        shard = self._shards.get(item["shard"])
+        if shard is None:
+            path = os.path.join(self.folder, f"images_{item['shard']:05d}.u8")
+            rows = os.path.getsize(path) // (self.height * self.width * 3)
+            shard = self._shards[item["shard"]] = np.memmap(path, dtype=np.uint8, mode="r",
+                                                            shape=(rows, self.height, self.width, 3))
+        return shard[item["row"]]
+
+def write_atomic(path, write, binary=True):
+    """Write a file through a temporary file, so a reader never sees half of it."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with (open(tmp_path, "wb") if binary else open(tmp_path, "w", newline="")) as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+def read_yolo_labels(path):
+    """YOLO labels of a text file, shape (n, 5), none for a missing file (a background image)."""
+    if not os.path.exists(path):
+        return np.zeros((0, 5), dtype=np.float32)
+    return np.loadtxt(path, ndmin=2, dtype=np.float32).reshape(-1, 5)
+
+def write_data_yaml(dataset, names):
+    """data.yaml of a dataset folder with train/ and val/ splits, for ultralytics (see shard_dataset.py)."""
+    splits = [split for split in ("train", "val") if os.path.exists(os.path.join(dataset, split, "meta.json"))]
+    lines = [f"path: {os.path.abspath(dataset)}"]
+    lines += [f"{split}: {split}" for split in splits]
+    if "val" not in splits and splits:
+        lines.append(f"val: {splits[0]}")
+    lines.append("names:")
+    lines += [f"  {i}: {name}" for i, name in enumerate(names)]
+    with open(os.path.join(dataset, "data.yaml"), "w") as f:
+        f.write("\n".join(lines) + "\n")
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Fleet-level ingest service for the detection metadata of many recording stations.
+
+Stations POST compact, columnar batches of detections (see record/Code/fleet_sync.py) instead of us listing and
+parsing millions of object names in the bucket. Detections are kept in a columnar store partitioned by station
+and day:
+
+  <store>/<station>/<YYYY-MM-DD>/part-<n>/{ts,end,score,cls,key}.npy
+
+Every part is sorted by time, so a range query only opens the partitions of the requested stations and days
+and binary-searches each part (memory-mapped). Small parts are compacted into one when a partition has more
+than --compact-after of them. The parts of a partition are listed in its parts.json, replaced atomically, so a
+crash during an ingest or a compaction leaves either the old parts or the new ones.
+
+Endpoints:
+  POST /ingest   {"station": "AM1", "batch": "<id>", "columns": {"ts": [...], "end": [...], "score": [...],
+                  "cls": [...], "key": [...]}}   (ts/end in epoch seconds; gzip bodies are accepted)
+  GET  /query?station=AM1&start=2025-08-22T00:00&end=2025-08-23&min_score=0.5&limit=1000
+  GET  /stations  detections per station and day
+
+Example:
+  python ingest_server.py --store fleet_store --port 8088
+"""
+
+# Import libraries
+import argparse
+import gzip
+import json
+import os
+import re
+import shutil
+import threading
+import zlib
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+COLUMNS = {"ts": np.float64, "end": np.float64, "score": np.float32, "cls": np.int16, "key": "U128"}
+KEY_LENGTH = 128
+# A station is a folder of the store: no "." or ".." and no path separator
+STATION_RE = re.compile(r"^(?!\.{1,2}$)[A-Za-z0-9_.-]{1,64}$")
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Ingest and query detection metadata from many stations.")
+    p.add_argument("--store", default=os.getenv("FLEET_STORE", "fleet_store"), help="Store directory (env FLEET_STORE)")
+    p.add_argument("--host", default="0.0.0.0", help="Address to listen on (default: 0.0.0.0)")
+    p.add_argument("--port", type=int, default=int(os.getenv("FLEET_PORT", "8088")), help="Port (env FLEET_PORT)")
+    p.add_argument("--compact-after", type=int, default=16, help="Compact a partition above this many parts")
+    return p.parse_args()
+
+def parse_time(value):
+    """ISO 8601 date/time or epoch seconds -> epoch seconds (naive times are UTC)."""
+    try:
+        return float(value)
+    except ValueError:
+        t = datetime.fromisoformat(value)
+        return (t if t.tzinfo else t.replace(tzinfo=timezone.utc)).timestamp()
+
+def day_of(ts):
+    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime("%Y-%m-%d")
+
+class ColumnStore:
+    """Columnar detections store partitioned by station and day."""
+
+    def __init__(self, root, compact_after=16):
+        self.root = root
+        self.compact_after = compact_after
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.batches_path = os.path.join(root, "batches.log")
+        self.batches = set()
+        if os.path.exists(self.batches_path):
+            with open(self.batches_path) as f:
+                self.batches = {line.strip() for line in f}
+
+    def _parts(self, partition):
+        """Parts of a partition, from its parts.json (the part folders of a store written without one)."""
+        manifest = os.path.join(partition, "parts.json")
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                return [os.path.join(partition, p) for p in json.load(f)]
+        if not os.path.isdir(partition):
+            return []
+        return sorted(os.path.join(partition, p) for p in os.listdir(partition) if p.startswith("part-") and not p.endswith(".tmp"))
+
+    def _set_parts(self, partition, parts):
+        manifest = os.path.join(partition, "parts.json")
+        with open(manifest + ".tmp", "w") as f:
+            json.dump([os.path.basename(p) for p in parts], f)
+        os.replace(manifest + ".tmp", manifest)
+
+    def _write_part(self, partition, columns):
+        """Write a new part, not listed in parts.json yet. Returns its path."""
+        os.makedirs(partition, exist_ok=True)
+        order = np.argsort(columns["ts"], kind="stable")
+        # Numbered after every part folder, including the ones left by a crash
+        existing = [int(p[5:11]) for p in os.listdir(partition) if p.startswith("part-")]
+        part = os.path.join(partition, f"part-{max(existing, default=-1) + 1:06d}")
+        tmp = part + ".tmp"
+        os.makedirs(tmp)
+        for name, dtype in COLUMNS.items():
+            np.save(os.path.join(tmp, f"{name}.npy"), np.asarray(columns[name], dtype=dtype)[order])
+        os.rename(tmp, part)
+        return part
+
+    def _compact(self, partition):
+        parts = self._parts(partition)
+        if len(parts) <= self.compact_after:
+            return
+        merged = {name: np.concatenate([np.load(os.path.join(p, f"{name}.npy")) for p in parts]) for name in COLUMNS}
+        merged_part = self._write_part(partition, merged)
+        self._set_parts(partition, [merged_part])
+        # The old parts, and the folders of an ingest or compaction a crash interrupted
+        for p in os.listdir(partition):
+            if p.startswith("part-") and p != os.path.basename(merged_part):
+                shutil.rmtree(os.path.join(partition, p))
+
+    def ingest(self, station, columns, batch=None):
+        """Store a batch of detections. Returns the number of rows stored (0 for an already seen batch)."""
+        if not STATION_RE.match(station):
+            raise ValueError(f"Invalid station name: {station!r}")
+        n = len(columns["ts"])
+        if any(len(columns[name]) != n for name in COLUMNS):
+            raise ValueError(f"Every column must have {n} values: {sorted(COLUMNS)}")
+        if any(len(str(key)) > KEY_LENGTH for key in columns["key"]):
+            raise ValueError(f"Keys are limited to {KEY_LENGTH} characters")
+
+        with self.lock:
+            if batch and batch in self.batches:
+                return 0  # retried batch
+            ts = np.asarray(columns["ts"], dtype=np.float64)
+            days = np.array([day_of(t) for t in ts])
+            for day in np.unique(days):
+                rows = days == day
+                partition = os.path.join(self.root, station, day)
+                parts = self._parts(partition)
+                part = self._write_part(partition, {name: np.asarray(columns[name])[rows] for name in COLUMNS})
+                # A part becomes visible to queries only once it is listed
+                self._set_parts(partition, parts + [part])
+                self._compact(partition)
+            if batch:
+                self.batches.add(batch)
+                with open(self.batches_path, "a") as f:
+                    f.write(batch + "\n")
+        return n
+
+    def stations(self):
+        return sorted(s for s in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, s)))
+
+    def query(self, stations=None, start=None, end=None, min_score=0.0, limit=10000):
+        """Detections of the given stations starting in [start, end), sorted by station then time."""
+        for station in stations or ():
+            if not STATION_RE.match(station):
+                raise ValueError(f"Invalid station name: {station!r}")
+        with self.lock:  # no compaction half-way through a query
+            return self._query(stations, start, end, min_score, limit)
+
+    def _query(self, stations, start, end, min_score, limit):
+        start = -np.inf if start is None else start
+        end = np.inf if end is None else end
+        rows = []
+        for station in stations or self.stations():
+            station_dir = os.path.join(self.root, station)
+            if not os.path.isdir(station_dir):
+                continue
+            for day in sorted(os.listdir(station_dir)):
+                # Partition pruning: partitions are UTC days
+                day_start = datetime.fromisoformat(day).replace(tzinfo=timezone.utc).timestamp()
+                if day_start >= end or day_start + timedelta(days=1).total_seconds() <= start:
+                    continue
+                day_rows = []
+                for part in self._parts(os.path.join(station_dir, day)):
+                    ts = np.load(os.path.join(part, "ts.npy"), mmap_mode="r")
+                    lo, hi = np.searchsorted(ts, [start, end], side="left")
+                    if lo == hi:
+                        continue
+                    cols = {name: np.load(os.path.join(part, f"{name}.npy"), mmap_mode="r")[lo:hi] for name in COLUMNS}
+                    for i in np.flatnonzero(cols["score"] >= min_score):
+                        day_rows.append({"station": station, "ts": float(cols["ts"][i]), "end": float(cols["end"][i]),
+                                         "score": round(float(cols["score"][i]), 4), "cls": int(cols["cls"][i]),
+                                         "key": str(cols["key"][i])})
+                rows.extend(sorted(day_rows, key=lambda row: row["ts"]))
+                if len(rows) >= limit:
+                    return rows[:limit]
+        return rows
+
+    def summary(self):
+        """Number of detections per station and day."""
+        summary = {}
+        for station in self.stations():
+            station_dir = os.path.join(self.root, station)
+            summary[station] = {
+                day: sum(len(np.load(os.path.join(p, "ts.npy"), mmap_mode="r")) for p in self._parts(os.path.join(station_dir, day)))
+                for day in sorted(os.listdir(station_dir))
+            }
+        return summary
+
+def make_handler(store):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if urlparse(self.path).path != "/ingest":
+                return self._send(404, {"error": "not found"})
+            try:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                batch = json.loads(body)
+                stored = store.ingest(batch["station"], batch["columns"], batch.get("batch"))
+            except (KeyError, ValueError, TypeError, OverflowError, EOFError, gzip.BadGzipFile, zlib.error) as e:
+                # Malformed batch: missing or wrong fields, truncated or invalid gzip
+                return self._send(400, {"error": f"{type(e).__name__}: {e}"})
+            self._send(200, {"stored": stored})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            try:
+                if url.path == "/query":
+                    rows = store.query(
+                        stations=params["station"].split(",") if "station" in params else None,
+                        start=parse_time(params["start"]) if "start" in params else None,
+                        end=parse_time(params["end"]) if "end" in params else None,
+                        min_score=float(params.get("min_score", 0)),
+                        limit=int(params.get("limit", 10000)),
+                    )
+                    return self._send(200, {"count": len(rows), "detections": rows})
+                if url.path == "/stations":
+                    return self._send(200, store.summary())
+            except ValueError as e:
+                return self._send(400, {"error": str(e)})
+            self._send(404, {"error": "not found"})
+
+        def log_message(self, fmt, *args):
+            if not self.path.startswith("/query"):
+                super().log_message(fmt, *args)
+
+    return Handler
+
+def main():
+    args = parse_args()
+    store = ColumnStore(args.store, compact_after=args.compact_after)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(store))
+    print(f"Fleet ingest server on http://{args.host}:{args.port} (store: {os.path.abspath(args.store)})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopped.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# Import libraries
+import os
+
+import pytest
+
+from ingest_server import ColumnStore, parse_time
+
+DAY = parse_time("2025-08-22T00:00")
+
+def batch(*times):
+    return {"ts": list(times), "end": [t + 1.5 for t in times], "score": [0.9] * len(times), "cls": [0] * len(times),
+            "key": [f"AM1_{i}.flac" for i in range(len(times))]}
+
+def test_a_retried_batch_is_stored_once(tmp_path):
+    store = ColumnStore(str(tmp_path))
+    assert store.ingest("AM1", batch(DAY + 10, DAY + 20), batch="AM1-1") == 2
+    assert store.ingest("AM1", batch(DAY + 10, DAY + 20), batch="AM1-1") == 0
+    # Also after a restart of the server
+    store = ColumnStore(str(tmp_path))
+    assert store.ingest("AM1", batch(DAY + 10, DAY + 20), batch="AM1-1") == 0
+    assert store.ingest("AM1", batch(DAY + 30), batch="AM1-2") == 1
+    assert [row["ts"] for row in store.query(["AM1"])] == [DAY + 10, DAY + 20, DAY + 30]
+
+def test_batches_are_split_into_day_partitions(tmp_path):
+    store = ColumnStore(str(tmp_path))
+    # Two UTC days, not in time order
+    store.ingest("AM1", batch(DAY + 86400 + 5, DAY + 50, DAY + 86399, DAY + 10))
+    assert sorted(os.listdir(tmp_path / "AM1")) == ["2025-08-22", "2025-08-23"]
+    assert store.summary() == {"AM1": {"2025-08-22": 3, "2025-08-23": 1}}
+
+    def times(start, end):
+        return [row["ts"] for row in store.query(["AM1"], parse_time(start), parse_time(end))]
+    assert times("2025-08-22", "2025-08-23") == [DAY + 10, DAY + 50, DAY + 86399]
+    assert times("2025-08-22T00:00:20", "2025-08-23T00:00:10") == [DAY + 50, DAY + 86399, DAY + 86405]
+    assert times("2025-08-24", "2025-08-25") == []
+
+def test_query_filters_stations_and_scores(tmp_path):
+    store = ColumnStore(str(tmp_path))
+    store.ingest("AM1", batch(DAY + 10))
+    store.ingest("AM2", {**batch(DAY + 20, DAY + 30), "score": [0.4, 0.8]})
+    assert [(row["station"], row["ts"]) for row in store.query(min_score=0.5)] == [("AM1", DAY + 10), ("AM2", DAY + 30)]
+    assert [row["station"] for row in store.query(["AM2"])] == ["AM2", "AM2"]
+    assert len(store.query(limit=2)) == 2
+
+def test_compaction_keeps_every_row(tmp_path):
+    store = ColumnStore(str(tmp_path), compact_after=2)
+    for i in range(5):
+        store.ingest("AM1", batch(DAY + 100 - i), batch=f"AM1-{i}")
+    partition = tmp_path / "AM1" / "2025-08-22"
+    assert len(store._parts(str(partition))) <= 2
+    assert [row["ts"] for row in store.query(["AM1"])] == [DAY + 96, DAY + 97, DAY + 98, DAY + 99, DAY + 100]
+
+@pytest.mark.parametrize("station", ["..", ".", "a/b", ""])
+def test_station_names_are_folder_names(tmp_path, station):
+    store = ColumnStore(str(tmp_path))
+    with pytest.raises(ValueError):
+        store.ingest(station, batch(DAY))
+    with pytest.raises(ValueError):
+        store.query([station])
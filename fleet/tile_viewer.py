@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Zoomable viewer of the spectrogram tile pyramids written by record/Code/tile_pyramid.py.
+
+The page shows one day of one station on a canvas: scroll to zoom, drag (or use the arrow keys) to pan. Only the
+tiles of the visible time range are fetched, at the level that matches the zoom, so scrolling through 24 hours
+stays fast. Detections are drawn on top as rectangles (a vector overlay, no image is redrawn), filtered by score.
+
+Endpoints:
+  GET /                                    the viewer
+  GET /api/index                           {"<station>": ["<YYYY-MM-DD>", ...]}
+  GET /api/meta                            tile geometry (pyramid.json)
+  GET /api/detections?station=AM1&day=...  detections of a day
+  GET /tiles/<station>/<day>/<z>/<x>.png   a tile
+
+Example:
+  python tile_viewer.py --root /opt/bird-files/record/tiles --port 8090
+"""
+
+# Import libraries
+import argparse
+import json
+import os
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Station names are folders of the pyramids: "." and ".." would leave the root
+STATION = r"(?!\.{1,2}(?:/|$))[A-Za-z0-9_.-]{1,64}"
+STATION_RE = re.compile(f"^{STATION}$")
+TILE_RE = re.compile(rf"^/tiles/({STATION})/(\d{{4}}-\d{{2}}-\d{{2}})/(\d+)/(\d+)\.png$")
+DAY_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Bird Song Detector - tiles</title>
+<style>
+  body { margin: 0; font-family: sans-serif; background: #111; color: #ddd; }
+  #bar { padding: 6px 10px; display: flex; gap: 12px; align-items: center; }
+  canvas { display: block; width: 100vw; height: calc(100vh - 40px); cursor: grab; }
+</style></head>
+<body>
+<div id="bar">
+  <select id="station"></select> <select id="day"></select>
+  <label>min score <input id="score" type="number" min="0" max="1" step="0.05" value="0.25" style="width:4em"></label>
+  <button id="all">Whole day</button> <span id="info"></span>
+</div>
+<canvas id="view"></canvas>
+<script>
+const canvas = document.getElementById("view"), ctx = canvas.getContext("2d");
+const $ = id => document.getElementById(id);
+let meta, index, detections = [], tiles = new Map();
+let t0 = 0, spp = 1;  // seconds at the left edge, seconds per pixel
+
+function resize() { canvas.width = canvas.clientWidth; canvas.height = canvas.clientHeight; draw(); }
+function level() {
+  const z = Math.floor(Math.log2(spp * meta.tile_width / meta.tile_seconds));
+  return Math.max(0, Math.min(meta.max_level, z));
+}
+function tile(z, x) {
+  const key = `${$("station").value}/${$("day").value}/${z}/${x}`;
+  if (!tiles.has(key)) {
+    const img = new Image();
+    img.onload = draw;
+    img.onerror = () => { img.missing = true; };
+    img.src = `/tiles/${key}.png`;
+    tiles.set(key, img);
+    if (tiles.size > 2000) tiles.delete(tiles.keys().next().value);  // bounded memory
+  }
+  return tiles.get(key);
+}
+function hhmm(t) {
+  const h = Math.floor(t / 3600), m = Math.floor(t % 3600 / 60), s = Math.floor(t % 60);
+  return `${String(h).padStart(2, "0")}:${String(m).padStart(2, "0")}` + (spp < 0.5 ? `:${String(s).padStart(2, "0")}` : "");
+}
+function draw() {
+  if (!meta) return;
+  const W = canvas.width, H = canvas.height, z = level(), span = meta.tile_seconds * 2 ** z;
+  ctx.fillStyle = "#000"; ctx.fillRect(0, 0, W, H);
+  for (let x = Math.max(0, Math.floor(t0 / span)); x * span < Math.min(86400, t0 + W * spp); x++) {
+    const img = tile(z, x);
+    if (img.complete && !img.missing && img.naturalWidth) ctx.drawImage(img, (x * span - t0) / spp, 0, span / spp, H);
+  }
+  // Detections: vector overlay
+  const minScore = parseFloat($("score").value) || 0;
+  let shown = 0;
+  ctx.strokeStyle = "#f33"; ctx.fillStyle = "#f33"; ctx.lineWidth = 2; ctx.font = "12px sans-serif";
+  for (const d of detections) {
+    if (d.score < minScore || d.end < t0 || d.start > t0 + W * spp) continue;
+    const x1 = (d.start - t0) / spp, w = Math.max(1, (d.end - d.start) / spp);
+    ctx.strokeRect(x1, 20, w, H - 22);
+    if (w > 25) ctx.fillText(d.score.toFixed(2), x1 + 2, 34);
+    shown++;
+  }
+  // Time axis
+  ctx.fillStyle = "rgba(0,0,0,0.6)"; ctx.fillRect(0, 0, W, 18); ctx.fillStyle = "#ddd";
+  const step = [1, 5, 10, 30, 60, 300, 600, 1800, 3600, 7200].find(s => s / spp > 80) || 14400;
+  for (let t = Math.ceil(t0 / step) * step; t < t0 + W * spp; t += step) ctx.fillText(hhmm(t), (t - t0) / spp + 2, 13);
+  $("info").textContent = `${hhmm(t0)} - ${hhmm(t0 + W * spp)}, level ${z}, ${shown} detections in view`;
+}
+function whole() { spp = 86400 / canvas.width; t0 = 0; draw(); }
+async function loadDay() {
+  tiles.clear();
+  detections = await (await fetch(`/api/detections?station=${$("station").value}&day=${$("day").value}`)).json();
+  whole();
+}
+function fillDays() {
+  $("day").innerHTML = (index[$("station").value] || []).map(d => `<option>${d}</option>`).join("");
+  $("day").selectedIndex = $("day").options.length - 1;
+  loadDay();
+}
+canvas.addEventListener("wheel", e => {
+  e.preventDefault();
+  const t = t0 + e.offsetX * spp;
+  spp = Math.min(86400 / canvas.width * 2, Math.max(0.005, spp * (e.deltaY > 0 ? 1.25 : 0.8)));
+  t0 = t - e.offsetX * spp; draw();
+}, { passive: false });
+let drag = null;
+canvas.addEventListener("mousedown", e => { drag = { x: e.clientX, t0 }; canvas.style.cursor = "grabbing"; });
+window.addEventListener("mouseup", () => { drag = null; canvas.style.cursor = "grab"; });
+window.addEventListener("mousemove", e => { if (drag) { t0 = drag.t0 - (e.clientX - drag.x) * spp; draw(); } });
+window.addEventListener("keydown", e => {
+  if (e.key === "ArrowLeft") t0 -= canvas.width * spp / 4;
+  else if (e.key === "ArrowRight") t0 += canvas.width * spp / 4;
+  else return;
+  draw();
+});
+window.addEventListener("resize", resize);
+$("station").onchange = fillDays; $("day").onchange = loadDay; $("score").oninput = draw; $("all").onclick = whole;
+(async () => {
+  meta = await (await fetch("/api/meta")).json();
+  index = await (await fetch("/api/index")).json();
+  $("station").innerHTML = Object.keys(index).map(s => `<option>${s}</option>`).join("");
+  resize(); fillDays();
+})();
+</script></body></html>
+"""
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Serve the spectrogram tile pyramids and a zoomable viewer.")
+    p.add_argument("--root", default=os.getenv("TILE_PYRAMID_DIR", "tiles"), help="Pyramid folder (env TILE_PYRAMID_DIR)")
+    p.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    p.add_argument("--port", type=int, default=8090, help="Port (default: 8090)")
+    return p.parse_args()
+
+def pyramid_index(root):
+    """Stations and days with a pyramid."""
+    index = {}
+    for station in sorted(os.listdir(root)):
+        station_dir = os.path.join(root, station)
+        if os.path.isdir(station_dir):
+            index[station] = sorted(d for d in os.listdir(station_dir) if DAY_RE.match(d))
+    return index
+
+def load_detections(root, station, day):
+    path = os.path.join(root, station, day, "detections.jsonl")
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def make_handler(root):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, body, content_type, cache=False):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            # Tiles of past days do not change, today's level-0 tiles only until the next clip
+            self.send_header("Cache-Control", "max-age=60" if cache else "no-cache")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _json(self, payload):
+            self._send(200, json.dumps(payload).encode(), "application/json")
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            tile = TILE_RE.match(url.path)
+            if tile:
+                path = os.path.join(root, *tile.groups()[:3], tile.group(4) + ".png")
+                if not os.path.exists(path):
+                    return self._send(404, b"", "image/png")
+                with open(path, "rb") as f:
+                    return self._send(200, f.read(), "image/png", cache=True)
+            if url.path == "/":
+                return self._send(200, PAGE.encode(), "text/html; charset=utf-8")
+            if url.path == "/api/index":
+                return self._json(pyramid_index(root))
+            if url.path == "/api/meta":
+                with open(os.path.join(root, "pyramid.json")) as f:
+                    return self._json(json.load(f))
+            if url.path == "/api/detections":
+                station, day = params.get("station", ""), params.get("day", "")
+                if not STATION_RE.match(station) or not DAY_RE.match(day):
+                    return self._send(400, b"invalid station or day", "text/plain")
+                return self._json(load_detections(root, station, day))
+            self._send(404, b"not found", "text/plain")
+
+        def log_message(self, *args):
+            pass  # one request per tile
+
+    return Handler
+
+def main():
+    args = parse_args()
+    if not os.path.exists(os.path.join(args.root, "pyramid.json")):
+        raise SystemExit(f"No tile pyramid in {args.root} (see record/Code/tile_pyramid.py)")
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(args.root))
+    print(f"Tile viewer on http://{args.host}:{args.port} (pyramids: {os.path.abspath(args.root)})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopped.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# Import libraries
+import os
+
+import numpy as np
+
+# Indices computed when none are configured, see INDICES for the names
+DEFAULT_INDICES = ("aci", "ndsi", "bi", "entropy")
+
+# window: length of the windows the indices are computed on (seconds), aci_step: temporal step of the ACI within a
+# window (seconds), the bands are in Hz and capped at 95% of the Nyquist frequency of the spectrogram (the top bins
+# are emptied by the low-pass filter of the resampling)
+INDEX_PARAMS = {
+    "window": 60.0,
+    "aci_step": 5.0,
+    "anthrophony": (1000, 2000),
+    "biophony": (2000, 11000),
+    "bi_band": (2000, 8000),
+}
+
+def parse_indices(value):
+    """Names of the indices from a comma separated list (ACOUSTIC_INDICES), none for an empty value."""
+    names = tuple(name.strip().lower() for name in value.split(",") if name.strip())
+    unknown = [name for name in names if name not in INDICES]
+    if unknown:
+        raise ValueError(f"Unknown acoustic indices {', '.join(unknown)}, expected some of {', '.join(INDICES)}")
+    return names
+
+def window_bounds(frames, window_frames):
+    """
+    First frame of every window. The last window takes the frames left over when they are less than half a
+    window, so a clip a few samples longer than a minute still gives one value per minute.
+    """
+    count = max(1, int(frames / max(window_frames, 1) + 0.5))
+    return np.arange(count) * window_frames
+
+def window_mean(S, bounds):
+    """Mean over the frames of every window, (..., freq, frames) -> (..., freq, windows)."""
+    counts = np.diff(np.append(bounds, S.shape[-1]))
+    return np.add.reduceat(S, bounds, axis=-1) / counts
+
+def band(freqs, low_high):
+    """Mask of the frequency bins within a band, up to 95% of the Nyquist frequency."""
+    low, high = low_high
+    return (freqs >= low) & (freqs <= min(high, 0.95 * freqs[-1]))
+
+def acoustic_complexity(S, freqs, fps, bounds, params):
+    """
+    Acoustic Complexity Index (Pieretti et al. 2011): in every frequency bin, the summed absolute difference of
+    successive frames over the summed intensity of a step, added up over the bins and the steps of the window.
+    """
+    frames = S.shape[-1]
+    step_frames = max(1, int(round(params["aci_step"] * fps)))
+    ends = np.append(bounds[1:], frames)
+    steps = np.concatenate([np.arange(start, end, step_frames) for start, end in zip(bounds, ends)])
+
+    # Difference between frame t and t + 1 counted in the step of frame t, none across two steps
+    diff = np.abs(np.diff(S, axis=-1, append=S[..., -1:]))
+    diff[..., steps[1:] - 1] = 0
+    total = np.add.reduceat(S, steps, axis=-1)
+    per_step = np.divide(np.add.reduceat(diff, steps, axis=-1), total, out=np.zeros_like(total), where=total > 0)
+    per_step = per_step.sum(axis=-2)
+    return np.add.reduceat(per_step, np.searchsorted(steps, bounds), axis=-1)
+
+def normalized_difference(S, freqs, fps, bounds, params):
+    """
+    Normalized Difference Soundscape Index (Kasten et al. 2012): (biophony - anthrophony) / (biophony + anthrophony)
+    of the power in the two bands, from -1 (only anthrophony) to 1 (only biophony).
+    """
+    power = window_mean(np.square(S), bounds)
+    anthro = power[..., band(freqs, params["anthrophony"]), :].sum(axis=-2)
+    bio = power[..., band(freqs, params["biophony"]), :].sum(axis=-2)
+    total = bio + anthro
+    return np.divide(bio - anthro, total, out=np.zeros_like(total), where=total > 0)
+
+def bioacoustic(S, freqs, fps, bounds, params):
+    """
+    Bioacoustic Index (Boelman et al. 2007): area (dB x kHz) between the mean spectrum of the window in dB and its
+    minimum within bi_band.
+    """
+    mask = band(freqs, params["bi_band"])
+    spectrum = 10 * np.log10(window_mean(np.square(S[..., mask, :]), bounds) + 1e-20)
+    bin_khz = (freqs[1] - freqs[0]) / 1000
+    return (spectrum - spectrum.min(axis=-2, keepdims=True)).sum(axis=-2) * bin_khz
+
+def spectral_entropy(S, freqs, fps, bounds, params):
+    """
+    Spectral entropy Hf (Sueur et al. 2008): Shannon entropy of the mean amplitude spectrum of the window divided by
+    its maximum, from 0 (a pure tone) to 1 (white noise).
+    """
+    spectrum = window_mean(S, bounds)
+    total = spectrum.sum(axis=-2, keepdims=True)
+    p = np.divide(spectrum, total, out=np.zeros_like(spectrum), where=total > 0)
+    plogp = p * np.log(np.where(p > 0, p, 1))
+    return -plogp.sum(axis=-2) / np.log(len(freqs))
+
+# Name -> function(S, freqs, fps, bounds, params) returning the index of every channel and window
+INDICES = {
+    "aci": acoustic_complexity,
+    "ndsi": normalized_difference,
+    "bi": bioacoustic,
+    "entropy": spectral_entropy,
+}
+
+def compute_indices(S, sr, n_fft, hop_length, names=DEFAULT_INDICES, params=None):
+    """
+    Soundscape indices of every channel and window from the magnitude STFT the spectrograms are made of, so they
+    cost a few vectorised reductions instead of another pass over the audio.
+
+    Args:
+        S (np.ndarray): Magnitude STFT, shape (channels, freq, frames).
+        sr, n_fft, hop_length: Parameters of the STFT.
+        names (tuple): Indices to compute, keys of INDICES.
+        params (dict, optional): Overrides of INDEX_PARAMS.
+
+    Returns:
+        dict: Name -> np.ndarray of shape (channels, windows).
+    """
+    params = {**INDEX_PARAMS, **(params or {})}
+    S = np.asarray(S)
+    freqs = np.linspace(0, sr / 2, 1 + n_fft // 2)
+    fps = sr / hop_length
+    bounds = window_bounds(S.shape[-1], int(round(params["window"] * fps)))
+    return {name: INDICES[name](S, freqs, fps, bounds, params) for name in names}
+
+def save_indices(output_path, indices, window=INDEX_PARAMS["window"]):
+    """
+    Save the indices as CSV, one row per channel and window: channel,start_second,<index>,...
+    """
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    names = list(indices)
+    table = np.stack([indices[name] for name in names], axis=-1)  # (channels, windows, indices)
+    channels, windows = table.shape[:2]
+    rows = np.column_stack([np.repeat(np.arange(channels), windows), np.tile(np.arange(windows) * window, channels),
+                            table.reshape(channels * windows, -1)])
+    np.savetxt(output_path, rows, fmt=["%d", "%.1f"] + ["%.6g"] * len(names), delimiter=",",
+               header=",".join(["channel", "start_second"] + names), comments="")
+    return output_path
@@ -1,128 +1,308 @@
 # Import libraries
-import pandas as pd
+# matplotlib and soundfile are imported by the functions that use them, they are slow to import and not needed
+# by every entry point
 import librosa
 import os
-import matplotlib.pyplot as plt
 import numpy as np
-from pydub import AudioSegment
-from PIL import Image
-from ultralytics.utils.ops import Profile
 
-@Profile()
-def save_spectrogram_from_audio(audio_file):
+from acoustic_indices import compute_indices
+from detections import Detections
+import metrics
+from metrics import trace
+from spectrogram_cache import model_version
+
+# STFT of the spectrograms the detector was trained on; part of the cache key of spectrograms and detections
+SPECTROGRAM_PARAMS = {"sr": 16000, "n_fft": 2048, "hop_length": 512}
+
+def derived_path(audio_file, folder, suffix="", ext=None, output_dir=None):
     """
-    Generate a spectrogram image from an audio file and save it to the Images folder."
+    Path of a file derived from an audio file: Audios/<name>.wav -> <folder>/<name><suffix><ext>
+    With output_dir the file goes to <output_dir>/<name><suffix><ext> instead.
+    """
+    base, audio_ext = os.path.splitext(audio_file.replace('Audios', folder))
+    if output_dir is not None:
+        base = os.path.join(output_dir, os.path.basename(base))
+    return base + suffix + (audio_ext if ext is None else ext)
+
+def segment_path(audio_file, start_sec, end_sec, score, output_dir=None):
+    """
+    Path of the WAV segment of a detection: Audios/<name>.flac -> Segments/<name>_<start>_<end>_<score>.wav
+    The extension of WAV clips is kept as is (.WAV of the recorders).
+    """
+    ext = None if audio_file.lower().endswith(".wav") else ".wav"
+    return derived_path(audio_file, 'Segments', f"_{start_sec:.2f}_{end_sec:.2f}_{score:.2f}", ext, output_dir)
+
+def image_path_for(audio_file, suffix="", output_dir=None):
+    """
+    Path of the spectrogram image of an audio file: Audios/<name>.wav -> Images/<name><suffix>.PNG
+    """
+    return derived_path(audio_file, 'Images', suffix, ".PNG", output_dir)
+
+def load_audio(audio_file, sr=16000, mono=True):
+    """
+    Load an audio file. With mono=False every channel is kept and y has shape (channels, samples).
+    """
+    y, sr = librosa.load(audio_file, sr=sr, mono=mono)
+    if not mono and y.ndim == 1:
+        y = y[np.newaxis, :]
+    return y, sr
+
+def estimate_snr_db(S):
+    """
+    Estimate the SNR of every channel from a magnitude STFT of shape (..., freq, frames).
+    The signal level is the 95th percentile of the frame energies and the noise floor is their median.
+    """
+    energy = np.sum(np.square(S), axis=-2)
+    signal = np.percentile(energy, 95, axis=-1)
+    noise = np.median(energy, axis=-1)
+    return 10 * np.log10((signal + 1e-12) / (noise + 1e-12))
+
+def save_spectrogram_image(D, sr, output_image_path):
+    """
+    Render a dB spectrogram (freq, frames) the way the detector was trained and save it as an image.
     """
+    import matplotlib.pyplot as plt
 
-    y, sr = librosa.load(audio_file, sr=16000)
-    
-    # Create the output path for the image
-    output_image_path = audio_file.replace('Audios', 'Images').replace(".WAV", ".PNG")
-    output_image_path = audio_file.replace('Audios', 'Images').replace(".wav", ".PNG")
-    
     # Ensure the output folder exists
     os.makedirs(os.path.dirname(output_image_path), exist_ok=True)
-    
+
     # Define the frequency range
     fmin = 1
     fmax = 16000
 
     fig, ax = plt.subplots(figsize=(12, 6))  # Set the background color to black
-    D = librosa.amplitude_to_db(librosa.stft(y), ref=np.max)
     librosa.display.specshow(D, sr=sr, x_axis="time", y_axis="log", fmin=fmin, fmax=fmax, ax=ax)  # Specify frequency range
     ax.axis('off')  # Remove axes
 
     # Save the figure using the output_image_path
     fig.savefig(output_image_path, bbox_inches='tight', pad_inches=0, transparent=True)
-    
-    # Close the figure to release memory resources
+
+    # Close the figure to release memory resources. A closed figure is a reference cycle that only a full garbage
+    # collection frees, hundreds of clips later on a station: release its artists and the image buffer of the
+    # canvas (~3 MB) now
+    fig.clear()
+    fig.canvas.renderer = None
     plt.close(fig)
 
     return output_image_path
 
-@Profile()
-def transform_coordinates_to_seconds(audio_path, prediccion_txt_path):
-    image_path = audio_path.replace('Audios', 'Images').replace(".WAV", ".PNG")
-    image_path = audio_path.replace('Audios', 'Images').replace(".wav", ".PNG")
-    # Read image size
-    with Image.open(image_path) as img:
-        WIDTH, _ = img.size
-    
-    # Read predictions file
-    with open(prediccion_txt_path, 'r') as file:
-        predictions = file.readlines()
-    
-    # Load original audio
-    audio = AudioSegment.from_wav(audio_path)
-    
-    # Audio duration in ms
-    audio_duration_ms = len(audio)
-    # To seconds
-    audio_duration_sec = audio_duration_ms / 1000
-    
-    # Process each prediction
-    for i, line in enumerate(predictions):
-        _, x_center, _, width, _, score = map(float, line.split())
-        
-        # Denormalize coordinates
-        x_center_desnorm = x_center * WIDTH
-        width_desnorm = width * WIDTH
+def canvas_image(fig, ax):
+    """
+    The pixels of the axes of a drawn figure as a (height, width, 3) BGR uint8 array: the PNG of
+    save_spectrogram_image (bbox_inches='tight', pad_inches=0) as YOLO reads it, without encoding it.
+    """
+    rgba = np.asarray(fig.canvas.buffer_rgba())
+    x0, y0, x1, y1 = np.round(ax.get_window_extent().extents).astype(int)
+    height = rgba.shape[0]
+    return rgba[height - y1:height - y0, x0:x1, 2::-1].copy()
 
-        # Convert image coordinates to audio seconds
-        start_sec = (x_center_desnorm - width_desnorm / 2) * 60 / WIDTH
-        end_sec = (x_center_desnorm + width_desnorm / 2) * 60 / WIDTH
-        
-        # Ensure the segment is within the audio duration
-        start_sec = max(0, min(start_sec, audio_duration_sec))
-        end_sec = max(0, min(end_sec, audio_duration_sec))
+def render_spectrogram(D, sr):
+    """
+    Render a dB spectrogram (freq, frames) like save_spectrogram_image, to an image array instead of a file
+    (see canvas_image).
+    """
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(12, 6))
+    librosa.display.specshow(D, sr=sr, x_axis="time", y_axis="log", fmin=1, fmax=16000, ax=ax)
+    ax.axis('off')
+    # transparent=True of the PNG
+    fig.patch.set_alpha(0)
+    ax.patch.set_alpha(0)
+    fig.canvas.draw()
+    image = canvas_image(fig, ax)
+
+    # Released now like in save_spectrogram_image
+    fig.clear()
+    fig.canvas.renderer = None
+    plt.close(fig)
+    return image
+
+class SpectrogramRenderer:
+    """
+    Same images as save_spectrogram_image, for a stream of spectrograms of the same shape: the figure is built once
+    and only its data is replaced, which saves building the axes and the mesh for every image.
+    """
+
+    def __init__(self, sr=16000):
+        self.sr = sr
+        self.fig = self.mesh = self.shape = None
+
+    def _update(self, D):
+        import matplotlib.pyplot as plt
+
+        if D.shape != self.shape:
+            if self.fig is not None:
+                plt.close(self.fig)
+            self.fig, ax = plt.subplots(figsize=(12, 6))
+            self.mesh = librosa.display.specshow(D, sr=self.sr, x_axis="time", y_axis="log", fmin=1, fmax=16000, ax=ax)
+            ax.axis('off')
+            self.shape = D.shape
+        else:
+            self.mesh.set_array(D)
+            # Colour scale from the data, like a new specshow
+            self.mesh.autoscale()
+
+    def save(self, D, output_image_path):
+        os.makedirs(os.path.dirname(output_image_path), exist_ok=True)
+        self._update(D)
+        self.fig.savefig(output_image_path, bbox_inches='tight', pad_inches=0, transparent=True)
+        return output_image_path
 
+    def render(self, D):
+        """The image of save() as an array (see canvas_image)."""
+        self._update(D)
+        self.fig.patch.set_alpha(0)
+        self.fig.axes[0].patch.set_alpha(0)
+        self.fig.canvas.draw()
+        return canvas_image(self.fig, self.fig.axes[0])
+
+def save_spectrogram_from_audio(audio_file):
+    """
+    Generate a spectrogram image from an audio file and save it to the Images folder."
+    """
+
+    y, sr = load_audio(audio_file, sr=16000)
+
+    D = librosa.amplitude_to_db(librosa.stft(y), ref=np.max)
+
+    return save_spectrogram_image(D, sr, image_path_for(audio_file))
+
+def save_channel_spectrograms(audio_file, output_dir=None, cache=None, params=None, min_snr_db=None, in_memory=False,
+                              indices=()):
+    """
+    Generate one spectrogram image per channel of an audio file and save them to the Images folder (or output_dir).
+    The STFT of all channels is computed in a single batched call, and the acoustic indices are computed from it.
+
+    Args:
+        audio_file (str): Path to the audio file.
+        output_dir (str, optional): Folder of the images.
+        cache (SpectrogramCache, optional): Reuse the spectrograms of an audio file already seen with the same params.
+        params (dict, optional): Overrides of SPECTROGRAM_PARAMS (sr, n_fft, hop_length).
+        min_snr_db (float, optional): Activity gate: nothing is rendered when no channel reaches this SNR.
+        in_memory (bool): Return the images as arrays (see render_spectrogram) instead of saving them.
+        indices (tuple): Acoustic indices to compute, see acoustic_indices.INDICES.
+
+    Returns:
+        images (list): One image per channel, Images/<name>_ch<i>.PNG (an array with in_memory), empty below
+            the activity gate.
+        snr_db (np.ndarray): SNR estimate of every channel.
+        duration (float): Duration of the audio in seconds.
+        index_values (dict): Index name -> value of every channel and window, shape (channels, windows).
+    """
+    params = {**SPECTROGRAM_PARAMS, **(params or {})}
+    sr = params["sr"]
+    config = {"kind": "spectrogram", **params, **({"indices": list(indices)} if indices else {})}
+    cached = cache.get(audio_file, config) if cache is not None else None
+
+    if cached is not None:
+        D, snr_db, duration = cached["D"].astype(np.float32), cached["snr_db"], float(cached["duration"])
+        index_values = {name: cached[f"index_{name}"] for name in indices}
+    else:
+        with trace("decode"):
+            y, sr = load_audio(audio_file, sr=sr, mono=False)
+
+        with trace("spectrogram", channels=len(y)):
+            # (channels, freq, frames), every channel normalised to its own maximum like ref=np.max does for mono
+            S = np.abs(librosa.stft(y, n_fft=params["n_fft"], hop_length=params["hop_length"]))
+            peak = np.maximum(S.max(axis=(-2, -1), keepdims=True), 1e-10)
+            D = librosa.amplitude_to_db(S / peak, ref=1.0)
+        snr_db, duration = estimate_snr_db(S), y.shape[-1] / sr
+        # From the same STFT (not the dB image, clipped at -80 dB), also for the clips below the activity gate
+        with trace("indices", indices=len(indices)):
+            index_values = compute_indices(S, sr, params["n_fft"], params["hop_length"], indices)
+
+        if cache is not None:
+            # dB values within [-80, 0] lose nothing visible in float16
+            cache.put(audio_file, config, D=D.astype(np.float16), snr_db=snr_db, duration=duration,
+                      **{f"index_{name}": values for name, values in index_values.items()})
+
+    if min_snr_db is not None and np.max(snr_db) < min_snr_db:
+        return [], snr_db, duration, index_values
+
+    with trace("render", channels=len(D), cached=cached is not None, in_memory=in_memory):
+        if in_memory:
+            images = [render_spectrogram(D[ch], sr) for ch in range(len(D))]
+        else:
+            images = [save_spectrogram_image(D[ch], sr, image_path_for(audio_file, f"_ch{ch}", output_dir)) for ch in range(len(D))]
+
+    return images, snr_db, duration, index_values
+
+def detect_channels(model, audio_path, fusion="max", output_dir=None, cache=None, params=None, imgsz=None, min_snr_db=None,
+                    indices=()):
+    """
+    Detect bird songs on every channel of an audio file, running all channels through the model as one batch,
+    and fuse the detections with the given policy (see channel_fusion.FUSION_POLICIES).
+    The spectrogram images are saved to output_dir when given, next to the audio in Images/ otherwise, or passed in
+    memory to a model that takes arrays (the detector daemon, see inference_service.py).
+    With a cache, the detections of an audio file already processed by the same model with the same parameters
+    are returned without computing anything. imgsz overrides the input size of the model and, with min_snr_db,
+    a recording where no channel reaches that SNR is not run through the model (no detections).
+    The acoustic indices named in indices are computed from the STFT of the spectrograms (Detections.indices).
+
+    Returns:
+        Detections: start_second, end_second, class, confidence and the score of every channel of each detection.
+    """
+    version = model_version(model) if cache is not None else None
+    if version is not None:
+        config = {"kind": "detections", "model": version, "fusion": fusion, **SPECTROGRAM_PARAMS, **(params or {}),
+                  **({"imgsz": imgsz} if imgsz else {}), **({"indices": list(indices)} if indices else {})}
+        cached = cache.get(audio_path, config)
+        if cached is not None:
+            print(f"Detections of {audio_path} from the cache ({version})")
+            return Detections.from_array(cached["table"], cached["duration"],
+                                         indices={name: cached[f"index_{name}"] for name in indices})
+
+    with trace("extraction") as dt:
+        images, snr_db, duration, index_values = save_channel_spectrograms(
+            audio_path, output_dir, cache=cache, params=params, min_snr_db=min_snr_db,
+            in_memory=getattr(model, "takes_arrays", False), indices=indices)
+    print("Spectrogram extraction: ", dt)
+    if not images:
+        print(f"Channel SNR (dB): {np.round(snr_db, 1)}, below the activity gate of {min_snr_db} dB")
+        metrics.CLIPS_GATED.inc()
+        return Detections.from_array(np.zeros((0, 4 + len(snr_db))), duration, indices=index_values)
+
+    with trace("inference", images=len(images)) as dtmodel:
+        results = model(images, **({"imgsz": imgsz} if imgsz else {}))
+    print("Model extraction: ", dtmodel)
+    print("Channel SNR (dB): ", np.round(snr_db, 1))
+
+    detections = Detections.from_results(results, duration, fusion=fusion, snr_db=snr_db)
+    detections.indices = index_values
+    if version is not None:
+        cache.put(audio_path, config, table=detections.to_array(), duration=duration,
+                  **{f"index_{name}": values for name, values in index_values.items()})
+    return detections
+
+def transform_coordinates_to_seconds(detections):
+    """
+    Print the time segment of every detection.
+    """
+    for i, (start_sec, end_sec, _, score) in enumerate(detections):
         print(f"Detection {i+1}: From {start_sec:.2f} to {end_sec:.2f} seconds ({score:.2f})")
 
-@Profile()
-def transform_predictions_save_segment(audio_path, prediccion_txt_path):
-    image_path = audio_path.replace('Audios', 'Images').replace(".WAV", ".PNG")
-    image_path = audio_path.replace('Audios', 'Images').replace(".wav", ".PNG")
-    # Read image size
-    with Image.open(image_path) as img:
-        WIDTH, _ = img.size
-    
-    # Read predictions file
-    with open(prediccion_txt_path, 'r') as file:
-        predictions = file.readlines()
-    
-    # Load original audio
-    audio = AudioSegment.from_wav(audio_path)
-    
-    # Audio duration in ms
-    audio_duration_ms = len(audio)
-    # To seconds
-    audio_duration_sec = audio_duration_ms / 1000
-    
-    # Process each prediction
-    for i, line in enumerate(predictions):
-        _, x_center, _, width, _, score = map(float, line.split())
-        
-        # Denormalize coordinates
-        x_center_desnorm = x_center * WIDTH
-        width_desnorm = width * WIDTH
+@trace("segments")
+def transform_predictions_save_segment(audio_path, detections, output_dir=None):
+    """
+    Save one audio segment per detection to the Segments folder (or output_dir): <name>_<start>_<end>_<score>.wav
+    """
+    import soundfile as sf
 
-        # Convert image coordinates to audio seconds
-        start_sec = (x_center_desnorm - width_desnorm / 2) * 60 / WIDTH
-        end_sec = (x_center_desnorm + width_desnorm / 2) * 60 / WIDTH
-        
-        # Ensure the segment is within the audio duration
-        start_sec = max(0, min(start_sec, audio_duration_sec))
-        end_sec = max(0, min(end_sec, audio_duration_sec))
+    # Load original audio, WAV or FLAC (the archives reprocessed with --segments hold FLAC clips)
+    audio, sr = sf.read(audio_path, always_2d=True)
+    # Segments are WAV files with the sample format of the clip (FLAC 8-bit has no WAV equivalent)
+    subtype = sf.info(audio_path).subtype
+    subtype = subtype if sf.check_format("WAV", subtype) else None
+
+
+    # Process each detection
+    for start_sec, end_sec, _, score in detections:
 
-        # To ms
-        start_msec = start_sec * 1000
-        end_msec = end_sec * 1000
-        
         # Segment audio
-        segment = audio[start_msec:end_msec]
+        segment = audio[int(start_sec * sr):int(end_sec * sr)]
 
-        output_path = audio_path.replace('Audios', 'Segments').replace(".WAV", f"_{start_sec:.2f}_{end_sec:.2f}_{score:.2f}.WAV")
-        output_path = audio_path.replace('Audios', 'Segments').replace(".wav", f"_{start_sec:.2f}_{end_sec:.2f}_{score:.2f}.wav")
+        output_path = segment_path(audio_path, start_sec, end_sec, score, output_dir)
         output_folder = os.path.dirname(output_path)
 
         # If output_folder does not exist, create it
@@ -130,7 +310,7 @@ def transform_predictions_save_segment(audio_path, prediccion_txt_path):
             os.makedirs(output_folder)
         
         # Save the segment
-        segment.export(output_path, format="wav")
+        sf.write(output_path, segment, sr, subtype=subtype, format="WAV")
 
         print(f"Detection {start_sec:.2f} - {end_sec:.2f} seconds ({score:.2f}) saved as {output_path}")
         
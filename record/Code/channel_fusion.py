@@ -0,0 +1,92 @@
+# Import libraries
+import numpy as np
+
+# Available policies to merge the detections of every channel of a recording:
+# - "max":   union of all channels, overlapping detections are merged keeping the highest score
+# - "union": every detection of every channel is kept
+# - "snr":   only the detections of the channel with the best signal to noise ratio are kept
+FUSION_POLICIES = ("max", "union", "snr")
+
+
+def interval_iou(a, b):
+    """
+    Pairwise intersection over union of two sets of time intervals.
+
+    Args:
+        a (np.ndarray): Array of shape (N, 2) with start and end seconds.
+        b (np.ndarray): Array of shape (M, 2) with start and end seconds.
+
+    Returns:
+        np.ndarray: Array of shape (N, M) with the IoU of every pair.
+    """
+    start = np.maximum(a[:, None, 0], b[None, :, 0])
+    end = np.minimum(a[:, None, 1], b[None, :, 1])
+    inter = np.clip(end - start, 0, None)
+    union = (a[:, None, 1] - a[:, None, 0]) + (b[None, :, 1] - b[None, :, 0]) - inter
+    return inter / np.maximum(union, 1e-9)
+
+
+def _suppress(detections, iou_threshold):
+    """Greedy non-maximum suppression over time intervals, keeping the highest score of each group."""
+    order = np.argsort(-detections[:, 3])
+    detections = detections[order]
+    iou = interval_iou(detections[:, :2], detections[:, :2])
+    keep = np.ones(len(detections), dtype=bool)
+    for i in range(len(detections)):
+        if keep[i]:
+            keep[i + 1:] &= iou[i, i + 1:] < iou_threshold
+    return detections[keep]
+
+
+def channel_scores(detections, per_channel, iou_threshold=0.5):
+    """
+    Score of every detection in every channel: the best score of the overlapping detections of that channel, 0 if none.
+
+    Returns:
+        np.ndarray: Array of shape (N, channels).
+    """
+    scores = np.zeros((len(detections), len(per_channel)))
+    for ch, channel in enumerate(per_channel):
+        if len(detections) == 0 or len(channel) == 0:
+            continue
+        overlap = interval_iou(detections[:, :2], channel[:, :2]) >= iou_threshold
+        scores[:, ch] = np.max(np.where(overlap, channel[None, :, 3], 0), axis=1)
+    return scores
+
+
+def fuse_channel_detections(per_channel, policy="max", snr_db=None, iou_threshold=0.5):
+    """
+    Merge the detections found independently on every channel of a recording.
+
+    Args:
+        per_channel (list): One array of shape (N, 4) per channel with start_second, end_second, class, confidence.
+        policy (str): One of FUSION_POLICIES.
+        snr_db (np.ndarray, optional): SNR of every channel, required by the "snr" policy.
+        iou_threshold (float): Minimum IoU for two detections to be considered the same song.
+
+    Returns:
+        np.ndarray: Array of shape (M, 4 + channels) with start_second, end_second, class, confidence
+        followed by the score of the detection in each channel, sorted by start time.
+    """
+    if policy not in FUSION_POLICIES:
+        raise ValueError(f"Unknown fusion policy '{policy}', expected one of {FUSION_POLICIES}")
+
+    per_channel = [np.asarray(channel, dtype=float).reshape(-1, 4) for channel in per_channel]
+
+    if len(per_channel) == 1:
+        # Mono: nothing to fuse, the detections of the model are kept as they are (no suppression)
+        detections = per_channel[0]
+        detections = detections[np.argsort(detections[:, 0], kind="stable")]
+        return np.hstack([detections, detections[:, 3:4]])
+
+    if policy == "snr":
+        if snr_db is None:
+            raise ValueError("The 'snr' fusion policy needs the SNR of every channel")
+        detections = per_channel[int(np.argmax(snr_db))]
+    else:
+        detections = np.concatenate(per_channel, axis=0)
+        if policy == "max" and len(detections):
+            detections = _suppress(detections, iou_threshold)
+
+    detections = detections[np.argsort(detections[:, 0], kind="stable")]
+    return np.hstack([detections, channel_scores(detections, per_channel, iou_threshold)])
@@ -0,0 +1,101 @@
+"""
+Local content index of the exported and uploaded files, to avoid re-encoding and re-uploading identical bytes.
+
+Reprocessing a clip, replaying the same test audio through the loopback (virtual_sound.sh) or retrying a run
+produces files with new names but the same content. The index keeps, in SQLite:
+- objects: content hash -> remote key, for every file uploaded,
+- names: file name -> content hash (and hash of the WAV it was encoded from), the lookup table from the names
+  the pipeline gives its files to the content-addressed objects.
+
+It is shared by several processes (move_file() runs in its own process per segment, upload_to_s3.py in another),
+which SQLite handles with its own locking.
+"""
+
+# Import libraries
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+def file_sha256(path, block_size=1 << 20):
+    """SHA-256 of the content of a file, as hex."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def content_key(digest, suffix="", prefix=""):
+    """Content-addressed remote key: <prefix>objects/ab/abcdef....flac"""
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    return f"{prefix}objects/{digest[:2]}/{digest}{suffix}"
+
+class ContentIndex:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Used from the upload threads, serialised by self.lock
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS objects (
+                    hash TEXT PRIMARY KEY, size INTEGER, key TEXT, uploaded_at REAL
+                );
+                CREATE TABLE IF NOT EXISTS names (
+                    name TEXT PRIMARY KEY, hash TEXT, source_hash TEXT, added_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS names_source ON names (source_hash);
+                CREATE INDEX IF NOT EXISTS names_hash ON names (hash);
+            """)
+
+    def name_for_source(self, source_hash):
+        """Name of a file already exported from the same source content, or None."""
+        with self.lock:
+            row = self.conn.execute("SELECT name FROM names WHERE source_hash = ? LIMIT 1", (source_hash,)).fetchone()
+        return row[0] if row else None
+
+    def add_name(self, name, digest=None, source_hash=None):
+        """Record (or complete) the hashes of a file name."""
+        with self.lock, self.conn:
+            self.conn.execute("""
+                INSERT INTO names VALUES (?, ?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET hash = COALESCE(excluded.hash, hash),
+                                                 source_hash = COALESCE(excluded.source_hash, source_hash)
+            """, (name, digest, source_hash, time.time()))
+
+    def uploaded_key(self, digest):
+        """Remote key the content was uploaded under, or None."""
+        with self.lock:
+            row = self.conn.execute("SELECT key FROM objects WHERE hash = ?", (digest,)).fetchone()
+        return row[0] if row else None
+
+    def add_object(self, digest, size, key):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)", (digest, size, key, time.time()))
+
+    def lookup(self, name):
+        """Content hash and remote key of a file name: (hash, key), with None for what is not known."""
+        with self.lock:
+            # A duplicate that was never exported resolves through the file exported from the same source
+            row = self.conn.execute("""
+                SELECT h.hash, objects.key FROM (
+                    SELECT COALESCE(n.hash, (SELECT m.hash FROM names m WHERE m.source_hash = n.source_hash
+                                             AND m.hash IS NOT NULL LIMIT 1)) AS hash
+                    FROM names n WHERE n.name = ?
+                ) h LEFT JOIN objects ON objects.hash = h.hash
+            """, (name,)).fetchone()
+        return row if row else (None, None)
+
+    def close(self):
+        self.conn.close()
+
+if __name__ == "__main__":
+    # Where is a file? python content_index.py <index.sqlite> <name> [<name> ...]
+    import sys
+
+    index = ContentIndex(sys.argv[1])
+    for name in sys.argv[2:]:
+        digest, key = index.lookup(name)
+        print(f"{name}\t{digest or '-'}\t{key or '-'}")
@@ -0,0 +1,84 @@
+# Import libraries
+import time
+
+import metrics
+from fleet_sync import clip_start_time
+
+# Cheaper settings used while the detector is behind, from what costs nothing in accuracy to what costs most. A level
+# keeps the settings of the levels before it.
+DEGRADATION_LEVELS = [
+    ("full", {}),
+    # Segments exported once the detector has caught up (the detections are still saved and sent right away)
+    ("deferred export", {"defer_export": True}),
+    # Coarser STFT and half the model input size (the model was trained at 640)
+    ("low resolution", {"imgsz": 320, "params": {"n_fft": 1024}}),
+    # Recordings where no channel reaches the SNR of the gate are not run through the model
+    ("activity gate", {"min_snr_db": None}),
+]
+
+class DeadlineController:
+    """
+    Keeps the detector within a lag budget of the recorder by switching to cheaper settings while it is behind.
+
+    The lag is how long ago the oldest clip still waiting finished recording (start from its name, see
+    fleet_sync.clip_start_time, + clip_seconds).
+    From one budget of lag on the next level of DEGRADATION_LEVELS is used, one level more for every further budget.
+    A level is left when the lag is back under recover times the lag it was entered at, so the settings do not
+    change from one clip to the next. budget=0 keeps the full settings whatever the lag.
+
+    policy "oldest" processes the clips in recording order. "newest" takes the newest finished clip first, so the
+    detections of what is being recorded stay fresh, and catches up the older clips when no newer clip waits (quiet
+    hours, when the activity gate makes most clips cheap).
+    """
+
+    POLICIES = ("oldest", "newest")
+
+    def __init__(self, budget=300.0, policy="oldest", clip_seconds=60, recover=0.5, min_snr_db=3.0, clock=time.time):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown clip order {policy!r}, expected one of {', '.join(self.POLICIES)}")
+        self.budget = budget
+        self.policy = policy
+        self.clip_seconds = clip_seconds
+        self.recover = recover
+        self.min_snr_db = min_snr_db
+        self.clock = clock
+        self.level = 0
+        self.lag = 0.0
+
+    def order(self, clips):
+        """The clips in the order they are processed."""
+        return sorted(clips, reverse=self.policy == "newest")
+
+    def update(self, waiting):
+        """
+        Update the lag and the level from the paths of the clips waiting for the detector (finished recordings).
+
+        Returns:
+            dict: Settings of the level (see settings()).
+        """
+        starts = [clip_start_time(path) for path in waiting]
+        self.lag = max(0.0, self.clock() - min(starts) - self.clip_seconds) if starts else 0.0
+
+        previous = self.level
+        if self.budget > 0:
+            target = min(len(DEGRADATION_LEVELS) - 1, int(self.lag // self.budget))
+            if target > self.level:
+                self.level = target
+            while self.level > target and self.lag < self.level * self.budget * self.recover:
+                self.level -= 1
+        if self.level != previous:
+            print(f"[LAG] {self.lag:.0f}s behind the recorder (budget {self.budget:.0f}s): "
+                  f"{DEGRADATION_LEVELS[previous][0]} -> {DEGRADATION_LEVELS[self.level][0]}")
+            metrics.event("deadline", lag=round(self.lag, 1), level=self.level, previous=previous)
+        metrics.LAG_SECONDS.set(self.lag)
+        metrics.DEGRADATION_LEVEL.set(self.level)
+        return self.settings()
+
+    def settings(self):
+        """defer_export, imgsz, params (STFT) and min_snr_db of the current level, the ones it does not change omitted."""
+        settings = {}
+        for _, level in DEGRADATION_LEVELS[1:self.level + 1]:
+            settings.update(level)
+        if "min_snr_db" in settings:
+            settings["min_snr_db"] = self.min_snr_db
+        return settings
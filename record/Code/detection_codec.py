@@ -0,0 +1,153 @@
+"""
+Detection-aware encoding of a clip: full rate and quality only around the detected songs.
+
+A clip is written as one ZIP container with:
+- index.json: sample rate, channels, duration, the detections and the list of regions with their file names,
+- region_<i>.flac: every detection window plus padding (overlapping windows are merged), at the original rate,
+  channels and bit depth,
+- context.flac: the whole clip downmixed to mono and resampled to a low rate ("downsample" mode), or nothing
+  but silence markers with the level of each gap in index.json ("silence" mode).
+
+decode_clip() rebuilds a full-length signal at the original rate for annotators.
+"""
+
+# Import libraries
+import io
+import json
+import os
+import zipfile
+
+import librosa
+import numpy as np
+import soundfile as sf
+
+CONTAINER_SUFFIX = ".clip.zip"
+CONTEXT_MODES = ("downsample", "silence")
+
+def merge_regions(start, end, padding, duration):
+    """
+    Pad every (start, end) window and merge the ones that overlap.
+
+    Returns:
+        np.ndarray: Array of shape (N, 2) with the start and end seconds of every region, sorted.
+    """
+    if len(start) == 0:
+        return np.zeros((0, 2))
+    order = np.argsort(start)
+    start = np.clip(np.asarray(start)[order] - padding, 0, duration)
+    end = np.clip(np.asarray(end)[order] + padding, 0, duration)
+    # A region starts wherever the window begins after every previous window has ended
+    running_end = np.maximum.accumulate(end)
+    new_region = np.concatenate([[True], start[1:] > running_end[:-1]])
+    region_id = np.cumsum(new_region) - 1
+    merged_end = np.zeros(region_id[-1] + 1)
+    np.maximum.at(merged_end, region_id, end)
+    return np.column_stack([start[new_region], merged_end])
+
+def _flac_bytes(y, sr, subtype):
+    buffer = io.BytesIO()
+    sf.write(buffer, y, sr, format="FLAC", subtype=subtype)
+    return buffer.getvalue()
+
+def encode_clip(audio_path, detections, output_path, padding=1.0, context="downsample", context_rate=4000):
+    """
+    Write a clip as a detection-aware container (see the module docstring).
+
+    Args:
+        audio_path (str): Path to the original audio file.
+        detections (Detections): Detections of the clip.
+        output_path (str): Path of the container, usually ending with CONTAINER_SUFFIX.
+        padding (float): Seconds kept at full quality before and after every detection.
+        context (str): What is kept outside the regions, one of CONTEXT_MODES.
+        context_rate (int): Sample rate of the context in "downsample" mode.
+
+    Returns:
+        str: output_path
+    """
+    if context not in CONTEXT_MODES:
+        raise ValueError(f"Unknown context mode '{context}', expected one of {CONTEXT_MODES}")
+
+    info = sf.info(audio_path)
+    subtype = info.subtype if info.subtype in ("PCM_16", "PCM_24", "PCM_S8") else "PCM_16"
+    y, sr = sf.read(audio_path, dtype="float32", always_2d=True)
+    duration = len(y) / sr
+
+    regions = merge_regions(detections.start, detections.end, padding, duration)
+    index = {
+        "source": os.path.basename(audio_path),
+        "sample_rate": sr,
+        "channels": y.shape[1],
+        "subtype": subtype,
+        "duration": duration,
+        "padding": padding,
+        "detections": detections.to_array().round(4).tolist(),
+        "regions": [],
+        "context": {"mode": context},
+    }
+
+    tmp_path = output_path + ".tmp"
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    # FLAC is already compressed, store the members as they are
+    with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_STORED) as container:
+        for i, (start, end) in enumerate(regions):
+            name = f"region_{i:03d}.flac"
+            container.writestr(name, _flac_bytes(y[int(start * sr):int(end * sr)], sr, subtype))
+            index["regions"].append({"start": round(float(start), 4), "end": round(float(end), 4), "file": name})
+
+        if context == "downsample":
+            mono = librosa.resample(y.mean(axis=1), orig_sr=sr, target_sr=context_rate)
+            container.writestr("context.flac", _flac_bytes(mono, context_rate, "PCM_16"))
+            index["context"].update(file="context.flac", sample_rate=context_rate)
+        else:
+            # Silence markers: the gaps between the regions with their RMS level, so loud gaps stand out
+            bounds = np.concatenate([[0.0], regions.ravel(), [duration]]).reshape(-1, 2)
+            gaps = []
+            for start, end in bounds[bounds[:, 1] > bounds[:, 0]]:
+                gap = y[int(start * sr):int(end * sr)]
+                rms = float(np.sqrt(np.mean(np.square(gap)))) if len(gap) else 0.0
+                gaps.append({"start": round(float(start), 4), "end": round(float(end), 4),
+                             "rms_db": round(20 * np.log10(max(rms, 1e-10)), 1)})
+            index["context"]["gaps"] = gaps
+
+        container.writestr("index.json", json.dumps(index, indent=1))
+
+    os.replace(tmp_path, output_path)
+    size = os.path.getsize(output_path)
+    print(f"Encoded {audio_path}: {len(regions)} regions, {size / 1024:.0f} KiB "
+          f"({size / max(os.path.getsize(audio_path), 1):.1%} of the original) -> {output_path}")
+    return output_path
+
+def decode_clip(container_path):
+    """
+    Rebuild a full-length clip from a container: the context upsampled (or silence) with the regions on top.
+
+    Returns:
+        y (np.ndarray): Audio of shape (samples, channels) at the original sample rate.
+        sr (int): Sample rate.
+        index (dict): The index of the container.
+    """
+    with zipfile.ZipFile(container_path) as container:
+        index = json.loads(container.read("index.json"))
+        sr, channels = index["sample_rate"], index["channels"]
+        y = np.zeros((int(round(index["duration"] * sr)), channels), dtype="float32")
+
+        if index["context"].get("file"):
+            context, context_rate = sf.read(io.BytesIO(container.read(index["context"]["file"])), dtype="float32")
+            context = librosa.resample(context, orig_sr=context_rate, target_sr=sr)[:len(y)]
+            y[:len(context)] = context[:, None]
+
+        for region in index["regions"]:
+            audio, _ = sf.read(io.BytesIO(container.read(region["file"])), dtype="float32", always_2d=True)
+            start = int(region["start"] * sr)
+            audio = audio[:len(y) - start]
+            y[start:start + len(audio)] = audio
+
+    return y, sr, index
+
+if __name__ == "__main__":
+    # Decode a container back to a full-length WAV: python detection_codec.py <clip.clip.zip> <output.wav>
+    import sys
+
+    y, sr, index = decode_clip(sys.argv[1])
+    sf.write(sys.argv[2], y, sr, subtype=index["subtype"])
+    print(f"Decoded {len(index['regions'])} regions of {index['source']} to {sys.argv[2]}")
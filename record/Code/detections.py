@@ -0,0 +1,114 @@
+# Import libraries
+import os
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from channel_fusion import fuse_channel_detections
+
+def to_numpy(values):
+    """Boxes of a YOLO result (tensors) or of a detector daemon result (arrays) as a NumPy array."""
+    return values.cpu().numpy() if hasattr(values, "cpu") else np.asarray(values)
+
+@dataclass
+class Detections:
+    """
+    Bird song detections of one recording, one row per detected song.
+    Built once from the in-memory YOLO results and shared by every consumer (segments, zip, app, uploads).
+
+    Attributes:
+        start (np.ndarray): Start of every detection in seconds.
+        end (np.ndarray): End of every detection in seconds.
+        cls (np.ndarray): Class of every detection.
+        score (np.ndarray): Confidence score of every detection.
+        channel_scores (np.ndarray): Score of every detection in every channel, shape (N, channels).
+        duration (float): Duration of the recording in seconds.
+        indices (dict): Acoustic indices of the recording, name -> value of every channel and window (see
+            acoustic_indices.py), empty when none were computed.
+    """
+    start: np.ndarray
+    end: np.ndarray
+    cls: np.ndarray
+    score: np.ndarray
+    channel_scores: np.ndarray
+    duration: float
+    indices: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_array(cls, table, duration, indices=None):
+        """
+        Build the detections from an array with start_second, end_second, class, confidence and the per-channel scores.
+        """
+        table = np.atleast_2d(np.asarray(table, dtype=float))
+        if table.shape[1] < 4:
+            table = np.zeros((0, 5))
+        return cls(table[:, 0], table[:, 1], table[:, 2].astype(int), table[:, 3], table[:, 4:], float(duration),
+                   dict(indices or {}))
+
+    @classmethod
+    def from_results(cls, results, duration, fusion="max", snr_db=None):
+        """
+        Build the detections straight from the YOLO Results of a recording, one Results per channel.
+        The boxes of all channels are converted to seconds in a single NumPy operation, then the channels are fused.
+
+        Args:
+            results (list): ultralytics Results (or inference_service.RemoteResult), one per channel spectrogram.
+            duration (float): Duration of the recording in seconds (the width of the spectrogram).
+            fusion (str): Channel fusion policy, see channel_fusion.FUSION_POLICIES.
+            snr_db (np.ndarray, optional): SNR of every channel, needed by the "snr" policy.
+        """
+        counts = [len(result.boxes) for result in results]
+        xywhn = np.concatenate([to_numpy(result.boxes.xywhn) for result in results]).reshape(-1, 4)
+        conf = np.concatenate([to_numpy(result.boxes.conf) for result in results])
+        classes = np.concatenate([to_numpy(result.boxes.cls) for result in results])
+
+        # Normalised x_center +- width / 2 -> seconds, kept inside the recording
+        bounds = np.clip(xywhn[:, [0, 0]] + xywhn[:, [2, 2]] * [-0.5, 0.5], 0, 1) * duration
+
+        table = np.column_stack([bounds, classes, conf])
+        per_channel = np.split(table, np.cumsum(counts)[:-1])
+        return cls.from_array(fuse_channel_detections(per_channel, policy=fusion, snr_db=snr_db), duration)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load detections saved with save().
+        """
+        with open(path) as f:
+            duration = float(f.readline().split("=")[1])
+        return cls.from_array(np.loadtxt(path, ndmin=2), duration)
+
+    def __len__(self):
+        return len(self.start)
+
+    def __iter__(self):
+        """
+        Iterate over (start_second, end_second, class, confidence) of every detection.
+        """
+        return zip(self.start, self.end, self.cls, self.score)
+
+    @property
+    def x_center(self):
+        """Normalised x center of every detection on the spectrogram image."""
+        return (self.start + self.end) / (2 * self.duration)
+
+    @property
+    def width(self):
+        """Normalised width of every detection on the spectrogram image."""
+        return (self.end - self.start) / self.duration
+
+    def to_array(self):
+        """
+        Array with start_second, end_second, class, confidence followed by the score of every channel.
+        """
+        return np.column_stack([self.start, self.end, self.cls, self.score, self.channel_scores])
+
+    def save(self, output_txt_path):
+        """
+        Save the detections as text: start_second end_second class confidence score_ch0 score_ch1 ...
+        """
+        os.makedirs(os.path.dirname(output_txt_path) or ".", exist_ok=True)
+        channels = " ".join(f"score_ch{ch}" for ch in range(self.channel_scores.shape[1]))
+        header = f"duration={self.duration:.3f}\nstart_second end_second class confidence {channels}"
+        np.savetxt(output_txt_path, self.to_array(), fmt="%.4f", header=header)
+        return output_txt_path
@@ -0,0 +1,138 @@
+"""
+Sync the detection metadata of this station to the fleet ingest server (fleet/ingest_server.py).
+
+Every processed clip appends its detections to a local spool (JSON lines), so nothing is lost while the network
+is down. flush() sends the spool as one columnar, gzipped batch with a batch ID; the server ignores a batch it
+has already stored, so a batch can be retried safely until it is acknowledged. A batch the server rejects (4xx)
+would be rejected again: it is moved to <spool_dir>/rejected/ instead, and the next detections are sent.
+"""
+
+# Import libraries
+import gzip
+import json
+import os
+import re
+import socket
+import time
+import urllib.error
+import urllib.request
+import uuid
+from datetime import datetime
+
+# Recording start time from the clip name: 2025-08-22_09-44-19.wav (record_upload.py) or AM1_20230511_060000.wav
+CLIP_TIME_PATTERNS = [
+    (re.compile(r"(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})"), "%Y-%m-%d_%H-%M-%S"),
+    (re.compile(r"(\d{8}_\d{6})"), "%Y%m%d_%H%M%S"),
+]
+
+def clip_start_time(audio_path):
+    """Start of a recording in epoch seconds, from its name (local time), or from its modification time."""
+    name = os.path.basename(audio_path)
+    for pattern, fmt in CLIP_TIME_PATTERNS:
+        match = pattern.search(name)
+        if match:
+            return datetime.strptime(match.group(1), fmt).timestamp()
+    return os.path.getmtime(audio_path)
+
+class FleetSync:
+    """
+    Spool detections locally and send them to the fleet ingest server in batches.
+
+    Args:
+        server (str): Base URL of the ingest server, e.g. http://fleet.local:8088.
+        spool_dir (str): Folder of the spool and of the batch waiting for acknowledgement.
+        station (str): Station name (default: env STATION_ID or the host name).
+        batch_size (int): Send as soon as this many detections are spooled.
+        timeout (float): HTTP timeout in seconds.
+    """
+
+    def __init__(self, server, spool_dir, station=None, batch_size=500, timeout=10):
+        self.url = server.rstrip("/") + "/ingest"
+        self.station = station or os.getenv("STATION_ID") or socket.gethostname()
+        self.batch_size = batch_size
+        self.timeout = timeout
+        os.makedirs(spool_dir, exist_ok=True)
+        self.spool_path = os.path.join(spool_dir, "spool.jsonl")
+        self.pending_path = os.path.join(spool_dir, "pending.json")
+        self.rejected_dir = os.path.join(spool_dir, "rejected")
+        self.spooled = 0
+        if os.path.exists(self.spool_path):
+            with open(self.spool_path) as f:
+                self.spooled = sum(1 for _ in f)
+
+    def add(self, audio_path, detections):
+        """
+        Spool the detections of a clip, with absolute times and the key of their uploaded segment.
+        """
+        clip_start = clip_start_time(audio_path)
+        name = os.path.splitext(os.path.basename(audio_path))[0]
+        with open(self.spool_path, "a") as f:
+            for start, end, cls, score in detections:
+                # Same name as the segment written by transform_predictions_save_segment() and converted by move_file()
+                key = f"{name}_{start:.2f}_{end:.2f}_{score:.2f}.flac"
+                f.write(json.dumps({"ts": clip_start + float(start), "end": clip_start + float(end),
+                                    "score": float(score), "cls": int(cls), "key": key}) + "\n")
+                self.spooled += 1
+        if self.spooled >= self.batch_size:
+            self.flush()
+
+    def _take_batch(self):
+        """Turn the spool into the pending batch (rows to columns), unless a batch is still waiting."""
+        if os.path.exists(self.pending_path) or not os.path.exists(self.spool_path):
+            return
+        with open(self.spool_path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        if rows:
+            batch = {
+                "station": self.station,
+                "batch": f"{self.station}-{uuid.uuid4().hex}",
+                "columns": {name: [row[name] for row in rows] for name in ("ts", "end", "score", "cls", "key")},
+            }
+            tmp_path = self.pending_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(batch, f)
+            os.replace(tmp_path, self.pending_path)
+        os.remove(self.spool_path)
+        self.spooled = 0
+
+    def flush(self):
+        """
+        Send the spooled detections. Returns the number of detections stored by the server, or None when the
+        server could not be reached or failed (the batch is kept and sent again by the next flush).
+        """
+        self._take_batch()
+        if not os.path.exists(self.pending_path):
+            return 0
+        with open(self.pending_path, "rb") as f:
+            body = gzip.compress(f.read())
+        request = urllib.request.Request(self.url, data=body, method="POST",
+                                         headers={"Content-Type": "application/json", "Content-Encoding": "gzip"})
+        t0 = time.time()
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                stored = json.loads(response.read())["stored"]
+        except urllib.error.HTTPError as e:
+            if not 400 <= e.code < 500:
+                print(f"[WARN] Fleet sync to {self.url} failed, will retry: {e}")
+                return None
+            self._reject(e)
+            stored = 0
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[WARN] Fleet sync to {self.url} failed, will retry: {e}")
+            return None
+        else:
+            os.remove(self.pending_path)
+            print(f"[OK] Fleet sync: {stored} detections sent ({len(body) / 1024:.1f} KiB) in {time.time() - t0:.2f}s")
+        # A batch sent (or rejected) before a spool that reached batch_size in the meantime
+        if os.path.exists(self.spool_path) and self.spooled >= self.batch_size:
+            return stored + (self.flush() or 0)
+        return stored
+
+    def _reject(self, error):
+        """Move the pending batch the server refused to rejected/, it would hold back every later detection."""
+        os.makedirs(self.rejected_dir, exist_ok=True)
+        rejected_path = os.path.join(self.rejected_dir, f"{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.json")
+        os.replace(self.pending_path, rejected_path)
+        reason = error.read().decode(errors="replace").strip()
+        print(f"[ERROR] Fleet sync batch rejected by {self.url} ({error.code} {error.reason}: {reason}), "
+              f"moved to {rejected_path}, it will not be sent again")
@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+Local detector daemon: one copy of the model in memory for all the entry points of a board.
+
+predict_on_audio.py, predict_on_folder.py, stream_detector.py and App/app.py otherwise each load the model, and
+torch with it, which does not fit several of them on a 4 GB board. With BIRD_DETECTOR_SOCKET set, load_detector()
+connects them to this daemon instead:
+- the spectrogram images go through shared memory (multiprocessing.shared_memory). They are rendered to arrays
+  (audio_processing.render_spectrogram) and written once into a block of the caller that the daemon reads in place,
+  without PNG files; only a short JSON request and the boxes go through the Unix socket
+- the requests waiting when the model is free, from any caller, are run as one batch (up to --max-batch images,
+  waiting at most --batch-wait seconds for more)
+- the model is a ModelManager: variants (BIRD_MODEL_VARIANT) and new checkpoints in --model-dir work as in
+  predict_on_audio.py
+
+The callers import neither torch nor ultralytics. A caller started without the daemon running fails at once.
+
+Protocol, one JSON object per line:
+  -> {"shm": "psm_1f2e", "images": [{"offset": 0, "shape": [462, 930, 3]}, ...], "kwargs": {"imgsz": 320},
+      "clip": "AM1_20230511_060000.wav"}
+  -> {"images": [{"path": "/tmp/bird_stream/window.PNG"}], "kwargs": {}}
+  <- {"version": "best.pt@1715400012", "results": [{"xywhn": [[0.41, 0.5, 0.02, 1.0]], "conf": [0.71], "cls": [0]}]}
+  <- {"error": "..."}
+
+Examples:
+  python inference_service.py --model ../../Bird-Song-Detector/Models/Bird_Song_Detector/weights/best.pt
+  BIRD_DETECTOR_SOCKET=/tmp/bird-detector.sock python predict_on_audio.py
+"""
+
+# Import libraries
+import argparse
+import atexit
+import json
+import os
+import queue
+import socket
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import metrics
+from metrics import trace
+from spectrogram_cache import model_version
+
+# Model weights, the default of every entry point
+MODEL_PATH = os.getenv("BIRD_MODEL", "/opt/bird-files/Bird-Song-Detector/Models/Bird_Song_Detector/weights/best.pt")
+# Socket of the daemon the entry points use, each entry point loads its own model when unset
+DETECTOR_SOCKET = os.getenv("BIRD_DETECTOR_SOCKET")
+DEFAULT_SOCKET = "/tmp/bird-detector.sock"
+
+def load_detector(load_local):
+    """
+    Detector of an entry point: a DetectorClient of the daemon when BIRD_DETECTOR_SOCKET is set, load_local()
+    (the model of the entry point, loaded in its own process) otherwise.
+    """
+    if DETECTOR_SOCKET:
+        client = DetectorClient(DETECTOR_SOCKET)
+        print(f"Using the detector daemon on {DETECTOR_SOCKET}: {client.version}")
+        return client
+    return load_local()
+
+class RemoteBoxes:
+    """Boxes of one image detected by the daemon, as NumPy arrays named like those of ultralytics Boxes."""
+
+    def __init__(self, xywhn, conf, cls):
+        self.xywhn = np.asarray(xywhn, dtype=np.float32).reshape(-1, 4)
+        self.conf = np.asarray(conf, dtype=np.float32)
+        self.cls = np.asarray(cls, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.conf)
+
+class RemoteResult:
+    """Result of one image detected by the daemon, enough for Detections.from_results."""
+
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+class DetectorClient:
+    """
+    Connection to the detector daemon, called like a YOLO model: client(images, **kwargs) returns one result per image.
+
+    images are BGR uint8 arrays (what YOLO reads from the PNG files, see audio_processing.render_spectrogram) or paths
+    of image files readable by the daemon. The arrays are written into a shared memory block of the client, reused
+    from one call to the next and grown when needed. kwargs (imgsz, conf, ...) are passed to the model.
+    """
+
+    # detect_channels() renders the spectrograms to arrays instead of PNG files for this detector
+    takes_arrays = True
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, timeout=600):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.version = None
+        self._lock = threading.RLock()
+        self._sock = self._file = self._shm = None
+        atexit.register(self.close)
+        # Fails now when the daemon is not running, and gets the version of its model
+        self._request({"images": []})
+
+    def _connect(self):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(self.timeout)
+        self._sock.connect(self.socket_path)
+        self._file = self._sock.makefile("rwb")
+
+    def _disconnect(self):
+        if self._sock is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass  # the request still buffered for a daemon that is gone
+            self._sock.close()
+        self._sock = self._file = None
+
+    def _request(self, request):
+        line = json.dumps(request).encode() + b"\n"
+        with self._lock:
+            # A second attempt on a new connection when the daemon was restarted since the last call
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    self._file.write(line)
+                    self._file.flush()
+                    reply = self._file.readline()
+                    if not reply:
+                        raise ConnectionError(f"Detector daemon on {self.socket_path} closed the connection")
+                    break
+                except OSError:
+                    self._disconnect()
+                    if attempt:
+                        raise
+        reply = json.loads(reply)
+        if "error" in reply:
+            raise RuntimeError(f"Detector daemon: {reply['error']}")
+        self.version = reply["version"]
+        return reply
+
+    def _buffer(self, size):
+        """Shared memory block of at least size bytes."""
+        if self._shm is None or self._shm.size < size:
+            self._release()
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+        return self._shm
+
+    def _release(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def __call__(self, source, **kwargs):
+        sources = list(source) if isinstance(source, (list, tuple)) else [source]
+        arrays = [s for s in sources if isinstance(s, np.ndarray)]
+        if arrays and len(arrays) != len(sources):
+            raise ValueError("Send either arrays or image paths to the detector daemon, not both")
+        if any(a.dtype != np.uint8 or a.ndim != 3 for a in arrays):
+            raise ValueError("The detector daemon takes (height, width, 3) BGR uint8 images")
+        kwargs.pop("device", None)  # the daemon runs on its own device
+
+        with self._lock:
+            # The clip tags the trace events and profiles of the daemon too
+            images, request = [], {"kwargs": kwargs, "clip": metrics.current_clip()}
+            if arrays:
+                shm = self._buffer(sum(a.nbytes for a in arrays))
+                request["shm"] = shm.name
+                offset = 0
+                for a in arrays:
+                    np.ndarray(a.shape, np.uint8, buffer=shm.buf, offset=offset)[...] = a
+                    images.append({"offset": offset, "shape": list(a.shape)})
+                    offset += a.nbytes
+            else:
+                images = [{"path": os.path.abspath(str(s))} for s in sources]
+            request["images"] = images
+            # The block is not written again before the reply, the daemon reads it in place
+            reply = self._request(request)
+        return [RemoteResult(RemoteBoxes(**r)) for r in reply["results"]]
+
+    def start(self):
+        """Nothing to start, the daemon watches for new checkpoints (same interface as ModelManager)."""
+        return self
+
+    def stop(self):
+        pass
+
+    def close(self):
+        self._disconnect()
+        self._release()
+
+def attach(name):
+    """Attach the shared memory block of a client, which stays the owner of the block (it unlinks it)."""
+    shm = shared_memory.SharedMemory(name=name)
+    # Python < 3.13 registers the block with the resource tracker of the daemon too, which would unlink it
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+def detach(shm):
+    try:
+        shm.close()
+    except BufferError:
+        # The predictor still holds the last batch, the mapping goes with it
+        pass
+
+def result_boxes(result):
+    boxes = result.boxes
+    return {
+        "xywhn": boxes.xywhn.cpu().numpy().round(6).tolist(),
+        "conf": boxes.conf.cpu().numpy().round(6).tolist(),
+        "cls": boxes.cls.cpu().numpy().tolist(),
+    }
+
+class Job:
+    """One request of a client, done when results (or error) is set."""
+
+    def __init__(self, images, kwargs, clip=None):
+        self.images = images
+        self.kwargs = kwargs
+        self.clip = clip
+        self.results = self.error = None
+        self.done = threading.Event()
+
+    def key(self):
+        """Requests run in the same batch have the same model arguments and the same kind of images."""
+        return json.dumps(self.kwargs, sort_keys=True), isinstance(self.images[0], str)
+
+class DetectorService:
+    """
+    Unix socket server running the requests of every client on one model, see the module docstring.
+
+    Args:
+        model: YOLO model or ModelManager.
+        socket_path (str): Path of the socket.
+        max_batch (int): Images run in one model call at most (a request with more images is not split).
+        batch_wait (float): Seconds the first request waits for others to batch with.
+    """
+
+    def __init__(self, model, socket_path=DEFAULT_SOCKET, max_batch=8, batch_wait=0.01):
+        self.model = model
+        self.socket_path = socket_path
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.jobs = queue.Queue()
+        self.server = None
+
+    def bind(self):
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+                raise SystemExit(f"A detector daemon is already running on {self.socket_path}")
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.remove(self.socket_path)  # left by a daemon that was killed
+            finally:
+                probe.close()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_path)
+        self.server.listen()
+
+    def serve_forever(self):
+        if self.server is None:
+            self.bind()
+        threading.Thread(target=self._infer, name="inference", daemon=True).start()
+        try:
+            while True:
+                conn, _ = self.server.accept()
+                threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+        finally:
+            self.server.close()
+            os.remove(self.socket_path)
+
+    def _serve(self, conn):
+        blocks = {}  # shared memory blocks of the client by name
+        try:
+            with conn, conn.makefile("rwb") as f:
+                for line in f:
+                    try:
+                        reply = self._handle(json.loads(line), blocks)
+                    except Exception as e:
+                        reply = {"error": f"{type(e).__name__}: {e}"}
+                    f.write(json.dumps(reply).encode() + b"\n")
+                    f.flush()
+        except OSError:
+            pass  # client gone
+        finally:
+            for shm in blocks.values():
+                detach(shm)
+
+    def _handle(self, request, blocks):
+        images = []
+        if request.get("shm"):
+            name = request["shm"]
+            if name not in blocks:
+                # The client grew its block: the previous one is not used any more
+                for old in blocks.values():
+                    detach(old)
+                blocks.clear()
+                blocks[name] = attach(name)
+            buf = blocks[name].buf
+            images = [np.ndarray(image["shape"], np.uint8, buffer=buf, offset=image["offset"])
+                      for image in request["images"]]
+        else:
+            images = [image["path"] for image in request["images"]]
+        if not images:
+            return {"version": self.version, "results": []}
+
+        job = Job(images, request.get("kwargs") or {}, request.get("clip"))
+        self.jobs.put(job)
+        job.done.wait()
+        job.images = None
+        if job.error:
+            raise RuntimeError(job.error)
+        return {"version": self.version, "results": job.results}
+
+    @property
+    def version(self):
+        return model_version(self.model)
+
+    def _infer(self):
+        while True:
+            jobs = [self.jobs.get()]
+            # Opportunistic batching: the requests waiting, or arriving within batch_wait, up to max_batch images
+            deadline = time.monotonic() + self.batch_wait
+            while sum(len(job.images) for job in jobs) < self.max_batch:
+                try:
+                    jobs.append(self.jobs.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            batches = {}
+            for job in jobs:
+                batches.setdefault(job.key(), []).append(job)
+            for batch in batches.values():
+                self._run(batch)
+
+    def _run(self, jobs):
+        images = [image for job in jobs for image in job.images]
+        # A batch can hold the requests of several clients, its events and profile are tagged with all their clips
+        clips = list(dict.fromkeys(job.clip for job in jobs if job.clip))
+        metrics.set_clip("+".join(clips) or None)
+        try:
+            with trace("daemon_inference", images=len(images), requests=len(jobs), clips=clips) as span:
+                results = self.model(images, **{"verbose": False, **jobs[0].kwargs})
+            boxes = [result_boxes(result) for result in results]
+        except Exception as e:
+            for job in jobs:
+                job.error = f"{type(e).__name__}: {e}"
+                job.done.set()
+            return
+        print(f"Batch of {len(images)} images from {len(jobs)} requests: {span}")
+        for job in jobs:
+            job.results, boxes = boxes[:len(job.images)], boxes[len(job.images):]
+            job.done.set()
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Local detector daemon shared by the entry points of a board.")
+    p.add_argument("--model", default=MODEL_PATH, help="Model weights (env BIRD_MODEL)")
+    p.add_argument("--variant", help="fp32, int8 or nano (env BIRD_MODEL_VARIANT, see model_manager.variant_path)")
+    p.add_argument("--model-dir", default=os.getenv("BIRD_MODEL_DIR"), help="Folder watched for new checkpoints (env BIRD_MODEL_DIR)")
+    p.add_argument("--device", default="cpu", help="cpu on the stations, cuda on a Jetson or a GPU server (default: cpu)")
+    p.add_argument("--socket", default=DETECTOR_SOCKET or DEFAULT_SOCKET, help=f"Unix socket (env BIRD_DETECTOR_SOCKET, default: {DEFAULT_SOCKET})")
+    p.add_argument("--max-batch", type=int, default=8, help="Images run in one model call at most (default: 8)")
+    p.add_argument("--batch-wait", type=float, default=0.01, help="Seconds a request waits for others to batch with (default: 0.01)")
+    p.add_argument("--profile-dir", default="/tmp/bird-detector-profiles", help="Profiles of the batches, asked for by SIGUSR2 or a request file (see sampling_profiler.py)")
+    return p.parse_args()
+
+def main():
+    args = parse_args()
+    from model_manager import ModelManager
+    from sampling_profiler import install
+
+    install(args.profile_dir)
+
+    service = DetectorService(None, args.socket, max_batch=args.max_batch, batch_wait=args.batch_wait)
+    # Bound before the model is loaded, a second daemon stops before loading another copy
+    service.bind()
+    service.model = ModelManager(args.model, watch_dir=args.model_dir, device=args.device, variant=args.variant).start()
+    print(f"Detector daemon on {args.socket}: {service.version}, batches of up to {args.max_batch} images")
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopped.")
+
+if __name__ == "__main__":
+    main()
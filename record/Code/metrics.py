@@ -0,0 +1,306 @@
+"""
+Prometheus-style metrics and JSON-lines trace events for the pipeline, with no dependency besides the standard library.
+
+- Counter, Gauge and Histogram register themselves in REGISTRY and are rendered in the Prometheus text format.
+- start_http_server() serves them on http://<addr>:<port>/metrics from a daemon thread, together with the
+  *.prom files of textfile_dir, which is how separate processes such as upload_to_s3.py publish theirs
+  (write_textfile()).
+- trace(stage) times a block of code: it observes the stage latency histogram, counts errors and writes one JSON
+  line per event to the trace file set with configure(), tagged with the current clip (set_clip()).
+"""
+
+# Import libraries
+import contextvars
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        return "".join(metric.render() for metric in metrics)
+
+REGISTRY = Registry()
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_labels(self.labelnames, key)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.functions = {}
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def set_function(self, function, **labels):
+        """Evaluate function() every time the metrics are scraped."""
+        self.functions[self._key(labels)] = function
+
+    def render(self):
+        for key, function in list(self.functions.items()):
+            try:
+                value = function()
+            except Exception:
+                value = float("nan")
+            with self.lock:
+                self.values[key] = value
+        return super().render()
+
+class Histogram(_Metric):
+    kind = "histogram"
+    # Seconds, from a fast inference on a desktop to a slow spectrogram on a Pi
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            counts = [c + (value <= bound) for c, bound in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, (counts, total, count) in items:
+            for bound, c in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', f'{bound:g}')])} {c}")
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total:g}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return "\n".join(lines) + "\n"
+
+# Pipeline metrics
+STAGE_SECONDS = Histogram("bird_stage_seconds", "Latency of every pipeline stage (decode, spectrogram, inference, export, upload)", ["stage"])
+STAGE_ERRORS = Counter("bird_errors_total", "Errors raised in a pipeline stage", ["stage"])
+CLIPS = Counter("bird_clips_total", "Clips processed by the detector")
+DETECTIONS = Counter("bird_detections_total", "Bird songs detected")
+UPLOADS = Counter("bird_uploads_total", "Files handled by the uploader, by result (ok, skip, error)", ["result"])
+QUEUE_DEPTH = Gauge("bird_queue_depth", "Recordings waiting for the detector")
+LAG_SECONDS = Gauge("bird_lag_seconds", "How long ago the oldest recording waiting for the detector was recorded")
+DEGRADATION_LEVEL = Gauge("bird_degradation_level", "Cheaper detector settings in use while behind (0: none)")
+CLIPS_GATED = Counter("bird_clips_gated_total", "Clips not run through the model, below the activity gate")
+DEFERRED_EXPORTS = Gauge("bird_deferred_exports", "Clips whose export waits for the detector to catch up")
+DISK_FREE = Gauge("bird_disk_free_bytes", "Free disk space", ["path"])
+
+# Trace events
+_trace = {"path": None, "max_bytes": 10 * 1024 * 1024, "lock": threading.Lock()}
+_clip = contextvars.ContextVar("clip", default=None)
+
+# Told of the clips and stages when installed (see sampling_profiler.py)
+profiler = None
+
+def configure(trace_path=None, max_bytes=10 * 1024 * 1024):
+    """Write trace events to trace_path (JSON lines), rotated to <trace_path>.1 above max_bytes."""
+    if trace_path:
+        os.makedirs(os.path.dirname(trace_path) or ".", exist_ok=True)
+    _trace.update(path=trace_path, max_bytes=max_bytes)
+
+def set_clip(clip):
+    """Tag the following trace events with a clip ID."""
+    _clip.set(clip)
+    if profiler is not None:
+        profiler.clip(clip)
+
+def current_clip():
+    return _clip.get()
+
+def event(stage, **fields):
+    """Write one trace event."""
+    path = _trace["path"]
+    if not path:
+        return
+    record = {"ts": round(time.time(), 3), "stage": stage, "clip": _clip.get(), "pid": os.getpid(), **fields}
+    with _trace["lock"]:
+        if os.path.exists(path) and os.path.getsize(path) > _trace["max_bytes"]:
+            os.replace(path, path + ".1")
+        with open(path, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+class Span:
+    duration = 0.0
+
+    def __str__(self):
+        return f"{self.duration:.3f}s"
+
+@contextmanager
+def trace(stage, **fields):
+    """
+    Time a pipeline stage: observe its latency, count its errors and write a trace event.
+
+    Usage:
+        with trace("inference") as span:
+            ...
+        print("Model extraction: ", span)
+    """
+    span = Span()
+    hook = profiler
+    if hook is not None:
+        hook.push(stage)
+    t0 = time.perf_counter()
+    status = "ok"
+    try:
+        yield span
+    except BaseException as e:
+        status = f"error: {e!r}"
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        span.duration = time.perf_counter() - t0
+        if hook is not None:
+            hook.pop()
+        STAGE_SECONDS.observe(span.duration, stage=stage)
+        event(stage, duration=round(span.duration, 4), status=status, **fields)
+
+def watch_disk(path):
+    """Report the free space of the disk holding path."""
+    import shutil
+    DISK_FREE.set_function(lambda: shutil.disk_usage(path).free, path=path)
+
+def _families(text):
+    """Split a Prometheus text exposition into {family: (header lines, sample lines)}, keeping the order."""
+    families = {}
+    name = None
+    for line in text.splitlines():
+        if line.startswith("# HELP ") or line.startswith("# TYPE "):
+            name = line.split()[2]
+            families.setdefault(name, ([], []))[0].append(line)
+        elif line and not line.startswith("#") and name is not None:
+            families[name][1].append(line)
+    return families
+
+def render(textfile_dir=None):
+    """
+    Metrics of this process merged with the *.prom files published by the other processes.
+    Samples of the same family are grouped under a single HELP/TYPE header, as the text format requires.
+    """
+    merged = _families(REGISTRY.render())
+    for path in sorted(glob.glob(os.path.join(textfile_dir, "*.prom"))) if textfile_dir else []:
+        with open(path) as f:
+            for name, (header, samples) in _families(f.read()).items():
+                merged.setdefault(name, (header, []))[1].extend(samples)
+    return "".join("\n".join(header + samples) + "\n" for header, samples in merged.values())
+
+def restore_textfile(path, registry=REGISTRY):
+    """
+    Load back the counters and histograms of a file written by write_textfile(), so that a process started
+    periodically (e.g. upload_to_s3.py) keeps counting from its previous totals instead of resetting them.
+    """
+    if not os.path.exists(path):
+        return
+    samples = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip() and not line.startswith("#"):
+                key, value = line.rsplit(" ", 1)
+                samples[key] = float(value)
+
+    for metric in registry.metrics:
+        for key in _sample_keys(metric, samples):
+            labels = _labels(metric.labelnames, key)
+            if isinstance(metric, Counter):
+                metric.values[key] = samples[f"{metric.name}{labels}"]
+            else:
+                counts = [int(samples[f"{metric.name}_bucket{_labels(metric.labelnames, key, [('le', f'{b:g}')])}"])
+                          for b in metric.buckets]
+                metric.values[key] = (counts, samples[f"{metric.name}_sum{labels}"],
+                                      int(samples[f"{metric.name}_count{labels}"]))
+
+def _sample_keys(metric, samples):
+    """Label values of the samples of a counter or histogram found in a parsed textfile."""
+    if not isinstance(metric, (Counter, Histogram)):
+        return
+    suffix = "_count" if isinstance(metric, Histogram) else ""
+    prefix = metric.name + suffix
+    for key in samples:
+        name, _, labels = key.partition("{")
+        if name != prefix:
+            continue
+        pairs = dict(pair.split("=", 1) for pair in labels.rstrip("}").split(",") if pair)
+        yield tuple(pairs.get(label, '""').strip('"') for label in metric.labelnames)
+
+def write_textfile(path):
+    """Publish the metrics of this (short-lived) process for start_http_server() of the long-running one."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(REGISTRY.render())
+    os.replace(tmp_path, path)
+
+def start_http_server(port, addr="127.0.0.1", textfile_dir=None):
+    """Serve the metrics on http://addr:port/metrics from a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = render(textfile_dir).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # do not flood the nohup logs with scrapes
+
+    server = ThreadingHTTPServer((addr, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"Metrics served on http://{addr}:{port}/metrics")
+    return server
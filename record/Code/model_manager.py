@@ -0,0 +1,280 @@
+# Import libraries
+import glob
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+import numpy as np
+from ultralytics import YOLO
+
+from channel_fusion import interval_iou
+
+# Shadow runs waiting for the shadow thread at most, the next ones are dropped until it catches up
+SHADOW_QUEUE = 2
+
+# Variants of a checkpoint written by compress_model.py next to it, picked with env BIRD_MODEL_VARIANT
+MODEL_VARIANTS = {"fp32": "{stem}.pt", "int8": "{stem}_int8.onnx", "nano": "{stem}_nano.pt"}
+
+def variant_path(model_path, variant=None):
+    """
+    Path of a variant of a checkpoint: best.pt -> best_int8.onnx (int8) or best_nano.pt (nano).
+
+    Args:
+        model_path (str): The fp32 checkpoint.
+        variant (str): fp32, int8 or nano, env BIRD_MODEL_VARIANT when None (default fp32).
+    """
+    variant = variant or os.getenv("BIRD_MODEL_VARIANT") or "fp32"
+    if variant not in MODEL_VARIANTS:
+        raise ValueError(f"Unknown model variant {variant!r}, expected one of {', '.join(MODEL_VARIANTS)}")
+    folder, name = os.path.split(model_path)
+    return os.path.join(folder, MODEL_VARIANTS[variant].format(stem=os.path.splitext(name)[0]))
+
+def is_variant(path):
+    """Variants and exports written next to a checkpoint (best_int8.onnx, best_nano.pt, best.onnx), not checkpoints."""
+    name = os.path.basename(path)
+    suffixes = [pattern.format(stem="") for pattern in MODEL_VARIANTS.values() if pattern != "{stem}.pt"]
+    return not name.endswith(".pt") or any(name.endswith(suffix) for suffix in suffixes)
+
+def own_images(source):
+    """
+    Copy of the images of a model call the caller cannot reuse or delete: arrays are copied (they can be views of the
+    shared memory of the detector daemon), image files are read.
+    """
+    import cv2
+
+    def own(image):
+        return image.copy() if isinstance(image, np.ndarray) else cv2.imread(str(image))
+    return [own(image) for image in source] if isinstance(source, (list, tuple)) else own(source)
+
+def checkpoint_version(model_path):
+    """Name and modification time of a checkpoint, enough to tell two checkpoints apart in the logs."""
+    return f"{os.path.basename(model_path)}@{int(os.path.getmtime(model_path))}"
+
+def result_intervals(result):
+    """Normalised (start, end) of the boxes of one YOLO result along the time axis."""
+    xywhn = result.boxes.xywhn.cpu().numpy().reshape(-1, 4)
+    return np.column_stack([xywhn[:, 0] - xywhn[:, 2] / 2, xywhn[:, 0] + xywhn[:, 2] / 2])
+
+def detection_agreement(results_a, results_b, iou_threshold=0.5):
+    """
+    Agreement between two models on the same images: share of the detections of both models that overlap
+    (IoU >= iou_threshold) a detection of the other model. 1.0 when neither model detects anything.
+    """
+    matched = total = 0
+    for a, b in zip(results_a, results_b):
+        intervals_a, intervals_b = result_intervals(a), result_intervals(b)
+        total += len(intervals_a) + len(intervals_b)
+        if len(intervals_a) and len(intervals_b):
+            overlap = interval_iou(intervals_a, intervals_b) >= iou_threshold
+            matched += overlap.any(axis=1).sum() + overlap.any(axis=0).sum()
+    return matched / total if total else 1.0
+
+class ModelManager:
+    """
+    Production detector that can be updated without restarting the pipeline.
+
+    A background thread watches watch_dir for new fp32 checkpoints (*.pt, not the variants, see is_variant). Once
+    the variant in use of a new checkpoint is written too (compress_model.py), it is loaded and warmed up in that
+    thread, then either swapped in atomically or, with shadow_fraction > 0, kept as a candidate that also runs on
+    that fraction of the clips. Shadow runs are done by another background thread, off the path of the clips, and
+    dropped while SHADOW_QUEUE of them are waiting. The agreement and latency of every shadow run are logged as
+    JSON lines.
+    The candidate is promoted after promote_after shadow clips, or as soon as a file named "promote" appears
+    in watch_dir (promote_after=0 waits for that file).
+
+    The manager is called like a YOLO model: model(images, **kwargs) returns the production results.
+    model_path is the fp32 checkpoint, the variant of it that is loaded is chosen with variant (env
+    BIRD_MODEL_VARIANT, see variant_path).
+    """
+
+    def __init__(self, model_path, watch_dir=None, device="cpu", shadow_fraction=0.0, promote_after=0,
+                 poll_interval=30, settle_time=10, shadow_log=None, variant=None):
+        self.variant = variant
+        self.watch_dir = watch_dir
+        self.device = device
+        self.shadow_fraction = shadow_fraction
+        self.promote_after = promote_after
+        self.poll_interval = poll_interval
+        self.settle_time = settle_time
+        self.shadow_log = shadow_log or (os.path.join(watch_dir, "shadow.jsonl") if watch_dir else None)
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._seen = {os.path.abspath(model_path)}
+        self._shadow_runs = []
+        self._shadow_queue = queue.Queue(maxsize=SHADOW_QUEUE)
+        self._shadow_thread = None
+        self.shadow_dropped = 0
+
+        # (model, version) pairs, replaced as a whole so that a clip never sees half a swap
+        self._production = self._load(variant_path(model_path, variant))
+        self._candidate = None
+        # Only checkpoints newer than the last one loaded are loaded: last.pt or the epochs of a training run left
+        # in watch_dir are never swapped in
+        self._loaded_mtime = os.path.getmtime(model_path)
+
+    @property
+    def version(self):
+        return self._production[1]
+
+    def _load(self, model_path):
+        model = YOLO(model_path, task="detect")
+        # Warm up, the first inference is several times slower than the next ones
+        _ = model(np.zeros((320, 640, 3), dtype=np.uint8), device=self.device, verbose=False)
+        version = checkpoint_version(model_path)
+        print(f"Model loaded: {version} on {self.device}")
+        return model, version
+
+    def __call__(self, source, **kwargs):
+        kwargs.setdefault("device", self.device)
+        with self._lock:
+            (model, version), candidate = self._production, self._candidate
+
+        t0 = time.perf_counter()
+        results = model(source, **kwargs)
+        latency = time.perf_counter() - t0
+
+        if candidate is not None and random.random() < self.shadow_fraction:
+            self._queue_shadow(candidate, source, kwargs, results, version, latency)
+        return results
+
+    def _queue_shadow(self, candidate, source, kwargs, results, version, latency):
+        if self._shadow_queue.full():
+            self.shadow_dropped += 1
+            print(f"[WARN] Shadow run dropped, {SHADOW_QUEUE} waiting ({self.shadow_dropped} dropped)")
+            return
+        with self._lock:
+            if self._shadow_thread is None:
+                self._shadow_thread = threading.Thread(target=self._shadow_worker, name="model-shadow", daemon=True)
+                self._shadow_thread.start()
+        try:
+            self._shadow_queue.put_nowait((candidate, own_images(source), kwargs, results, version, latency))
+        except queue.Full:
+            self.shadow_dropped += 1
+
+    def _shadow_worker(self):
+        while not self._stop.is_set():
+            try:
+                job = self._shadow_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                self._shadow(*job)
+            except Exception as e:
+                print(f"[WARN] Shadow run: {e}")
+            finally:
+                self._shadow_queue.task_done()
+
+    def _shadow(self, candidate, source, kwargs, results, version, latency):
+        model, candidate_version = candidate
+        t0 = time.perf_counter()
+        candidate_results = model(source, **kwargs)
+        candidate_latency = time.perf_counter() - t0
+
+        record = {
+            "time": time.time(),
+            "production": version,
+            "candidate": candidate_version,
+            "agreement": round(float(detection_agreement(results, candidate_results)), 4),
+            "production_detections": sum(len(r.boxes) for r in results),
+            "candidate_detections": sum(len(r.boxes) for r in candidate_results),
+            "production_latency": round(latency, 4),
+            "candidate_latency": round(candidate_latency, 4),
+        }
+        print(f"Shadow {candidate_version}: agreement {record['agreement']:.2f}, "
+              f"latency {candidate_latency:.2f}s vs {latency:.2f}s")
+        if self.shadow_log:
+            with open(self.shadow_log, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+        with self._lock:
+            if self._candidate is candidate:
+                self._shadow_runs.append(record)
+
+    def swap(self, loaded):
+        """Make a loaded (model, version) pair the production model."""
+        with self._lock:
+            previous = self._production[1]
+            self._production, self._candidate, self._shadow_runs = loaded, None, []
+        print(f"Model swapped: {previous} -> {loaded[1]}")
+
+    def summary(self):
+        """Mean agreement and latencies of the shadow runs of the current candidate."""
+        with self._lock:
+            runs = list(self._shadow_runs)
+        if not runs:
+            return None
+        return {
+            "candidate": runs[-1]["candidate"],
+            "clips": len(runs),
+            "agreement": float(np.mean([r["agreement"] for r in runs])),
+            "production_latency": float(np.mean([r["production_latency"] for r in runs])),
+            "candidate_latency": float(np.mean([r["candidate_latency"] for r in runs])),
+        }
+
+    def _newest_checkpoint(self):
+        """
+        Newest checkpoint of watch_dir not seen yet and newer than the last one loaded, once neither it nor its variant
+        in use has been written to for settle_time seconds. The other checkpoints found are marked seen too, so they
+        are never loaded later.
+        """
+        checkpoints = [os.path.abspath(p) for p in glob.glob(os.path.join(self.watch_dir, "*.pt")) if not is_variant(p)]
+        checkpoints = [p for p in checkpoints if p not in self._seen and self._settled(p)
+                       and self._settled(variant_path(p, self.variant))]
+        self._seen.update(checkpoints)
+        checkpoints = [p for p in checkpoints if os.path.getmtime(p) > self._loaded_mtime]
+        return max(checkpoints, key=os.path.getmtime) if checkpoints else None
+
+    def _settled(self, path):
+        return os.path.exists(path) and time.time() - os.path.getmtime(path) > self.settle_time
+
+    def poll(self):
+        """Check watch_dir once: load a new checkpoint and/or promote the candidate."""
+        checkpoint = self._newest_checkpoint()
+        if checkpoint:
+            self._loaded_mtime = os.path.getmtime(checkpoint)
+            try:
+                loaded = self._load(variant_path(checkpoint, self.variant))
+            except Exception as e:
+                print(f"[WARN] Could not load {checkpoint}: {e}")
+                loaded = None
+            if loaded and self.shadow_fraction > 0:
+                with self._lock:
+                    self._candidate, self._shadow_runs = loaded, []
+                print(f"Model {loaded[1]} running in shadow mode on {self.shadow_fraction:.0%} of the clips")
+            elif loaded:
+                self.swap(loaded)
+
+        candidate = self._candidate
+        if candidate is None:
+            return
+        promote_file = os.path.join(self.watch_dir, "promote")
+        if os.path.exists(promote_file):
+            os.remove(promote_file)
+            print(f"Promoting {candidate[1]}: {self.summary()}")
+            self.swap(candidate)
+        elif self.promote_after and len(self._shadow_runs) >= self.promote_after:
+            print(f"Promoting {candidate[1]} after {len(self._shadow_runs)} shadow clips: {self.summary()}")
+            self.swap(candidate)
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"[WARN] Model watcher: {e}")
+
+    def start(self):
+        """Start watching watch_dir in a background thread (no-op without watch_dir)."""
+        if self.watch_dir and self._thread is None:
+            os.makedirs(self.watch_dir, exist_ok=True)
+            self._thread = threading.Thread(target=self._watch, name="model-watcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
@@ -19,75 +19,121 @@ Variables:
 """
 
 # Import libraries
-from ultralytics import YOLO
+# Only light modules at import time: ultralytics, librosa, matplotlib... are imported by the functions that need
+# them, so that the metrics server and the uploads are up within a second of a (re)boot
 import os
-import numpy as np
-import pandas as pd
-from ultralytics.utils.ops import Profile
-from audio_processing import save_spectrogram_from_audio, transform_coordinates_to_seconds, transform_predictions_save_segment
-import librosa
-import soundfile as sf
-from zipfile import ZipFile
-import tempfile
 import sys
 import time 
 import glob
+import subprocess
 from pathlib import Path
 
-import subprocess
+import multiprocessing
 from multiprocessing import Process
 
-model = YOLO("/opt/bird-files/Bird-Song-Detector/Models/Bird_Song_Detector/weights/best.pt")
-brank = np.zeros((320, 640, 3), dtype=np.uint8)
-_ = model(brank, device="cpu")
-# model.to("cuda") # pi has no gpu!!
-# print("Model device:", next(model.model.parameters()).device)
-print("Model device: CPU")
-
-def extract_segments_and_save_zip_from_txt(audio_path: str, segments_txt_path: str, output_zip_path: str = None):
+import metrics
+from metrics import trace
+from fleet_sync import FleetSync
+from content_index import ContentIndex, file_sha256
+
+# Folder watched for new checkpoints that are swapped in without restarting (the weights are BIRD_MODEL, see
+# inference_service.py)
+MODEL_DIR = os.getenv("BIRD_MODEL_DIR")
+# Fraction of the clips a new checkpoint runs on in shadow mode before it is promoted (0 = swap immediately)
+SHADOW_FRACTION = float(os.getenv("BIRD_SHADOW_FRACTION", "0"))
+SHADOW_PROMOTE_AFTER = int(os.getenv("BIRD_SHADOW_PROMOTE_AFTER", "0"))
+
+# Loaded by load_model(), the slowest part of a cold start. With BIRD_DETECTOR_SOCKET set, the model of the detector
+# daemon shared with the other entry points is used instead (see inference_service.py)
+model = None
+
+def load_local_model():
+    from inference_service import MODEL_PATH
+    from model_manager import ModelManager
+    return ModelManager(MODEL_PATH, watch_dir=MODEL_DIR, device="cpu", shadow_fraction=SHADOW_FRACTION, promote_after=SHADOW_PROMOTE_AFTER) # pi has no gpu!!
+
+def load_model():
+    global model
+    if model is None:
+        from inference_service import load_detector
+        model = load_detector(load_local_model)
+    return model
+
+# How the detections of the channels of a recording are merged: max, union or snr (see channel_fusion.py)
+CHANNEL_FUSION = os.getenv("CHANNEL_FUSION", "max")
+
+# What is exported for upload: "segments" (one file per detection), "clip" (the whole clip at full quality only
+# around the detections, see detection_codec.py) or "both"
+EXPORT_MODES = ("segments", "clip", "both")
+EXPORT_MODE = os.getenv("EXPORT_MODE", "segments")
+EXPORT_PADDING = float(os.getenv("EXPORT_PADDING", "1.0"))
+EXPORT_CONTEXT = os.getenv("EXPORT_CONTEXT", "downsample")
+
+# Metrics served on http://127.0.0.1:METRICS_PORT/metrics, trace events and uploader metrics in METRICS_DIR
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+METRICS_DIR = os.getenv("METRICS_DIR", "/opt/bird-files/record/metrics")
+# Stack profiles of the next clips on SIGUSR2 or echo N > PROFILE_DIR/request (see sampling_profiler.py)
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(METRICS_DIR, "profiles"))
+
+# Fleet ingest server the detection metadata is sent to (see fleet/ingest_server.py), disabled when unset
+FLEET_SERVER = os.getenv("FLEET_SERVER")
+FLEET_SPOOL_DIR = os.getenv("FLEET_SPOOL_DIR", "/opt/bird-files/record/fleet_spool")
+
+# Spectrogram tile pyramid of every day for fleet/tile_viewer.py, disabled when unset (see tile_pyramid.py)
+TILE_PYRAMID_DIR = os.getenv("TILE_PYRAMID_DIR")
+
+# host:port of triggered_capture.py: the detections of every clip are sent there to keep their high-rate audio
+CAPTURE_TRIGGER = os.getenv("CAPTURE_TRIGGER")
+
+# Wait while the recorder writes the next clip, shorter when the recorder is simulated faster than real time
+POLL_SECONDS = float(os.getenv("POLL_SECONDS", "30"))
+
+# Lag budget against the recorder in seconds: further behind, cheaper settings are used until the detector has
+# caught up (see deadline.py), 0 always keeps the full settings. CLIP_ORDER=newest takes the newest clip first.
+LAG_BUDGET = float(os.getenv("LAG_BUDGET", "300"))
+CLIP_ORDER = os.getenv("CLIP_ORDER", "oldest")
+# SNR (dB) a clip must reach on one channel to be run through the model while far behind
+ACTIVITY_MIN_SNR = float(os.getenv("ACTIVITY_MIN_SNR", "3"))
+
+# Soundscape indices of every minute computed from the STFT of the spectrograms and uploaded next to the detections
+# as <clip>_indices.csv (see acoustic_indices.py), comma separated, empty to skip them
+ACOUSTIC_INDICES = os.getenv("ACOUSTIC_INDICES", "aci,ndsi,bi,entropy")
+
+def extract_segments_and_save_zip(audio_path: str, detections, output_zip_path: str = None):
     """
-    Extracts audio segments based on a .txt file containing start_second, end_second, class, and confidence.
-    Saves all extracted segments as .wav files in a zip archive.
+    Extracts the audio segment of every detection and saves them as .wav files in a zip archive.
 
     Args:
         audio_path (str): Path to the original audio file.
-        segments_txt_path (str): Path to the TXT file with transformed predictions.
+        detections (Detections): Detections of the audio file (start_second, end_second, class, confidence).
         output_zip_path (str, optional): Path to the output ZIP file. Defaults to <audio_name>_segments.zip.
     """
+    import tempfile
+    from zipfile import ZipFile
+
+    import librosa
+    import soundfile as sf
+
     if not os.path.exists(audio_path):
         print(f"Audio file not found: {audio_path}")
         return
-    if not os.path.exists(segments_txt_path):
-        print(f"Prediction TXT file not found: {segments_txt_path}")
+    if not len(detections):
+        print("No valid segments found.")
         return
 
     audio_name = os.path.basename(audio_path).rsplit('.', 1)[0]
-    output_zip_path = output_zip_path or f"/opt/bird-files/record/Code/runs/detect/predict/{audio_name}_segments.zip"
-
-    # Load audio
-    y, sr = librosa.load(audio_path, sr=None)
-
-    # Read segments
-    segments = []
-    with open(segments_txt_path, 'r') as f:
-        for idx, line in enumerate(f):
-            parts = line.strip().split()
-            if len(parts) < 4:
-                continue  # Skip malformed lines
-            start, end, cls, conf = map(float, parts[:4])
-            segments.append((idx, start, end, int(cls), conf))
-
-    if not segments:
-        print("No valid segments found.")
-        return
+    output_zip_path = output_zip_path or str(DATA_ROOT / "Code" / "runs" / "detect" / "predict" / f"{audio_name}_segments.zip")
+
+    # Load audio, keeping every channel
+    y, sr = librosa.load(audio_path, sr=None, mono=False)
 
     with tempfile.TemporaryDirectory() as tmpdir:
         wav_paths = []
-        for idx, start, end, cls, conf in segments:
-            segment = y[int(start * sr):int(end * sr)]
+        for idx, (start, end, cls, conf) in enumerate(detections):
+            segment = y[..., int(start * sr):int(end * sr)]
             filename = f"{audio_name}_segment_{idx}_class{cls}_conf{conf:.2f}.wav"
             out_path = os.path.join(tmpdir, filename)
-            sf.write(out_path, segment, sr)
+            sf.write(out_path, segment.T, sr)
             wav_paths.append(out_path)
 
         with ZipFile(output_zip_path, 'w') as zipf:
@@ -96,44 +142,119 @@ def extract_segments_and_save_zip_from_txt(audio_path: str, segments_txt_path: s
 
     print(f"Extracted {len(wav_paths)} segments and saved to: {output_zip_path}")
 
-def run(audio_path):
-    # Load model (Bird Song Detector from BIRDeep)
-    
+def run(audio_path, fusion=CHANNEL_FUSION, export_mode=EXPORT_MODE, settings=None):
+    """
+    Detect and export one clip. settings are the cheaper settings of deadline.DeadlineController (imgsz, params,
+    min_snr_db, defer_export), none by default.
+    """
+    from acoustic_indices import parse_indices
+    from audio_processing import detect_channels
+
     # Clean the output folder
     import shutil
 
     # Clean the output folder
     shutil.rmtree('runs', ignore_errors=True)
 
-    audio_name = os.path.basename(audio_path).replace(".wav", "")
-    # Audio has to be converted to spectrogram and saved as image
-    with Profile() as dt:
-        image_path = save_spectrogram_from_audio(audio_path)
-    print("Spectrogram extraction: ",dt)
-
-    with Profile() as dtmodel:
-        model(image_path, save_txt=True, save_conf=True)
-    print("Model extraction: ",dtmodel)
-    # Read txt in the output folder
-    predictions_txt = f"/opt/bird-files/record/Code/runs/detect/predict/labels/{audio_name}.txt"
-
-    if os.path.exists(predictions_txt):
-        # Convert to start_second, end_second, class, confidence score:
-        transform_predictions_save_segment(audio_path, predictions_txt)
-        extract_segments_and_save_zip_from_txt(audio_path, predictions_txt)
-
-    else:
-        print(f"No detections for {audio_path}")
+    settings = settings or {}
+    metrics.set_clip(os.path.basename(audio_path))
+    with trace("clip", **{k: v for k, v in settings.items() if k != "params"}) as dtclip:
+        # Every channel is converted to a spectrogram, detected in one batch and the channels are fused
+        detections = detect_channels(load_model(), audio_path, fusion=fusion, params=settings.get("params"),
+                                     imgsz=settings.get("imgsz"), min_snr_db=settings.get("min_snr_db"),
+                                     indices=parse_indices(ACOUSTIC_INDICES))
+        metrics.CLIPS.inc()
+        metrics.DETECTIONS.inc(len(detections))
+
+        # Deferred: the clip is kept by defer_export() once the other consumers are done with it
+        if not (settings.get("defer_export") and len(detections)):
+            export(audio_path, detections, export_mode)
+    print("Clip processed in ", dtclip)
+
+    return detections
+
+def check_export_mode(export_mode):
+    if export_mode not in EXPORT_MODES:
+        raise ValueError(f"Unknown export mode {export_mode!r} (EXPORT_MODE), expected one of {', '.join(EXPORT_MODES)}")
+
+def export(audio_path, detections, export_mode=EXPORT_MODE):
+    from audio_processing import transform_predictions_save_segment
+    from detection_codec import encode_clip, CONTAINER_SUFFIX
+
+    check_export_mode(export_mode)
+    with trace("export", mode=export_mode, detections=len(detections)):
+        if not len(detections):
+            print(f"No detections for {audio_path}")
+
+        elif export_mode in ("segments", "both"):
+            transform_predictions_save_segment(audio_path, detections, output_dir=str(SEGMENTS_DIR))
+            extract_segments_and_save_zip(audio_path, detections)
+
+        if export_mode in ("clip", "both"):
+            # Straight to the upload folder, the container is already compressed
+            clip_name = os.path.splitext(os.path.basename(audio_path))[0] + CONTAINER_SUFFIX
+            encode_clip(audio_path, detections, str(DEST_DIR / clip_name), padding=EXPORT_PADDING, context=EXPORT_CONTEXT)
+
+def defer_export(audio_path, detections):
+    """Keep the clip and its detections in DEFERRED_DIR until export_deferred() exports them."""
+    DEFERRED_DIR.mkdir(parents=True, exist_ok=True)
+    name = os.path.basename(audio_path)
+    detections.save(str(DEFERRED_DIR / name.replace(".wav", "_detections.txt")))
+    os.replace(audio_path, DEFERRED_DIR / name)
+    print(f"[LAG] Export of {name} deferred ({len(detections)} detections)")
+
+def export_deferred():
+    """Export the oldest clip deferred while the detector was behind. False when there is none."""
+    from detections import Detections
+
+    clips = sorted(DEFERRED_DIR.glob("*.wav")) if DEFERRED_DIR.exists() else []
+    if not clips:
+        return False
+    audio_path = str(clips[0])
+    detections_path = audio_path.replace(".wav", "_detections.txt")
+    metrics.set_clip(os.path.basename(audio_path))
+    export(audio_path, Detections.load(detections_path))
+    os.remove(audio_path)
+    os.remove(detections_path)
+    print(f"Deferred export finished of {audio_path}")
+    return True
+
+def waiting_clips(target_dir):
+    """Paths of the finished recordings not processed yet (the newest .wav is still being recorded)."""
+    return [os.path.join(target_dir, f) for f in sorted(f for f in os.listdir(target_dir) if f.endswith(".wav"))[:-1]]
 
 # def upload():
 #     subprocess.run(["bash", "/opt/bird-files/record/upload.sh"])
 
+# upload_to_s3.py lives in record/, next to Code/
+UPLOADER_DIR = str(Path(__file__).resolve().parent.parent)
+
 def upload_to_s3(target_dir):
-    subprocess.run(["python", "upload_to_s3.py", "--dir", target_dir, "--delete"], check=False)
+    import upload_to_s3 as uploader
+    try:
+        uploader.main(["--dir", target_dir, "--delete", "--metrics-dir", METRICS_DIR, "--index", CONTENT_INDEX])
+    except SystemExit as e:
+        print(f"[WARN] Upload exited with {e.code}")
 
-DATA_ROOT = Path("/opt/bird-files/record")
+def uploader_context():
+    """
+    Uploads run in processes forked from a server process that imported boto3 once at start-up, instead of a new
+    interpreter importing boto3 again every time. The server does not share the state of this process (metrics).
+    """
+    sys.path.insert(0, UPLOADER_DIR)
+    import upload_to_s3 as uploader
+    ctx = multiprocessing.get_context("forkserver")
+    ctx.set_forkserver_preload(["__main__", "upload_to_s3"] + uploader.BOTO3_MODULES)
+    return ctx
+
+# Root of the station folders, another root runs the same loop elsewhere (see simulate_station.py)
+DATA_ROOT = Path(os.getenv("STATION_ROOT", "/opt/bird-files/record"))
 SEGMENTS_DIR = DATA_ROOT / "data_temp" / "Segments"
+# Clips detected while behind, exported once caught up (see deadline.py)
+DEFERRED_DIR = DATA_ROOT / "data_temp" / "Deferred"
 DEST_DIR = DATA_ROOT / "data"
+# Hashes of the exported and uploaded files, shared with upload_to_s3.py (see content_index.py)
+CONTENT_INDEX = os.getenv("CONTENT_INDEX", str(DATA_ROOT / "content_index.sqlite"))
 
 def move_file(src_path: str):
     src = Path(src_path)
@@ -152,6 +273,18 @@ def move_file(src_path: str):
         stem = stem[:-5]
     dest_name = stem + ".flac"
 
+    # Same audio already exported under another name (reprocessed clip, replayed test audio, retried run):
+    # keep the name -> content mapping but do not encode and upload the bytes again
+    index = ContentIndex(CONTENT_INDEX)
+    source_hash = file_sha256(src)
+    existing = index.name_for_source(source_hash)
+    if existing:
+        index.add_name(dest_name, source_hash=source_hash)
+        index.close()
+        src.unlink()
+        print(f"[DUP] {src} has the same content as {existing}, not exported again")
+        return
+
     # Place in /opt/bird-files/record/data/
     dest = DEST_DIR / dest_name
     dest.parent.mkdir(parents=True, exist_ok=True)
@@ -161,43 +294,104 @@ def move_file(src_path: str):
 
     # Run converter; convert.sh removes input only if ffmpeg succeeds
     subprocess.run(
-        ["bash", "/opt/bird-files/record/convert.sh", str(src), str(tmp_out)],
+        ["bash", str(DATA_ROOT / "convert.sh"), str(src), str(tmp_out)],
         check=True,
     )
 
     # Atomic finalize
     tmp_out.rename(dest)
+    index.add_name(dest_name, source_hash=source_hash)
+    index.close()
     print(f"[OK] Converted {src} → {dest}")
 
-if __name__ == "__main__":
-    target_dir = "/opt/bird-files/record/data_temp/Audios"
-    result_dir = "/opt/bird-files/record/data_temp/Segments/"
+def main():
+    from acoustic_indices import save_indices
+    from audio_processing import image_path_for
+    from deadline import DeadlineController
+    from sampling_profiler import install
+
+    # Fail at start-up rather than at the first clip with detections
+    check_export_mode(EXPORT_MODE)
+
+    target_dir = str(DATA_ROOT / "data_temp" / "Audios")
+    result_dir = str(SEGMENTS_DIR) + "/"
+
+    metrics.configure(os.path.join(METRICS_DIR, "traces.jsonl"))
+    install(PROFILE_DIR)
+    metrics.QUEUE_DEPTH.set_function(lambda: len(waiting_clips(target_dir)))
+    metrics.DEFERRED_EXPORTS.set_function(lambda: len(list(DEFERRED_DIR.glob("*.wav"))) if DEFERRED_DIR.exists() else 0)
+    metrics.watch_disk(str(DATA_ROOT))
+    metrics.start_http_server(METRICS_PORT, textfile_dir=METRICS_DIR)
+    fleet = FleetSync(FLEET_SERVER, FLEET_SPOOL_DIR) if FLEET_SERVER else None
+    uploads = uploader_context()
+
+    t0 = time.perf_counter()
+    load_model().start()
+    print(f"Model ready in {time.perf_counter() - t0:.1f}s")
+    if TILE_PYRAMID_DIR:
+        from tile_pyramid import TilePyramid
+        pyramid = TilePyramid(TILE_PYRAMID_DIR)
+    else:
+        pyramid = None
+    deadline = DeadlineController(LAG_BUDGET, policy=CLIP_ORDER, min_snr_db=ACTIVITY_MIN_SNR)
 
     count = 10
     while True:
         if count > 9:
             count = 0
-            p = Process(target=upload_to_s3, args=(target_dir,)) # fix the upload to upload to server
+            # The exported files, like upload_to_s3.sh: uploading target_dir with --delete removed clips that
+            # were still queued or being recorded
+            p = uploads.Process(target=upload_to_s3, args=(str(DEST_DIR),))
             p.start()
+            if fleet:
+                fleet.flush()
         
         files = os.listdir(target_dir)
         if len(files) == 1:
-            print("Now recording...")
-            time.sleep(30)
-            continue
+            # Nothing to detect: export a clip deferred while behind, or wait for the recorder
+            if not (deadline.level == 0 and export_deferred()):
+                print("Now recording...")
+                time.sleep(POLL_SECONDS)
+                continue
         
         files = [file for file in files if file.endswith(".wav")]
         files.sort()
 
         files = files[:-1] # remove the last file
+        if deadline.policy == "newest":
+            # One clip per pass, so that a clip recorded meanwhile is taken before the older ones
+            files = deadline.order(files)[:1]
         for file in files:
             file = os.path.join(target_dir, file)
-            run(file)
+            settings = deadline.update(waiting_clips(target_dir))
+            detections = run(file, settings=settings)
+            if detections.indices:
+                # Every clip, with or without detections
+                save_indices(str(DEST_DIR / os.path.basename(file).replace(".wav", "_indices.csv")), detections.indices)
+            if len(detections):
+                # Keep the per-channel scores next to the segments that get uploaded
+                detections.save(str(DEST_DIR / os.path.basename(file).replace(".wav", "_detections.txt")))
+                if fleet:
+                    fleet.add(file, detections)
+                if CAPTURE_TRIGGER:
+                    from triggered_capture import send_triggers
+                    try:
+                        send_triggers(CAPTURE_TRIGGER, file, detections)
+                    except OSError as e:
+                        print(f"[WARN] High-rate capture trigger: {e}")
+            if pyramid:
+                try:
+                    with trace("tiles"):
+                        pyramid.add_clip(file, detections)
+                except Exception as e:
+                    print(f"[WARN] Tile pyramid: {e}")
+            if settings.get("defer_export") and len(detections):
+                defer_export(file, detections)
             delete_files = glob.glob(file.replace(".wav", "*"))
             for delete_file in delete_files:
                 os.remove(delete_file)
-            # tmp=file.replace("Audios", "Images").replace("wav","PNG")
-            os.remove(file.replace("Audios", "Images").replace("wav","PNG"))
+            for image in glob.glob(image_path_for(file, "_ch*")):
+                os.remove(image)
             print("Process finished of", file)
             count += 1
 
@@ -207,7 +401,9 @@ if __name__ == "__main__":
             p = Process(target=move_file, args=(result_dir + file,))
             p.start()
         
-        time.sleep(1)
+        # Straight to the next clip while behind
+        if deadline.level == 0:
+            time.sleep(1)
 
         
 
@@ -218,11 +414,5 @@ if __name__ == "__main__":
     #     # run("/home/jetson/Bird-Song-Detector/Data/Audios/AM1_20230510_073000.wav")
     #     run("/home/jetson/record/AM1_20230511_060000.wav")
 
-
-
-
-
-
-
-
-
+if __name__ == "__main__":
+    main()
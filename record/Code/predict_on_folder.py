@@ -19,46 +19,40 @@ Variables:
 """
 
 # Import libraries
-from ultralytics import YOLO
-from ultralytics.utils.ops import Profile
 import os
-import pandas as pd
-
-from audio_processing import save_spectrogram_from_audio, transform_coordinates_to_seconds, transform_predictions_save_segment
-
-# Load model (Bird Song Detector from BIRDeep)
-model = YOLO("/opt/bird-files/Bird-Song-Detector/Models/Bird_Song_Detector/weights/best.pt")
-# Clean the output folder
 import shutil
 
-# Clean the output folder
-shutil.rmtree('runs', ignore_errors=True)
-
 # Path to the folder containing audio files
 audio_folder = "/opt/bird-files/record/data_temp/Audios/"
 
-# Iterate over all audio files in the folder
-for audio_file in os.listdir(audio_folder):
-    if audio_file.endswith(".WAV"):
-        audio_path = os.path.join(audio_folder, audio_file)
-        audio_name = os.path.basename(audio_path).replace(".WAV", "")
-        
-        # Audio has to be converted to spectrogram and saved as image
-        with Profile() as dt:
-            image_path = save_spectrogram_from_audio(audio_path)
-        print("Spectrogram extraction: ",dt)
-        # Perform detection on the spectrogram image using the model
-        model(image_path, save_txt=True, save_conf=True)
-        
-        # Read txt in the output folder
-        predictions_txt = f"/opt/bird-files/Bird-Song-Detector/Code/runs/detect/predict/labels/{audio_name}.txt"
-        
-        if os.path.exists(predictions_txt):
-            # Convert to start_second, end_second, class, confidence score:
-            transform_predictions_save_segment(audio_path, predictions_txt)
-        else:
-            print(f"No detections for {audio_file}")
+def load_local_model():
+    from ultralytics import YOLO
+    from inference_service import MODEL_PATH
+    return YOLO(MODEL_PATH)
+
+def main():
+    # Heavy imports are done here, not when the module is imported
+    from audio_processing import transform_predictions_save_segment, detect_channels
+    from inference_service import load_detector
+
+    # Load model (Bird Song Detector from BIRDeep), or use the detector daemon when BIRD_DETECTOR_SOCKET is set
+    model = load_detector(load_local_model)
+
+    # Clean the output folder
+    shutil.rmtree('runs', ignore_errors=True)
 
+    # Iterate over all audio files in the folder
+    for audio_file in os.listdir(audio_folder):
+        if audio_file.lower().endswith(".wav"):
+            audio_path = os.path.join(audio_folder, audio_file)
 
+            # Every channel is converted to a spectrogram, detected in one batch and the channels are fused
+            detections = detect_channels(model, audio_path, fusion=os.getenv("CHANNEL_FUSION", "max"))
 
+            if len(detections):
+                transform_predictions_save_segment(audio_path, detections)
+            else:
+                print(f"No detections for {audio_file}")
 
+if __name__ == "__main__":
+    main()
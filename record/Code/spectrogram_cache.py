@@ -0,0 +1,150 @@
+# Import libraries
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+def model_version(model):
+    """
+    Version of a model for the cache key: ModelManager.version, or the name and modification time of the
+    checkpoint of a plain YOLO model. None when unknown, then detections are not cached.
+    """
+    version = getattr(model, "version", None)
+    if version:
+        return version
+    ckpt_path = getattr(model, "ckpt_path", None)
+    if ckpt_path and os.path.exists(ckpt_path):
+        return f"{os.path.basename(ckpt_path)}@{int(os.path.getmtime(ckpt_path))}"
+    return None
+
+class SpectrogramCache:
+    """
+    On-disk cache of spectrograms and detections, keyed by the content hash of the audio and the configuration
+    that produced them (spectrogram parameters, and model version and fusion policy for detections).
+
+    Entries are compressed .npz files under root/, indexed in root/index.sqlite with their size and last use.
+    The least recently used entries are evicted when the cache grows over max_bytes. The content hash of an
+    audio file is computed once per (path, size, modification time).
+
+    Usage:
+        cache = SpectrogramCache("cache", max_bytes=2 * 1024**3)
+        entry = cache.get(audio_path, {"kind": "spectrogram", "n_fft": 2048})
+        if entry is None:
+            cache.put(audio_path, {"kind": "spectrogram", "n_fft": 2048}, D=D)
+    """
+
+    def __init__(self, root, max_bytes=2 * 1024**3):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        # Shared by the worker processes of reprocess_archive.py, SQLite does the locking. Used from the handler
+        # threads of the app too, serialised by self.lock
+        self.conn = sqlite3.connect(os.path.join(root, "index.sqlite"), timeout=60, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, last_used REAL, config TEXT);
+                CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT);
+                CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+            """)
+
+    def audio_hash(self, audio_path):
+        """SHA-256 of the content of an audio file, memoised by path, size and modification time."""
+        path = os.path.abspath(audio_path)
+        stat = os.stat(path)
+        with self.lock:
+            row = self.conn.execute("SELECT size, mtime_ns, hash FROM hashes WHERE path = ?", (path,)).fetchone()
+        if row and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            return row[2]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)",
+                              (path, stat.st_size, stat.st_mtime_ns, digest.hexdigest()))
+        return digest.hexdigest()
+
+    def key(self, audio_path, config):
+        config = json.dumps(config, sort_keys=True, default=str)
+        return hashlib.sha256(f"{self.audio_hash(audio_path)}|{config}".encode()).hexdigest()[:32]
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + ".npz")
+
+    def get(self, audio_path, config):
+        """
+        Arrays stored for this audio and configuration, as a dict, or None on a miss.
+        """
+        key = self.key(audio_path, config)
+        path = self._path(key)
+        try:
+            with np.load(path) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+        except (OSError, ValueError):
+            # Missing (evicted by another process) or truncated file
+            with self.lock, self.conn:
+                self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            return None
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+        return arrays
+
+    def put(self, audio_path, config, **arrays):
+        """
+        Store arrays for this audio and configuration, then evict the least recently used entries over budget.
+        """
+        key = self.key(audio_path, config)
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(buffer.getvalue())
+        os.replace(tmp_path, path)
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                              (key, buffer.tell(), time.time(), json.dumps(config, sort_keys=True, default=str)))
+        self._evict()
+
+    def _evict(self):
+        with self.lock:
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            evicted = []
+            for key, size in self.conn.execute("SELECT key, size FROM entries ORDER BY last_used"):
+                if total <= self.max_bytes:
+                    break
+                evicted.append(key)
+                total -= size
+            with self.conn:
+                self.conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in evicted])
+        for key in evicted:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        """Number of entries and bytes used."""
+        with self.lock:
+            count, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {"entries": count, "bytes": size, "max_bytes": self.max_bytes}
+
+def cache_from_env():
+    """
+    Cache configured with the SPECTROGRAM_CACHE (folder) and SPECTROGRAM_CACHE_BYTES environment variables,
+    None when SPECTROGRAM_CACHE is not set.
+    """
+    root = os.getenv("SPECTROGRAM_CACHE")
+    if not root:
+        return None
+    return SpectrogramCache(root, max_bytes=int(float(os.getenv("SPECTROGRAM_CACHE_BYTES", 2 * 1024**3))))
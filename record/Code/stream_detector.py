@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Low-latency detection on the live audio stream, instead of waiting for the 60 s clip to be closed.
+
+The raw PCM of the microphone is read from arecord (an ALSA device, the loopback, or a dsnoop device shared with
+record_upload.py). Every hop of audio adds one column to a rolling magnitude spectrogram of the last --window
+seconds. Every --step seconds, the window is rendered exactly like the clips the detector was trained on (same
+STFT, dB scale and image) and the model runs on it. A song is reported --step plus one inference after it is seen,
+not one to two minutes later.
+
+As the windows overlap, a song is seen by several windows: it is reported once as a "detection" event, then as
+"update" events while it grows (end later, or a higher score). "open" is true while the song reaches the end of the
+window, i.e. may still be going on. Times are epoch seconds; "latency" is the time from the end of the sound seen to
+the event.
+
+  {"type": "detection", "id": 12, "start": 1715400012.31, "end": 1715400014.02, "cls": 0, "score": 0.71,
+   "open": true, "latency": 1.62}
+
+Events go to the callbacks passed to StreamDetector, and with --port to every client of a local TCP socket
+(one JSON event per line, e.g. `nc 127.0.0.1 8766`), to drive triggered recording or playback experiments.
+
+Examples:
+  python stream_detector.py --device hw:Loopback,1,0 --step 2
+  python stream_detector.py --device dsnoop:2,0 --window 60 --step 1 --model-device cuda --port 8766
+  python stream_detector.py --input ../AM1_20230511_060000.wav --speed 4     # replay a recording for testing
+"""
+
+# Import libraries
+import argparse
+import json
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import librosa
+import numpy as np
+
+import metrics
+from metrics import trace
+from audio_processing import SPECTROGRAM_PARAMS, SpectrogramRenderer
+from detections import Detections
+from inference_service import MODEL_PATH
+
+ARECORD_DEVICE = os.getenv("ARECORD_DEVICE", "plughw:2,0")
+STREAM_PORT = int(os.getenv("STREAM_PORT", "8766"))
+
+class RollingSpectrogram:
+    """
+    Magnitude STFT of the last window_seconds of a stream, updated one hop at a time.
+
+    Only the frames completed by the new samples are computed; the columns are kept in a ring buffer so that
+    nothing is shifted in memory. Same window and frame layout as librosa.stft (periodic Hann, centred frames).
+    """
+
+    def __init__(self, sr=16000, n_fft=2048, hop_length=512, window_seconds=60.0):
+        self.sr = sr
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.columns = int(round(window_seconds * sr / hop_length))
+        self.S = np.zeros((n_fft // 2 + 1, self.columns), dtype=np.float32)
+        self.pos = 0           # next column to write
+        self.filled = 0        # columns written so far, up to self.columns
+        self.samples = 0       # samples pushed so far
+        self.window_fn = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(n_fft) / n_fft)).astype(np.float32)
+        # Like center=True: the first frame is centred on the first sample
+        self._tail = np.zeros(n_fft // 2, dtype=np.float32)
+
+    def push(self, samples):
+        """Add mono samples. Returns the number of new columns."""
+        buf = np.concatenate([self._tail, np.asarray(samples, dtype=np.float32)])
+        self.samples += len(samples)
+        if len(buf) < self.n_fft:
+            self._tail = buf
+            return 0
+        n = (len(buf) - self.n_fft) // self.hop_length + 1
+        frames = np.lib.stride_tricks.sliding_window_view(buf, self.n_fft)[::self.hop_length][:n]
+        columns = np.abs(np.fft.rfft(frames * self.window_fn, axis=1)).T
+        self._tail = buf[n * self.hop_length:]
+
+        # Only the last self.columns are kept when more arrive at once
+        columns = columns[:, -self.columns:]
+        first = min(len(columns.T), self.columns - self.pos)
+        self.S[:, self.pos:self.pos + first] = columns[:, :first]
+        self.S[:, :len(columns.T) - first] = columns[:, first:]
+        self.pos = (self.pos + len(columns.T)) % self.columns
+        self.filled = min(self.columns, self.filled + n)
+        return n
+
+    def window(self):
+        """The last window in time order, shape (freq, columns). Columns not recorded yet are zeros, on the left."""
+        return np.concatenate([self.S[:, self.pos:], self.S[:, :self.pos]], axis=1)
+
+class EventServer:
+    """Local TCP socket that sends every event as one JSON line to all the connected clients."""
+
+    def __init__(self, host="127.0.0.1", port=STREAM_PORT):
+        self.sock = socket.create_server((host, port))
+        self.clients = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self._accept, daemon=True).start()
+        print(f"Events on tcp://{host}:{port}")
+
+    def _accept(self):
+        while True:
+            client, _ = self.sock.accept()
+            # A client that stops reading is dropped instead of blocking the detections
+            client.settimeout(1.0)
+            with self.lock:
+                self.clients.append(client)
+
+    def __call__(self, event):
+        line = (json.dumps(event) + "\n").encode()
+        with self.lock:
+            for client in list(self.clients):
+                try:
+                    client.sendall(line)
+                except OSError:
+                    # Client gone
+                    self.clients.remove(client)
+                    client.close()
+
+class StreamDetector:
+    """
+    Sliding-window detector on a live stream.
+
+    Args:
+        model: YOLO model, ModelManager or DetectorClient (the window is then passed in memory, not rendered to
+            image_path).
+        window_seconds (float): Length of the window the model sees (default: 60 s, the length it was trained on).
+        step_seconds (float): Time between two detections.
+        min_score (float): Detections below this score are not reported.
+        on_event (list): Callables receiving every event (dict).
+        image_path (str): Where the window image is rendered.
+    """
+
+    def __init__(self, model, window_seconds=60.0, step_seconds=2.0, min_score=0.25, on_event=None,
+                 image_path="/tmp/bird_stream/window.PNG", params=None):
+        params = {**SPECTROGRAM_PARAMS, **(params or {})}
+        self.model = model
+        self.sr = params["sr"]
+        self.window_seconds = window_seconds
+        self.step = int(step_seconds * self.sr)
+        self.min_score = min_score
+        self.on_event = list(on_event or [])
+        self.image_path = image_path
+        self.spectrogram = RollingSpectrogram(params["sr"], params["n_fft"], params["hop_length"], window_seconds)
+        self.renderer = SpectrogramRenderer(self.sr)
+        self.events = {}     # id -> last event of the songs still in the window
+        self.next_id = 1
+        self._last_detect = 0
+
+    def feed(self, samples, t_end):
+        """
+        Add mono samples at self.sr, the last one recorded at epoch time t_end, and detect when a step is due.
+        """
+        self.spectrogram.push(samples)
+        if self.spectrogram.samples - self._last_detect >= self.step:
+            self._last_detect = self.spectrogram.samples
+            self.detect(t_end)
+
+    def detect(self, t_end):
+        """Run the model on the current window and emit the new and grown detections."""
+        t0 = time.time()
+        S = self.spectrogram.window()
+        # Same scale as save_channel_spectrograms: dB relative to the window maximum
+        D = librosa.amplitude_to_db(S / max(float(S.max()), 1e-10), ref=1.0)
+        with trace("stream_render"):
+            image = self.renderer.render(D) if getattr(self.model, "takes_arrays", False) else self.renderer.save(D, self.image_path)
+        with trace("stream_inference"):
+            results = self.model(image, verbose=False)
+        detections = Detections.from_results(results, self.window_seconds)
+
+        window_start = t_end - self.window_seconds
+        # Left part of the window not recorded yet (start-up)
+        recorded_from = t_end - self.spectrogram.filled * self.spectrogram.hop_length / self.sr
+        # Stream time of the events: t_end plus the time spent here (replayed files run ahead of the clock)
+        now = t_end + time.time() - t0
+        for start, end, cls, score in detections:
+            start, end = window_start + float(start), window_start + float(end)
+            if score < self.min_score or end <= recorded_from:
+                continue
+            event = {"start": round(start, 2), "end": round(end, 2), "cls": int(cls), "score": round(float(score), 3),
+                     "open": t_end - end < 0.5}
+            match = next((i for i, e in self.events.items()
+                          if e["cls"] == event["cls"] and e["start"] < end and start < e["end"]), None)
+            if match is None:
+                event.update(type="detection", id=self.next_id)
+                self.next_id += 1
+            else:
+                last = self.events[match]
+                if event["end"] - last["end"] < 0.25 and event["score"] - last["score"] < 0.05 and event["open"] == last["open"]:
+                    continue
+                event.update(type="update", id=match, start=min(last["start"], event["start"]),
+                             end=max(last["end"], event["end"]), score=max(last["score"], event["score"]))
+            event["latency"] = round(now - event["end"], 2)
+            self.events[event["id"]] = event
+            self.emit(event)
+
+        # Forget the songs that left the window
+        self.events = {i: e for i, e in self.events.items() if e["end"] > window_start}
+
+    def emit(self, event):
+        metrics.event("stream_" + event["type"], **{k: v for k, v in event.items() if k != "type"})
+        for callback in self.on_event:
+            try:
+                callback(event)
+            except Exception as e:
+                print(f"[WARN] Event callback failed: {e}", file=sys.stderr)
+
+def arecord_stream(device, sr, channels=2, block_seconds=0.25):
+    """
+    Read blocks of the live stream from arecord.
+
+    Yields:
+        samples (np.ndarray): Mono float32 samples at sr.
+        t_end (float): Epoch time of the last sample.
+    """
+    command = ["arecord", "--device", device, "--rate", str(sr), "--format", "S16_LE", "--channels", str(channels),
+               "--file-type", "raw", "--quiet"]
+    block_bytes = int(block_seconds * sr) * channels * 2
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+    try:
+        while True:
+            data = proc.stdout.read(block_bytes)
+            if not data:
+                raise SystemExit(f"arecord stopped (exit code {proc.wait()})")
+            t_end = time.time()
+            pcm = np.frombuffer(data[:len(data) // (2 * channels) * 2 * channels], dtype="<i2").reshape(-1, channels)
+            yield pcm.mean(axis=1, dtype=np.float32) / 32768, t_end
+    finally:
+        proc.terminate()
+
+def file_stream(path, sr, block_seconds=0.25, speed=1.0):
+    """Replay an audio file as a live stream, at speed times real time (0 = as fast as possible)."""
+    import soundfile as sf
+
+    t0 = time.time()
+    done = 0
+    with sf.SoundFile(path) as f:
+        for block in f.blocks(blocksize=int(block_seconds * f.samplerate), dtype="float32", always_2d=True):
+            y = block.mean(axis=1)
+            if f.samplerate != sr:
+                y = np.interp(np.arange(0, len(y), f.samplerate / sr), np.arange(len(y)), y).astype(np.float32)
+            done += len(y)
+            t_end = t0 + done / sr
+            if speed > 0:
+                time.sleep(max(0.0, t0 + (t_end - t0) / speed - time.time()))
+            yield y, t_end
+
+def run_stream(source, detector):
+    """
+    Feed a stream to the detector. Blocks are read in a thread so that a slow inference does not make
+    arecord overrun: the blocks recorded meanwhile wait in a queue and are all added before the next detection.
+    """
+    blocks = queue.Queue()
+
+    def read():
+        try:
+            for block in source:
+                blocks.put(block)
+        finally:
+            blocks.put(None)
+
+    threading.Thread(target=read, daemon=True).start()
+    while True:
+        block = blocks.get()
+        if block is None:
+            return
+        samples, t_end = block
+        # Catch up without detecting on every block
+        while not blocks.empty():
+            more = blocks.get()
+            if more is None:
+                detector.feed(samples, t_end)
+                return
+            samples, t_end = np.concatenate([samples, more[0]]), more[1]
+        detector.feed(samples, t_end)
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Real-time bird song detection on the live audio stream.")
+    p.add_argument("--device", default=ARECORD_DEVICE, help="ALSA capture device (env ARECORD_DEVICE)")
+    p.add_argument("--channels", type=int, default=2, help="Channels captured, mixed to mono (default: 2)")
+    p.add_argument("--input", help="Replay this audio file instead of capturing")
+    p.add_argument("--speed", type=float, default=1.0, help="Replay speed of --input, 0 = as fast as possible (default: 1)")
+    p.add_argument("--window", type=float, default=60.0, help="Window the model sees in seconds (default: 60)")
+    p.add_argument("--step", type=float, default=2.0, help="Seconds between two detections (default: 2)")
+    p.add_argument("--min-score", type=float, default=0.25, help="Minimum score reported (default: 0.25)")
+    p.add_argument("--port", type=int, default=STREAM_PORT, help="Local TCP port of the events, 0 = none (env STREAM_PORT)")
+    p.add_argument("--events", help="Also append the events to this JSON lines file")
+    p.add_argument("--model", default=MODEL_PATH, help="Model weights (env BIRD_MODEL)")
+    p.add_argument("--model-device", default="cpu", help="cpu on the stations, cuda on a Jetson (default: cpu)")
+    return p.parse_args()
+
+def main():
+    args = parse_args()
+    from inference_service import load_detector
+
+    def load_local_model():
+        from model_manager import ModelManager
+        return ModelManager(args.model, device=args.model_device)
+
+    callbacks = [lambda e: print(json.dumps(e), flush=True)]
+    if args.port:
+        callbacks.append(EventServer(port=args.port))
+    if args.events:
+        events_file = open(args.events, "a", buffering=1)
+        callbacks.append(lambda e: events_file.write(json.dumps(e) + "\n"))
+
+    # The detector daemon when BIRD_DETECTOR_SOCKET is set
+    model = load_detector(load_local_model)
+    detector = StreamDetector(model, window_seconds=args.window, step_seconds=args.step, min_score=args.min_score,
+                              on_event=callbacks)
+    sr = detector.sr
+    if args.input:
+        source = file_stream(args.input, sr, speed=args.speed)
+    else:
+        source = arecord_stream(args.device, sr, channels=args.channels)
+    print(f"Detecting on {args.input or args.device}: {args.window:.0f} s window every {args.step:g} s")
+    try:
+        run_stream(source, detector)
+    except KeyboardInterrupt:
+        print("\nStopped.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+# Import libraries
+import os
+
+import numpy as np
+import soundfile as sf
+
+from audio_processing import segment_path, transform_predictions_save_segment
+
+SR = 16000
+
+def write_clip(path, subtype="PCM_16"):
+    y = np.random.default_rng(0).uniform(-0.5, 0.5, (SR * 3, 2))
+    sf.write(path, y, SR, subtype=subtype)
+
+def test_flac_segments_are_wav_files(tmp_path):
+    clip = str(tmp_path / "AM1_20230511_060000.flac")
+    write_clip(clip, "PCM_24")
+    transform_predictions_save_segment(clip, [(0.5, 1.5, 0, 0.9)], output_dir=str(tmp_path / "Segments"))
+    path = tmp_path / "Segments" / "AM1_20230511_060000_0.50_1.50_0.90.wav"
+    info = sf.info(str(path))
+    assert os.listdir(tmp_path / "Segments") == [path.name]
+    assert (info.format, info.subtype, info.channels, info.frames) == ("WAV", "PCM_24", 2, SR)
+
+def test_wav_segments_keep_their_extension(tmp_path):
+    clip = str(tmp_path / "AM1_20230511_060000.WAV")
+    write_clip(clip)
+    transform_predictions_save_segment(clip, [(1.0, 2.0, 0, 0.5)], output_dir=str(tmp_path / "Segments"))
+    assert os.listdir(tmp_path / "Segments") == ["AM1_20230511_060000_1.00_2.00_0.50.WAV"]
+
+def test_segment_path_is_wav():
+    assert segment_path("Audios/a.flac", 1, 2, 0.5) == "Segments/a_1.00_2.00_0.50.wav"
+    assert segment_path("Audios/a.wav", 1, 2, 0.5, "out") == os.path.join("out", "a_1.00_2.00_0.50.wav")
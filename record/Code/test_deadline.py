@@ -0,0 +1,68 @@
+# Import libraries
+from datetime import datetime
+
+import pytest
+
+from deadline import DEGRADATION_LEVELS, DeadlineController
+
+START = datetime(2025, 8, 22, 9, 0, 0).timestamp()
+
+class Clock:
+    """Time of the recorder: the oldest waiting clip, recorded at START, finished lag seconds ago."""
+
+    def __init__(self):
+        self.lag = 0.0
+
+    def __call__(self):
+        return START + 60 + self.lag
+
+WAITING = [datetime.fromtimestamp(START).strftime("%Y-%m-%d_%H-%M-%S.wav"), "2025-08-22_09-01-00.wav"]
+
+def levels(controller, clock, lags):
+    result = []
+    for lag in lags:
+        clock.lag = lag
+        controller.update(WAITING)
+        result.append(controller.level)
+    return result
+
+def test_level_per_budget_of_lag():
+    clock = Clock()
+    controller = DeadlineController(budget=300, clock=clock)
+    assert levels(controller, clock, [100, 350, 650, 5000]) == [0, 1, 2, len(DEGRADATION_LEVELS) - 1]
+    assert controller.lag == pytest.approx(5000)
+
+def test_level_is_left_under_recover_times_its_lag():
+    clock = Clock()
+    controller = DeadlineController(budget=300, recover=0.5, clock=clock)
+    # Level 1 is entered at 300 s and left under 150 s, level 3 entered at 900 s is left under 450 s
+    assert levels(controller, clock, [350, 250, 160, 140]) == [1, 1, 1, 0]
+    assert levels(controller, clock, [950, 650, 400, 290, 100]) == [3, 3, 2, 1, 0]
+
+def test_no_waiting_clip_is_no_lag():
+    clock = Clock()
+    controller = DeadlineController(budget=300, clock=clock)
+    levels(controller, clock, [1000])
+    assert controller.update([]) == {}
+    assert (controller.lag, controller.level) == (0.0, 0)
+
+def test_zero_budget_keeps_the_full_settings():
+    clock = Clock()
+    controller = DeadlineController(budget=0, clock=clock)
+    assert levels(controller, clock, [10000]) == [0]
+    assert controller.settings() == {}
+
+def test_settings_add_up_with_the_levels():
+    clock = Clock()
+    controller = DeadlineController(budget=300, min_snr_db=6.0, clock=clock)
+    levels(controller, clock, [350])
+    assert controller.settings() == {"defer_export": True}
+    levels(controller, clock, [5000])
+    assert controller.settings() == {"defer_export": True, "imgsz": 320, "params": {"n_fft": 1024}, "min_snr_db": 6.0}
+
+def test_clip_order():
+    clips = ["2025-08-22_09-01-00.wav", "2025-08-22_09-00-00.wav", "2025-08-22_09-02-00.wav"]
+    assert DeadlineController(policy="oldest").order(clips) == sorted(clips)
+    assert DeadlineController(policy="newest").order(clips) == sorted(clips, reverse=True)
+    with pytest.raises(ValueError):
+        DeadlineController(policy="random")
@@ -0,0 +1,72 @@
+# Import libraries
+import gzip
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from fleet_sync import FleetSync
+
+class Server(ThreadingHTTPServer):
+    """Ingest server stand-in answering with the next status of replies, the batches it stored in batches."""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.batches = []
+        super().__init__(("127.0.0.1", 0), Handler)
+
+class Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        batch = json.loads(gzip.decompress(self.rfile.read(int(self.headers["Content-Length"]))))
+        status = self.server.replies.pop(0)
+        body = json.dumps({"stored": len(batch["columns"]["ts"])} if status == 200 else {"error": "bad batch"}).encode()
+        if status == 200:
+            self.server.batches.append(batch)
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    def start(*replies):
+        server = Server(replies)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+    servers = []
+    yield start
+    for server in servers:
+        server.shutdown()
+
+def url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+def test_server_error_keeps_the_batch(server, tmp_path):
+    s = server(503, 200)
+    sync = FleetSync(url(s), str(tmp_path), station="AM1")
+    sync.add("AM1_20230511_060000.wav", [(1.0, 2.0, 0, 0.9)])
+    assert sync.flush() is None
+    assert os.path.exists(tmp_path / "pending.json")
+    assert sync.flush() == 1
+    assert not os.path.exists(tmp_path / "pending.json")
+
+def test_rejected_batch_does_not_block_the_next_ones(server, tmp_path):
+    s = server(400, 200)
+    sync = FleetSync(url(s), str(tmp_path), station="AM1")
+    sync.add("AM1_20230511_060000.wav", [(1.0, 2.0, 0, 0.9)])
+    assert sync.flush() == 0
+    assert not os.path.exists(tmp_path / "pending.json")
+    rejected = os.listdir(tmp_path / "rejected")
+    assert len(rejected) == 1
+    with open(tmp_path / "rejected" / rejected[0]) as f:
+        assert json.load(f)["columns"]["key"] == ["AM1_20230511_060000_1.00_2.00_0.90.flac"]
+
+    sync.add("AM1_20230511_060100.wav", [(3.0, 4.0, 0, 0.8)])
+    assert sync.flush() == 1
+    assert s.batches[0]["columns"]["key"] == ["AM1_20230511_060100_3.00_4.00_0.80.flac"]
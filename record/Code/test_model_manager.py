@@ -0,0 +1,95 @@
+# Import libraries
+import os
+import threading
+import time
+import types
+
+import numpy as np
+import pytest
+
+from model_manager import SHADOW_QUEUE, ModelManager, checkpoint_version
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    # Checkpoints are not loaded, only their versions are swapped
+    monkeypatch.setattr(ModelManager, "_load", lambda self, path: (None, checkpoint_version(path)))
+    now = time.time()
+    for name, age in (("best.pt", 1000), ("last.pt", 2000), ("epoch10.pt", 3000)):
+        (tmp_path / name).write_bytes(b"")
+        os.utime(tmp_path / name, (now - age, now - age))
+    return ModelManager(str(tmp_path / "best.pt"), watch_dir=str(tmp_path), settle_time=0)
+
+def test_older_checkpoints_are_not_swapped_in(manager, tmp_path):
+    manager.poll()
+    assert manager.version.startswith("best.pt@")
+
+def test_new_checkpoint_is_swapped_in_once(manager, tmp_path):
+    (tmp_path / "new.pt").write_bytes(b"")
+    os.utime(tmp_path / "new.pt", (time.time() - 10, time.time() - 10))
+    manager.poll()
+    assert manager.version.startswith("new.pt@")
+    manager.poll()
+    manager.poll()
+    assert manager.version.startswith("new.pt@")
+
+def test_variants_and_exports_are_not_checkpoints(manager, tmp_path):
+    for name in ("best_int8.onnx", "best_nano.pt", "best.onnx"):
+        (tmp_path / name).write_bytes(b"")
+        os.utime(tmp_path / name, (time.time() - 10, time.time() - 10))
+    manager.poll()
+    assert manager.version.startswith("best.pt@")
+
+def test_variant_of_new_checkpoint_is_loaded(manager, tmp_path, monkeypatch):
+    monkeypatch.setattr(manager, "variant", "int8")
+    (tmp_path / "new.pt").write_bytes(b"")
+    os.utime(tmp_path / "new.pt", (time.time() - 10, time.time() - 10))
+    manager.poll()
+    # Until compress_model.py has written the INT8 variant of it
+    assert manager.version.startswith("best.pt@")
+    (tmp_path / "new_int8.onnx").write_bytes(b"")
+    os.utime(tmp_path / "new_int8.onnx", (time.time() - 5, time.time() - 5))
+    manager.poll()
+    assert manager.version.startswith("new_int8.onnx@")
+
+class Boxes:
+    """Boxes of a result with no detection, with the accessors of ultralytics used by detection_agreement."""
+
+    @property
+    def xywhn(self):
+        return self
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return np.zeros((0, 4))
+
+    def __len__(self):
+        return 0
+
+class SlowModel:
+    """Model with no detections, that waits for release while it runs."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    def __call__(self, source, **kwargs):
+        self.calls += 1
+        self.release.wait(5)
+        return [types.SimpleNamespace(boxes=Boxes()) for _ in source]
+
+def test_shadow_runs_are_off_the_clip_path(manager):
+    candidate = SlowModel()
+    manager._production = (lambda source, **kwargs: [types.SimpleNamespace(boxes=Boxes()) for _ in source], "best.pt@0")
+    manager._candidate = (candidate, "new.pt@1")
+    manager.shadow_fraction = 1.0
+    t0 = time.perf_counter()
+    for _ in range(SHADOW_QUEUE + 3):
+        manager([np.zeros((4, 4, 3), np.uint8)])
+    # The clips did not wait for the candidate, and the runs beyond the queue were dropped
+    assert time.perf_counter() - t0 < 1
+    candidate.release.set()
+    manager._shadow_queue.join()
+    assert len(manager._shadow_runs) == candidate.calls
+    assert manager.shadow_dropped == SHADOW_QUEUE + 3 - candidate.calls >= 1
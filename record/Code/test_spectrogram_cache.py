@@ -0,0 +1,31 @@
+# Import libraries
+import threading
+
+import numpy as np
+
+from spectrogram_cache import SpectrogramCache
+
+def test_cache_used_from_another_thread(tmp_path):
+    # Like the app: the cache is created at import time and used from the handler threads
+    cache = SpectrogramCache(str(tmp_path / "cache"))
+    audio_path = tmp_path / "clip.wav"
+    audio_path.write_bytes(b"RIFF" + bytes(1000))
+    config = {"kind": "spectrogram", "n_fft": 2048}
+    results, errors = [], []
+
+    def handler():
+        try:
+            cache.put(str(audio_path), config, D=np.ones((2, 3)))
+            results.append(cache.get(str(audio_path), config))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=handler) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert len(results) == 4 and all(np.array_equal(r["D"], np.ones((2, 3))) for r in results)
+    assert cache.stats()["entries"] == 1
@@ -0,0 +1,218 @@
+"""
+Multi-resolution spectrogram tile pyramid of the recordings of a station, built incrementally as clips are processed,
+so that a whole day can be reviewed in fleet/tile_viewer.py instead of opening one image per clip.
+
+Layout, one pyramid per station and day (times in seconds since local midnight):
+  <root>/pyramid.json                              tile geometry, read by the viewer
+  <root>/<station>/<YYYY-MM-DD>/<z>/<x>.png         tile x of level z covers [x, x + 1) * TILE_SECONDS * 2**z
+  <root>/<station>/<YYYY-MM-DD>/detections.jsonl    one detection per line, drawn by the viewer as a vector overlay
+  <root>/<station>/<YYYY-MM-DD>/clips.jsonl         the clips added to the pyramid
+
+Level 0 has TILE_WIDTH pixels per TILE_SECONDS; every level above halves the time resolution, up to MAX_LEVEL where
+one tile covers the whole day. Adding a clip renders its level-0 columns and rebuilds only the ancestors of the
+tiles it touched. Colours use a fixed dB scale (not normalised per clip) so that neighbouring clips match.
+
+Examples:
+  python tile_pyramid.py --input /archive/AM1 --root tiles --station AM1
+  python tile_pyramid.py --input data_temp/Audios --root tiles --detections data
+"""
+
+# Import libraries
+import argparse
+import glob
+import json
+import os
+import re
+import socket
+from datetime import datetime, timedelta
+
+import numpy as np
+import soundfile as sf
+from PIL import Image
+
+from fleet_sync import clip_start_time
+
+TILE_SECONDS = 60
+TILE_WIDTH = 512
+TILE_HEIGHT = 256
+MAX_LEVEL = 11  # 60 s * 2**11 > 24 h
+FMIN, FMAX = 50, 16000
+DB_FLOOR, DB_CEIL = -100.0, -20.0
+DAY_SECONDS = 24 * 3600
+# A station is a folder of the pyramids: no "." or ".." and no path separator
+STATION_RE = re.compile(r"^(?!\.{1,2}$)[A-Za-z0-9_.-]{1,64}$")
+
+def _colormap():
+    """256 x 4 RGBA lookup table (magma), grey levels when matplotlib is missing."""
+    try:
+        from matplotlib import colormaps
+        return (colormaps["magma"](np.linspace(0, 1, 256)) * 255).astype(np.uint8)
+    except ImportError:
+        grey = np.arange(256, dtype=np.uint8)
+        return np.column_stack([grey, grey, grey, np.full(256, 255, np.uint8)])
+
+COLORMAP = _colormap()
+
+def spectrogram_columns(y, sr, n_fft=2048):
+    """
+    Level-0 pixel columns of a mono signal: TILE_WIDTH columns per TILE_SECONDS, TILE_HEIGHT log-spaced frequency
+    rows (high frequencies on top), coloured on the fixed dB scale.
+
+    Returns:
+        np.ndarray: RGBA image of shape (TILE_HEIGHT, columns, 4).
+    """
+    hop = sr * TILE_SECONDS / TILE_WIDTH
+    n_columns = max(1, int(round(len(y) / hop)))
+    padded = np.pad(y, (n_fft // 2, n_fft // 2 + n_fft))
+    starts = (np.arange(n_columns) * hop).astype(int)
+    frames = padded[starts[:, None] + np.arange(n_fft)] * np.hanning(n_fft)
+    S = np.abs(np.fft.rfft(frames, axis=1))
+
+    # Max over the bins of every log-spaced band, so that short high-frequency songs stay visible when zoomed out
+    edges = np.geomspace(FMIN, min(FMAX, sr / 2), TILE_HEIGHT + 1) * n_fft / sr
+    edges = np.clip(edges.astype(int), 0, S.shape[1] - 1)
+    bands = np.maximum.reduceat(S[:, :edges[-1] + 1], edges[:-1], axis=1)
+
+    db = 20 * np.log10(np.maximum(bands / (np.hanning(n_fft).sum() / 2), 1e-10))
+    level = np.clip((db - DB_FLOOR) / (DB_CEIL - DB_FLOOR) * 255, 0, 255).astype(np.uint8)
+    return COLORMAP[level.T[::-1]]
+
+class TilePyramid:
+    """
+    Args:
+        root (str): Folder of the pyramids.
+        station (str): Station name (default: env STATION_ID or the host name).
+    """
+
+    def __init__(self, root, station=None):
+        self.root = root
+        self.station = station or os.getenv("STATION_ID") or socket.gethostname()
+        if not STATION_RE.match(self.station):
+            raise ValueError(f"Invalid station name: {self.station!r}")
+        os.makedirs(root, exist_ok=True)
+        meta = os.path.join(root, "pyramid.json")
+        if not os.path.exists(meta):
+            with open(meta, "w") as f:
+                json.dump({"tile_seconds": TILE_SECONDS, "tile_width": TILE_WIDTH, "tile_height": TILE_HEIGHT,
+                           "max_level": MAX_LEVEL}, f)
+
+    def _day_dir(self, day):
+        return os.path.join(self.root, self.station, day)
+
+    def _tile_path(self, day, z, x):
+        return os.path.join(self._day_dir(day), str(z), f"{x}.png")
+
+    def _load(self, path, width=TILE_WIDTH):
+        if os.path.exists(path):
+            with Image.open(path) as img:
+                return np.array(img.convert("RGBA"))
+        return np.zeros((TILE_HEIGHT, width, 4), dtype=np.uint8)  # transparent: not recorded
+
+    def _save(self, path, tile):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp.png"
+        Image.fromarray(tile, "RGBA").save(tmp_path, optimize=False)
+        os.replace(tmp_path, path)
+
+    def _paste(self, day, first_pixel, columns):
+        """Write level-0 columns starting at pixel first_pixel of the day. Returns the level-0 tiles touched."""
+        touched = set()
+        last_pixel = min(first_pixel + columns.shape[1], DAY_SECONDS * TILE_WIDTH // TILE_SECONDS)
+        pixel = first_pixel
+        while pixel < last_pixel:
+            x = pixel // TILE_WIDTH
+            offset = pixel - x * TILE_WIDTH
+            n = min(TILE_WIDTH - offset, last_pixel - pixel)
+            path = self._tile_path(day, 0, x)
+            tile = self._load(path)
+            tile[:, offset:offset + n] = columns[:, pixel - first_pixel:pixel - first_pixel + n]
+            self._save(path, tile)
+            touched.add(x)
+            pixel += n
+        return touched
+
+    def _rebuild_ancestors(self, day, touched):
+        """Rebuild the tiles above the touched level-0 tiles: two children side by side, halved in width."""
+        for z in range(1, MAX_LEVEL + 1):
+            touched = {x // 2 for x in touched}
+            for x in touched:
+                children = [self._load(self._tile_path(day, z - 1, 2 * x + i)) for i in (0, 1)]
+                pair = np.concatenate(children, axis=1).astype(np.uint16)
+                self._save(self._tile_path(day, z, x), ((pair[:, 0::2] + pair[:, 1::2]) // 2).astype(np.uint8))
+
+    def add_clip(self, audio_path, detections=None, start_time=None):
+        """
+        Add a clip to the pyramid of its day (and of the next day when it crosses midnight). The clip and its
+        detections are listed in the days they are in, split at midnight.
+
+        Args:
+            audio_path (str): Path to the audio file.
+            detections (Detections, optional): Detections of the clip, added to the overlay.
+            start_time (float, optional): Start of the clip in epoch seconds (default: from the file name).
+        """
+        start_time = clip_start_time(audio_path) if start_time is None else start_time
+        y, sr = sf.read(audio_path, dtype="float32", always_2d=True)
+        columns = spectrogram_columns(y.mean(axis=1), sr)
+        duration = len(y) / sr
+
+        start = datetime.fromtimestamp(start_time)
+        midnight = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        offset = (start - midnight).total_seconds()  # seconds of the day, local time like the clip names
+        name = os.path.basename(audio_path)
+
+        day_start_pixel = int(round(offset * TILE_WIDTH / TILE_SECONDS))
+        done = 0
+        day = midnight
+        while done < columns.shape[1]:
+            first_pixel = day_start_pixel + done
+            n = min(columns.shape[1] - done, DAY_SECONDS * TILE_WIDTH // TILE_SECONDS - first_pixel)
+            touched = self._paste(day.strftime("%Y-%m-%d"), first_pixel, columns[:, done:done + n])
+            self._rebuild_ancestors(day.strftime("%Y-%m-%d"), touched)
+            done += n
+            day += timedelta(days=1)
+            day_start_pixel = 0
+
+        # Seconds of the day the clip starts in, then of every next day it reaches
+        day, day_offset = midnight, offset
+        while day_offset + duration > 0:
+            day_dir = self._day_dir(day.strftime("%Y-%m-%d"))
+            os.makedirs(day_dir, exist_ok=True)
+            with open(os.path.join(day_dir, "clips.jsonl"), "a") as f:
+                f.write(json.dumps({"clip": name, "start": round(max(day_offset, 0), 3),
+                                    "end": round(min(day_offset + duration, DAY_SECONDS), 3)}) + "\n")
+            if detections is not None and len(detections):
+                with open(os.path.join(day_dir, "detections.jsonl"), "a") as f:
+                    for s, e, cls, score in detections:
+                        s, e = day_offset + float(s), day_offset + float(e)
+                        if e > 0 and s < DAY_SECONDS:
+                            f.write(json.dumps({"start": round(max(s, 0), 3), "end": round(min(e, DAY_SECONDS), 3),
+                                                "score": round(float(score), 4), "cls": int(cls), "clip": name}) + "\n")
+            day += timedelta(days=1)
+            day_offset -= DAY_SECONDS
+        return columns.shape[1]
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Build the spectrogram tile pyramid of a folder of recordings.")
+    p.add_argument("--input", required=True, help="Folder with the recordings (.wav/.flac, recursive)")
+    p.add_argument("--root", default=os.getenv("TILE_PYRAMID_DIR", "tiles"), help="Pyramid folder (env TILE_PYRAMID_DIR)")
+    p.add_argument("--station", default=None, help="Station name (default: env STATION_ID or the host name)")
+    p.add_argument("--detections", help="Folder with the <clip>_detections.txt files to overlay")
+    return p.parse_args()
+
+def main():
+    from detections import Detections
+
+    args = parse_args()
+    pyramid = TilePyramid(args.root, args.station)
+    clips = sorted(p for p in glob.glob(os.path.join(args.input, "**", "*"), recursive=True)
+                   if p.lower().endswith((".wav", ".flac")))
+    for i, clip in enumerate(clips, 1):
+        detections = None
+        if args.detections:
+            txt = os.path.join(args.detections, os.path.splitext(os.path.basename(clip))[0] + "_detections.txt")
+            detections = Detections.load(txt) if os.path.exists(txt) else None
+        pyramid.add_clip(clip, detections)
+        print(f"[{i}/{len(clips)}] {clip}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Event-triggered high-rate capture: full quality around the songs, low rate the rest of the time.
+
+One arecord process captures at the high rate (record_upload.py parameters: S16_LE, 2 channels, 44.1 kHz by
+default). The last --buffer seconds stay in a ring buffer in memory. What is written continuously is only a
+low-rate copy (16 kHz, the rate of the detector), as the 60 s clips record_upload.py writes, so that
+predict_on_audio.py processes them as usual. When a trigger arrives, the high-rate audio from --pre seconds
+before the song to --post seconds after it is written to --output at full quality. The capture waits for the
+post-trigger audio, and triggers that overlap are merged into one file.
+
+Triggers:
+- --detect: stream_detector.StreamDetector runs on the low-rate stream in this process and every event is a
+  trigger, a few seconds after the song (see stream_detector.py).
+- TCP: JSON lines {"start": <epoch>, "end": <epoch>} on 127.0.0.1:--port. predict_on_audio.py sends the detections
+  of run() there when CAPTURE_TRIGGER is set (see send_triggers()); these arrive about a minute after the song,
+  so --buffer must cover the clip length plus the processing time.
+
+Examples:
+  python triggered_capture.py --rate 48000 --buffer 180 --pre 5 --post 5
+  python triggered_capture.py --rate 96000 --detect --step 2
+  echo '{"start": 1715400012.3, "end": 1715400014.0}' | nc 127.0.0.1 8767
+"""
+
+# Import libraries
+import argparse
+import json
+import os
+import queue
+import socket
+import subprocess
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+import soundfile as sf
+
+from fleet_sync import clip_start_time
+
+ARECORD_DEVICE = os.getenv("ARECORD_DEVICE", "plughw:2,0")
+TRIGGER_PORT = int(os.getenv("TRIGGER_PORT", "8767"))
+AUDIOS_DIR = "/opt/bird-files/record/data_temp/Audios"
+HIGHRATE_DIR = os.getenv("HIGHRATE_DIR", "/opt/bird-files/record/data/highrate")
+CLIP_NAME_FORMAT = "%Y-%m-%d_%H-%M-%S"  # same names as record_upload.py, parsed by fleet_sync.clip_start_time
+
+class CaptureRing:
+    """
+    The last `seconds` of a multi-channel int16 stream, with the epoch time of every frame.
+
+    The time of a frame is derived from the clock time of the last block read, so it follows the sound card clock
+    and the small drift of the system clock between blocks does not accumulate.
+    """
+
+    def __init__(self, rate, channels, seconds):
+        self.rate = rate
+        self.size = int(rate * seconds)
+        self.buffer = np.zeros((self.size, channels), dtype=np.int16)
+        self.frames = 0          # frames written since the start
+        self.t_end = None        # epoch time of the end of the last frame written
+        self.lock = threading.Lock()
+
+    def write(self, block, t_end):
+        with self.lock:
+            block = block[-self.size:]
+            pos = self.frames % self.size
+            first = min(len(block), self.size - pos)
+            self.buffer[pos:pos + first] = block[:first]
+            self.buffer[:len(block) - first] = block[first:]
+            self.frames += len(block)
+            self.t_end = t_end
+
+    def oldest_time(self):
+        return self.t_end - min(self.frames, self.size) / self.rate
+
+    def read(self, start, end):
+        """
+        Frames between two epoch times, clipped to what is still in the buffer.
+
+        Returns:
+            np.ndarray: Frames of shape (n, channels), None when nothing of the range is in the buffer.
+            float: Epoch time of the first frame returned.
+        """
+        with self.lock:
+            start = max(start, self.oldest_time())
+            end = min(end, self.t_end)
+            if end <= start:
+                return None, start
+            last = self.frames - int(round((self.t_end - end) * self.rate))
+            first = self.frames - int(round((self.t_end - start) * self.rate))
+            index = np.arange(first, last) % self.size
+            return self.buffer[index].copy(), start
+
+class Downsampler:
+    """
+    Streaming resampler from the capture rate to the low rate: windowed-sinc low-pass filter, then linear
+    interpolation at the output instants. The filter state and the phase are kept between blocks.
+    """
+
+    def __init__(self, rate_in, rate_out, channels, taps=101):
+        self.step = rate_in / rate_out
+        cutoff = 0.45 / self.step  # just below the new Nyquist frequency, in cycles per input sample
+        n = np.arange(taps) - (taps - 1) / 2
+        self.h = (2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)).astype(np.float32)
+        self.history = np.zeros((taps - 1, channels), dtype=np.float32)
+        self.previous = np.zeros((1, channels), dtype=np.float32)
+        self.pos = 0.0  # position of the next output sample, in input samples after self.previous
+
+    def __call__(self, block):
+        x = np.concatenate([self.history, block.astype(np.float32)])
+        self.history = x[-len(self.history):]
+        filtered = np.column_stack([np.convolve(x[:, ch], self.h, mode="valid") for ch in range(x.shape[1])])
+        y = np.concatenate([self.previous, filtered])
+        self.previous = y[-1:]
+
+        positions = np.arange(self.pos, len(y) - 1, self.step)
+        self.pos = (positions[-1] + self.step if len(positions) else self.pos) - (len(y) - 1)
+        i = positions.astype(int)
+        frac = (positions - i)[:, None].astype(np.float32)
+        return y[i] * (1 - frac) + y[i + 1] * frac
+
+class LowRateWriter:
+    """Write the low-rate stream as clips of clip_seconds named like record_upload.py, in folder."""
+
+    def __init__(self, folder, rate, channels, clip_seconds=60):
+        self.folder = folder
+        self.rate = rate
+        self.channels = channels
+        self.clip_frames = int(clip_seconds * rate)
+        self.file = None
+        self.written = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def write(self, block, t_end):
+        while len(block):
+            if self.file is None:
+                start = t_end - len(block) / self.rate
+                path = os.path.join(self.folder, datetime.fromtimestamp(start).strftime(CLIP_NAME_FORMAT) + ".wav")
+                self.file = sf.SoundFile(path, "w", samplerate=self.rate, channels=self.channels, subtype="PCM_16")
+                self.written = 0
+            n = min(len(block), self.clip_frames - self.written)
+            self.file.write(np.clip(block[:n], -32768, 32767).astype(np.int16))
+            self.written += n
+            block = block[n:]
+            if self.written >= self.clip_frames:
+                self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class TriggeredCapture:
+    """
+    Pending high-rate captures: a trigger adds the range [start - pre, end + post], merged with the pending ranges
+    it overlaps, and every range is written once the ring buffer holds its end.
+    """
+
+    def __init__(self, ring, output_dir, pre=5.0, post=5.0, max_seconds=120.0):
+        self.ring = ring
+        self.output_dir = output_dir
+        self.pre = pre
+        self.post = post
+        self.max_seconds = max_seconds
+        self.pending = []
+        self.lock = threading.Lock()
+        os.makedirs(output_dir, exist_ok=True)
+
+    def trigger(self, start, end):
+        start, end = start - self.pre, end + self.post
+        with self.lock:
+            for capture in self.pending:
+                if capture[0] <= end and start <= capture[1]:
+                    capture[0], capture[1] = min(capture[0], start), max(capture[1], end)
+                    return
+            self.pending.append([start, end])
+
+    def poll(self):
+        """Write the pending captures whose audio is complete. Returns the paths written."""
+        if self.ring.t_end is None:
+            return []
+        with self.lock:
+            ready, waiting = [], []
+            for capture in self.pending:
+                done = capture[1] <= self.ring.t_end or capture[1] - capture[0] > self.max_seconds
+                (ready if done else waiting).append(capture)
+            self.pending = waiting
+        return [path for path in (self.write(*capture) for capture in ready) if path]
+
+    def write(self, start, end):
+        end = min(end, start + self.max_seconds)
+        frames, first = self.ring.read(start, end)
+        if frames is None:
+            print(f"[WARN] High-rate audio of {datetime.fromtimestamp(start):%H:%M:%S} no longer in the buffer "
+                  f"(oldest {datetime.fromtimestamp(self.ring.oldest_time()):%H:%M:%S}), increase --buffer")
+            return None
+        if first > start + 0.01:
+            print(f"[WARN] High-rate capture starts {first - start:.1f}s late, increase --buffer")
+        stamp = datetime.fromtimestamp(first)
+        name = f"{stamp.strftime(CLIP_NAME_FORMAT)}_{stamp.microsecond // 1000:03d}_{self.ring.rate // 1000}k.flac"
+        path = os.path.join(self.output_dir, name)
+        sf.write(path + ".tmp", frames, self.ring.rate, format="FLAC", subtype="PCM_16")
+        os.replace(path + ".tmp", path)
+        print(f"[CAP] {path} ({len(frames) / self.ring.rate:.1f}s at {self.ring.rate} Hz)")
+        return path
+
+def send_triggers(address, audio_path, detections, timeout=2.0):
+    """
+    Ask a running triggered_capture.py for the high-rate audio of the detections of a clip (see run() in
+    predict_on_audio.py). address is "host:port".
+    """
+    clip_start = clip_start_time(audio_path)
+    lines = "".join(json.dumps({"start": clip_start + float(s), "end": clip_start + float(e), "score": float(score),
+                                "clip": os.path.basename(audio_path)}) + "\n"
+                    for s, e, _, score in detections)
+    host, port = address.rsplit(":", 1)
+    with socket.create_connection((host, int(port)), timeout=timeout) as sock:
+        sock.sendall(lines.encode())
+
+def serve_triggers(capture, port):
+    """Accept triggers as JSON lines on 127.0.0.1:port."""
+    server = socket.create_server(("127.0.0.1", port))
+
+    def handle(conn):
+        with conn, conn.makefile() as lines:
+            for line in lines:
+                try:
+                    event = json.loads(line)
+                    capture.trigger(float(event["start"]), float(event["end"]))
+                except (ValueError, KeyError) as e:
+                    print(f"[WARN] Invalid trigger {line.strip()!r}: {e}")
+
+    def accept():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    print(f"Triggers on tcp://127.0.0.1:{port}")
+
+def start_detector(capture, low_rate, args):
+    """Run the stream detector on the low-rate stream in a thread; every event triggers a capture."""
+    from inference_service import MODEL_PATH
+    from model_manager import ModelManager
+    from stream_detector import StreamDetector, run_stream
+
+    model = ModelManager(MODEL_PATH, device=args.model_device)
+    detector = StreamDetector(model, step_seconds=args.step, min_score=args.min_score,
+                              on_event=[lambda e: capture.trigger(e["start"], e["end"])])
+    if detector.sr != low_rate:
+        raise SystemExit(f"--low-rate must be {detector.sr} Hz with --detect")
+    blocks = queue.Queue()
+    threading.Thread(target=run_stream, args=(iter(blocks.get, None), detector), daemon=True).start()
+    return blocks
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Low-rate recording with high-rate captures around the detected songs.")
+    p.add_argument("--device", default=ARECORD_DEVICE, help="ALSA capture device (env ARECORD_DEVICE)")
+    p.add_argument("--rate", type=int, default=44100, help="High sampling rate in Hz (default: 44100)")
+    p.add_argument("--channels", type=int, default=2, help="Channels (default: 2)")
+    p.add_argument("--low-rate", type=int, default=16000, help="Rate of the continuous clips in Hz (default: 16000)")
+    p.add_argument("--clip-seconds", type=float, default=60, help="Length of the low-rate clips (default: 60)")
+    p.add_argument("--audios", default=AUDIOS_DIR, help="Folder of the low-rate clips (predict_on_audio.py input)")
+    p.add_argument("--output", default=HIGHRATE_DIR, help="Folder of the high-rate captures (env HIGHRATE_DIR)")
+    p.add_argument("--buffer", type=float, default=180, help="Seconds of high-rate audio kept in memory (default: 180)")
+    p.add_argument("--pre", type=float, default=5, help="Seconds kept before a song (default: 5)")
+    p.add_argument("--post", type=float, default=5, help="Seconds kept after a song (default: 5)")
+    p.add_argument("--port", type=int, default=TRIGGER_PORT, help="Trigger port, 0 = none (env TRIGGER_PORT)")
+    p.add_argument("--detect", action="store_true", help="Trigger on the events of the stream detector")
+    p.add_argument("--step", type=float, default=2.0, help="--detect: seconds between two detections (default: 2)")
+    p.add_argument("--min-score", type=float, default=0.25, help="--detect: minimum score (default: 0.25)")
+    p.add_argument("--model-device", default="cpu", help="--detect: cpu or cuda (default: cpu)")
+    return p.parse_args()
+
+def main():
+    args = parse_args()
+    ring = CaptureRing(args.rate, args.channels, args.buffer)
+    capture = TriggeredCapture(ring, args.output, pre=args.pre, post=args.post)
+    downsample = Downsampler(args.rate, args.low_rate, args.channels)
+    writer = LowRateWriter(args.audios, args.low_rate, args.channels, args.clip_seconds)
+    if args.port:
+        serve_triggers(capture, args.port)
+    detector_blocks = start_detector(capture, args.low_rate, args) if args.detect else None
+    print(f"Buffer: {args.buffer:.0f}s at {args.rate} Hz x {args.channels} "
+          f"({ring.buffer.nbytes / 2**20:.0f} MiB), clips at {args.low_rate} Hz in {args.audios}")
+
+    command = ["arecord", "--device", args.device, "--rate", str(args.rate), "--format", "S16_LE",
+               "--channels", str(args.channels), "--file-type", "raw", "--quiet"]
+    block_bytes = args.rate // 4 * args.channels * 2
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
+    try:
+        while True:
+            data = proc.stdout.read(block_bytes)
+            if not data:
+                raise SystemExit(f"arecord stopped (exit code {proc.wait()})")
+            t_end = time.time()
+            block = np.frombuffer(data[:len(data) // (2 * args.channels) * 2 * args.channels], dtype="<i2")
+            block = block.reshape(-1, args.channels)
+            ring.write(block, t_end)
+            low = downsample(block)
+            writer.write(low, t_end)
+            if detector_blocks is not None:
+                detector_blocks.put((low.mean(axis=1) / 32768, t_end))
+            capture.poll()
+    except KeyboardInterrupt:
+        print("\nStopped.")
+    finally:
+        proc.terminate()
+        writer.close()
+        for start, end in capture.pending:
+            capture.write(start, min(end, ring.t_end))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+Asyncio upload engine of upload_to_s3.py (--engine async), for directories of thousands of small segment files.
+
+Compared with the thread pool, every file costs no thread and no per-file transfer manager:
+- one aiobotocore client, i.e. one pool of keep-alive connections shared by all the requests,
+- existence checks (HEAD) and uploads (PUT) run as two pipelined stages, so the HEAD of the next files is in
+  flight while the previous ones are uploading,
+- the number of requests in flight of each stage adapts to the observed latency and throughput (AdaptiveLimit),
+  between 1 and --max-inflight.
+
+Requires aiobotocore (pip install aiobotocore); the thread-pool engine stays the default.
+"""
+
+# Import libraries
+import asyncio
+import contextlib
+import itertools
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / "Code"))
+import metrics
+from content_index import content_key, file_sha256
+
+# Like the TransferConfig of the thread-pool engine: larger files go up in parts, one part in memory at a time
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+
+# Errors that mean "too many requests": back off instead of only counting a failure
+THROTTLING_CODES = {"SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded", "503", "TooManyRequests"}
+
+class AdaptiveLimit:
+    """
+    Concurrency limit of one stage, adapted every `window` requests (additive increase, multiplicative decrease).
+    The throughput of a stage is about limit / latency, so more requests in flight pay off as long as the latency
+    does not grow with them:
+    - +1 while the median latency stays under latency_factor x the best median seen,
+    - x0.75 when it rises above that (the endpoint or the uplink is saturated),
+    - /2 on a throttling or connection error.
+    """
+
+    def __init__(self, initial=8, minimum=1, maximum=64, window=16, latency_factor=1.5):
+        self.limit = max(minimum, min(initial, maximum))
+        self.minimum, self.maximum = minimum, maximum
+        self.window, self.latency_factor = window, latency_factor
+        self.inflight = 0
+        self.best_latency = float("inf")
+        self.throughput = 0.0
+        self._latencies = []
+        self._window_start = time.perf_counter()
+        self._cond = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.inflight < self.limit)
+            self.inflight += 1
+        t0 = time.perf_counter()
+        failed = False
+        try:
+            yield
+        except Exception as e:
+            failed = _is_throttling(e)
+            raise
+        finally:
+            async with self._cond:
+                self.inflight -= 1
+                self._record(time.perf_counter() - t0, failed)
+                self._cond.notify_all()
+
+    def _record(self, latency, failed):
+        if failed:
+            self._set_limit(self.limit // 2)
+            return
+        self._latencies.append(latency)
+        if len(self._latencies) < self.window:
+            return
+        now = time.perf_counter()
+        throughput = len(self._latencies) / max(now - self._window_start, 1e-9)
+        median = statistics.median(self._latencies)
+        self.best_latency = min(self.best_latency, median)
+        self.throughput = throughput
+        if median > self.latency_factor * self.best_latency:
+            self._set_limit(int(self.limit * 0.75))
+        else:
+            self._set_limit(self.limit + 1)
+
+    def _set_limit(self, limit):
+        self.limit = max(self.minimum, min(limit, self.maximum))
+        self._latencies, self._window_start = [], time.perf_counter()
+
+def _is_throttling(e):
+    response = getattr(e, "response", None) or {}
+    code = str(response.get("Error", {}).get("Code", ""))
+    status = str(response.get("ResponseMetadata", {}).get("HTTPStatusCode", ""))
+    return code in THROTTLING_CODES or status in THROTTLING_CODES or isinstance(e, (ConnectionError, asyncio.TimeoutError))
+
+def _not_found(e):
+    response = getattr(e, "response", None) or {}
+    code = response.get("Error", {}).get("Code")
+    status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return code in {"404", "NotFound", "NoSuchKey"} or status == 404
+
+async def _put_file(s3, bucket, key, path, content_type):
+    """Upload a file without reading it into memory first. Returns its size."""
+    size = path.stat().st_size
+    if size < MULTIPART_THRESHOLD:
+        # Streamed from the file by the HTTP client
+        with open(path, "rb") as body:
+            await s3.put_object(Bucket=bucket, Key=key, Body=body, ContentType=content_type)
+        return size
+
+    upload_id = (await s3.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type))["UploadId"]
+    parts = []
+    try:
+        with open(path, "rb") as f:
+            for number in itertools.count(1):
+                chunk = await asyncio.to_thread(f.read, MULTIPART_CHUNKSIZE)
+                if not chunk:
+                    break
+                part = await s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=chunk)
+                parts.append({"ETag": part["ETag"], "PartNumber": number})
+        await s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+    except BaseException:
+        with contextlib.suppress(Exception):
+            await s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    return size
+
+async def _run(args, tasks, local_base, index, names, guess_content_type, delete_local):
+    try:
+        from aiobotocore.config import AioConfig
+        from aiobotocore.session import get_session
+    except ImportError:
+        print("ERROR: --engine async requires aiobotocore (pip install aiobotocore).", file=sys.stderr)
+        sys.exit(2)
+
+    counts = {"OK": 0, "DRY": 0, "SKIP": 0, "ERR": 0}
+    head_limit = AdaptiveLimit(initial=min(16, args.max_inflight), maximum=args.max_inflight)
+    put_limit = AdaptiveLimit(initial=min(8, args.max_inflight), maximum=args.max_inflight)
+    to_check = asyncio.Queue()
+    to_put = asyncio.Queue(maxsize=2 * args.max_inflight)
+    for task in tasks:
+        to_check.put_nowait(task)
+
+    config = AioConfig(
+        retries={"max_attempts": 6, "mode": "standard"},
+        connect_timeout=10,
+        read_timeout=300,
+        max_pool_connections=2 * args.max_inflight,  # both stages share the pool
+        s3={"addressing_style": "path"},
+    )
+    session = get_session()
+    async with session.create_client("s3", region_name=args.region, endpoint_url=args.endpoint or None, config=config) as s3:
+
+        async def check():
+            # Stage 1: hash, content index and HEAD
+            while True:
+                try:
+                    f, k = to_check.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    digest = None
+                    if index is not None:
+                        digest = await asyncio.to_thread(file_sha256, f)
+                        index.add_name(f.name, digest=digest)
+                        if args.content_addressed:
+                            k = content_key(digest, f.suffix, args.prefix)
+                        uploaded_key = index.uploaded_key(digest)
+                        # A duplicate is found under the key its content was uploaded to
+                        names.append({"name": f.relative_to(local_base).as_posix(), "hash": digest, "key": uploaded_key or k})
+                        if uploaded_key and not args.dry_run:
+                            print(f"[SKP] Same content already uploaded as s3://{args.bucket}/{uploaded_key}: {f}")
+                            metrics.UPLOADS.inc(result="skip")
+                            counts["SKIP"] += 1
+                            if args.delete:
+                                delete_local(f)
+                            continue
+                    if args.only_missing and not args.dry_run:
+                        try:
+                            async with head_limit.slot():
+                                await s3.head_object(Bucket=args.bucket, Key=k)
+                            print(f"[SKP] Exists remotely, skipping: {f}")
+                            if index is not None:
+                                index.add_object(digest, f.stat().st_size, k)
+                            metrics.UPLOADS.inc(result="skip")
+                            counts["SKIP"] += 1
+                            continue
+                        except Exception as e:
+                            if not _not_found(e):
+                                raise
+                    await to_put.put((f, k, digest))
+                except Exception as e:
+                    print(f"[ERR] {f} -> s3://{args.bucket}/{k}: {e}", file=sys.stderr)
+                    metrics.UPLOADS.inc(result="error")
+                    counts["ERR"] += 1
+
+        async def put():
+            # Stage 2: PUT
+            while True:
+                item = await to_put.get()
+                if item is None:
+                    return
+                f, k, digest = item
+                try:
+                    if args.dry_run:
+                        print(f"[DRY] Would upload: {f} -> s3://{args.bucket}/{k}")
+                        counts["DRY"] += 1
+                        continue
+                    async with put_limit.slot():
+                        with metrics.trace("upload", key=k, bytes=f.stat().st_size):
+                            size = await _put_file(s3, args.bucket, k, f, guess_content_type(f))
+                    print(f"[OK ] Uploaded: {f} -> s3://{args.bucket}/{k}")
+                    if index is not None:
+                        index.add_object(digest, size, k)
+                    if args.delete:
+                        delete_local(f)
+                    metrics.UPLOADS.inc(result="ok")
+                    counts["OK"] += 1
+                except Exception as e:
+                    print(f"[ERR] {f} -> s3://{args.bucket}/{k}: {e}", file=sys.stderr)
+                    metrics.UPLOADS.inc(result="error")
+                    counts["ERR"] += 1
+
+        # One worker per possible request in flight, the limits decide how many actually run
+        checkers = [asyncio.create_task(check()) for _ in range(args.max_inflight)]
+        putters = [asyncio.create_task(put()) for _ in range(args.max_inflight)]
+        await asyncio.gather(*checkers)
+        for _ in putters:
+            await to_put.put(None)
+        await asyncio.gather(*putters)
+
+    for name, limit in (("HEAD", head_limit), ("PUT", put_limit)):
+        if limit.best_latency < float("inf"):
+            print(f"{name}: {limit.limit} in flight at the end, {limit.throughput:.1f} req/s, "
+                  f"best median latency {limit.best_latency * 1000:.0f} ms")
+    return counts["OK"] + counts["DRY"], counts["SKIP"], counts["ERR"]
+
+def upload_async(args, tasks, local_base, index, names, guess_content_type, delete_local):
+    """
+    Upload the (path, key) tasks with the asyncio engine. Same behaviour and output as the thread-pool engine
+    of upload_to_s3.py.
+
+    Returns:
+        tuple: (uploaded, skipped, failed)
+    """
+    return asyncio.run(_run(args, tasks, local_base, index, names, guess_content_type, delete_local))
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Benchmark the upload engines of upload_to_s3.py (thread pool vs asyncio) against a local S3 stand-in.
+
+The stand-in is a small in-memory HTTP server that answers HEAD/PUT/GET (and multipart uploads) with path-style
+keys, adds a fixed latency to every request (to mimic the round trip from a station to the bucket) and counts the
+requests and the TCP connections it receives. simulate_station.py uses it as the bucket of a simulated station. Each engine uploads the same directory of small files twice:
+- cold: nothing exists remotely, every file costs a HEAD (404) and a PUT,
+- warm: everything exists, every file costs a HEAD only.
+
+Example:
+  python benchmark_upload.py --files 2000 --size 16384 --latency 0.02
+"""
+
+# Import libraries
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+UPLOADER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "upload_to_s3.py")
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Compare the thread-pool and asyncio upload engines on many small files.")
+    p.add_argument("--files", type=int, default=2000, help="Number of files (default: 2000)")
+    p.add_argument("--size", type=int, default=16384, help="Size of every file in bytes (default: 16384)")
+    p.add_argument("--latency", type=float, default=0.02, help="Latency added to every request in seconds (default: 0.02)")
+    p.add_argument("--workers", type=int, default=4, help="Workers of the thread-pool engine (default: 4)")
+    p.add_argument("--max-inflight", type=int, default=32, help="Max requests in flight of the async engine (default: 32)")
+    p.add_argument("--engines", default="threads,async", help="Engines to compare (default: threads,async)")
+    return p.parse_args()
+
+class S3StandIn(ThreadingHTTPServer):
+    """
+    In-memory S3 subset: HEAD, PUT and GET of objects and multipart uploads, with a fixed latency per request.
+    With keep_bodies=False only the keys and sizes are kept (long runs), GET then returns empty objects.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency, keep_bodies=True):
+        self.latency = latency
+        self.keep_bodies = keep_bodies
+        self.objects = {}
+        self.multipart = {}  # upload id -> {part number: body}
+        self.counts = {"HEAD": 0, "PUT": 0, "GET": 0, "POST": 0, "connections": 0, "bytes": 0}
+        self.lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), _Handler)
+
+    def store(self, key, body):
+        with self.lock:
+            self.counts["bytes"] += len(body)
+            self.objects[key] = body if self.keep_bodies else b""
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def reset_counts(self):
+        with self.lock:
+            self.counts = dict.fromkeys(self.counts, 0)
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so connection reuse shows in the counts
+
+    def setup(self):
+        super().setup()
+        self.server.count("connections")
+
+    def _reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    # Trailers (e.g. checksums) up to the empty line
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_HEAD(self):
+        self.server.count("HEAD")
+        time.sleep(self.server.latency)
+        body = self.server.objects.get(self.path.split("?")[0])
+        if body is None:
+            return self._reply(404)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", f'"{hash(body) & 0xffffffff:08x}"')
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.count("GET")
+        time.sleep(self.server.latency)
+        body = self.server.objects.get(self.path.split("?")[0])
+        if body is None:
+            return self._reply(404, b"<Error><Code>NoSuchKey</Code></Error>", {"Content-Type": "application/xml"})
+        self._reply(200, body)
+
+    def do_PUT(self):
+        self.server.count("PUT")
+        body = self._read_body()
+        time.sleep(self.server.latency)
+        query = parse_qs(urlparse(self.path).query)
+        if "uploadId" in query:
+            # Part of a multipart upload
+            parts = self.server.multipart.get(query["uploadId"][0])
+            if parts is None:
+                return self._reply(404, b"<Error><Code>NoSuchUpload</Code></Error>", {"Content-Type": "application/xml"})
+            parts[int(query["partNumber"][0])] = body
+        else:
+            self.server.store(self.path.split("?")[0], body)
+        self._reply(200, headers={"ETag": f'"{hash(body) & 0xffffffff:08x}"'})
+
+    def do_POST(self):
+        self.server.count("POST")
+        self._read_body()
+        time.sleep(self.server.latency)
+        key, _, query = self.path.partition("?")
+        query = parse_qs(query, keep_blank_values=True)
+        bucket, _, name = key.lstrip("/").partition("/")
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            self.server.multipart[upload_id] = {}
+            body = (f"<InitiateMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{name}</Key>"
+                    f"<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>")
+        elif "uploadId" in query:
+            parts = self.server.multipart.pop(query["uploadId"][0], None)
+            if parts is None:
+                return self._reply(404, b"<Error><Code>NoSuchUpload</Code></Error>", {"Content-Type": "application/xml"})
+            self.server.store(key, b"".join(parts[n] for n in sorted(parts)))
+            body = (f"<CompleteMultipartUploadResult><Bucket>{bucket}</Bucket><Key>{name}</Key>"
+                    f'<ETag>"{len(parts)}"</ETag></CompleteMultipartUploadResult>')
+        else:
+            return self._reply(400, b"<Error><Code>InvalidRequest</Code></Error>", {"Content-Type": "application/xml"})
+        self._reply(200, body.encode(), {"Content-Type": "application/xml"})
+
+    def do_DELETE(self):
+        # Abort of a multipart upload
+        query = parse_qs(urlparse(self.path).query)
+        self.server.multipart.pop(query.get("uploadId", [""])[0], None)
+        self._reply(204)
+
+    def log_message(self, *args):
+        pass
+
+def make_files(root, count, size):
+    """count files of random bytes, spread over folders like a day of segments."""
+    for i in range(count):
+        folder = os.path.join(root, f"{i // 500:03d}")
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"segment_{i:06d}.flac"), "wb") as f:
+            f.write(os.urandom(size))
+
+def run_uploader(engine, data_dir, endpoint, args):
+    cmd = [sys.executable, UPLOADER, "--dir", data_dir, "--bucket", "bench", "--endpoint", endpoint,
+           "--prefix", f"{engine}/", "--engine", engine, "--workers", str(args.workers),
+           "--max-inflight", str(args.max_inflight)]
+    env = dict(os.environ, AWS_ACCESS_KEY_ID="bench", AWS_SECRET_ACCESS_KEY="bench", METRICS_DIR="", CONTENT_INDEX="")
+    t0 = time.perf_counter()
+    out = subprocess.run(cmd, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - t0
+    done = re.search(r"Uploaded: (\d+), Skipped: (\d+), Failed: (\d+)", out.stdout)
+    if out.returncode or not done:
+        print(out.stdout[-2000:], out.stderr[-2000:], file=sys.stderr)
+        raise SystemExit(f"{engine} uploader failed (exit code {out.returncode})")
+    return elapsed, tuple(int(n) for n in done.groups())
+
+def main():
+    args = parse_args()
+    server = S3StandIn(args.latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        make_files(data_dir, args.files, args.size)
+        print(f"{args.files} files of {args.size / 1024:.0f} KiB, {args.latency * 1000:.0f} ms per request, S3 stand-in on {endpoint}\n")
+        print(f"{'engine':8} {'pass':5} {'seconds':>8} {'files/s':>8} {'MiB/s':>7} {'HEAD':>6} {'PUT':>6} {'conns':>6}  uploaded/skipped/failed")
+        for engine in args.engines.split(","):
+            for label in ("cold", "warm"):
+                server.reset_counts()
+                elapsed, (uploaded, skipped, failed) = run_uploader(engine, data_dir, endpoint, args)
+                c = server.counts
+                print(f"{engine:8} {label:5} {elapsed:8.2f} {args.files / elapsed:8.1f} "
+                      f"{uploaded * args.size / elapsed / 2**20:7.2f} {c['HEAD']:6} {c['PUT']:6} {c['connections']:6}  "
+                      f"{uploaded}/{skipped}/{failed}")
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
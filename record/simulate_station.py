@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Accelerated-clock station simulator and soak test of the production loop, to catch slow leaks in an hour.
+
+The station (Code/predict_on_audio.py, which runs upload_to_s3.py every 10 clips) is started unchanged in a
+station folder of its own (env STATION_ROOT) and fed by a simulated recorder instead of record_upload.py: the
+recordings of --audios are replayed in turn, in the format of the recorder (--rate, --channels, one clip per
+minute named after the simulated clock), --speed times faster than real time. The bucket is the local S3
+stand-in of benchmark_upload.py. By default the speed is derived from the time the station takes per clip,
+measured on a few clips before the run, so that it is busy half of the time. Leaks grow with the number of clips,
+so --clip-seconds can replay shorter clips to make every clip cheaper, and the run faster.
+
+Every --sample-interval seconds the station is sampled: RSS (of the main process and of all its processes),
+open file descriptors, threads, child processes (and zombies), clips waiting in data_temp/Audios and disk use of
+the station folder. The samples go to --output (CSV). After --warmup of the run, the growth per simulated day
+of RSS, descriptors and disk is fitted and compared with the --max-*-growth bounds, the child processes and the
+queue with their --max-* bounds. The exit code is 1 when a bound is exceeded or when the station died.
+
+Examples:
+  python simulate_station.py --days 30 --clip-seconds 10
+  python simulate_station.py --days 2 --speed 60 --root /tmp/station --keep
+  BIRD_MODEL_VARIANT=int8 python simulate_station.py --days 7 --speed 200 --output week.csv
+"""
+
+# Import libraries
+import argparse
+import csv
+import glob
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from benchmark_upload import S3StandIn
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STATION = os.path.join(HERE, "Code", "predict_on_audio.py")
+CLIP_SECONDS = 60  # record_upload.py records one clip per minute
+# Share of the time the station is busy at the measured speed, the rest absorbs uploads and slower clips
+UTILISATION = 0.5
+CALIBRATION_CLIPS = 3
+# Folders of a station, as under /opt/bird-files/record
+STATION_DIRS = ["data_temp/Audios", "data_temp/Images", "data_temp/Segments", "data", "metrics",
+                "Code/runs/detect/predict"]
+DISK_GROUPS = ["data_temp", "data", "runs", "metrics"]
+
+def parse_args():
+    p = argparse.ArgumentParser(description="Replay recordings into the station loop faster than real time and check for leaks.")
+    p.add_argument("--audios", default=os.path.join(HERE, "..", "Bird-Song-Detector", "Data", "Audios"),
+                   help="Recordings replayed in turn (default: Bird-Song-Detector/Data/Audios)")
+    p.add_argument("--days", type=float, default=30, help="Simulated days (default: 30)")
+    p.add_argument("--speed", type=float, help="Simulated seconds per second (default: from the measured time per clip)")
+    p.add_argument("--clip-seconds", type=float, default=CLIP_SECONDS, help="Audio in every clip, the clock still advances a minute per clip (default: 60)")
+    p.add_argument("--rate", type=int, default=44100, help="Sample rate of the simulated recorder (default: 44100, as record_upload.py)")
+    p.add_argument("--channels", type=int, default=2, help="Channels of the simulated recorder (default: 2)")
+    p.add_argument("--start", default="2024-01-01_00-00-00", help="Simulated start time (default: 2024-01-01_00-00-00)")
+    p.add_argument("--root", help="Station folder (default: a temporary folder, removed at the end unless --keep)")
+    p.add_argument("--keep", action="store_true", help="Keep the station folder (station log in output.log)")
+    p.add_argument("--sample-interval", type=float, default=5, help="Seconds between two samples (default: 5)")
+    p.add_argument("--warmup", type=float, default=0.1, help="Fraction of the run not checked (default: 0.1)")
+    p.add_argument("--max-rss-growth", type=float, default=5, help="MB per simulated day (default: 5)")
+    p.add_argument("--max-fd-growth", type=float, default=1, help="Open descriptors per simulated day (default: 1)")
+    p.add_argument("--max-disk-growth", type=float, default=50, help="MB per simulated day (default: 50)")
+    p.add_argument("--max-children", type=int, default=8, help="Child processes at any time (default: 8)")
+    p.add_argument("--max-queue", type=int, default=30, help="Clips waiting to be processed at any time (default: 30)")
+    p.add_argument("--output", default="soak_timeline.csv", help="Samples (default: soak_timeline.csv)")
+    return p.parse_args()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def render_sources(audios, cache_dir, rate, channels, seconds):
+    """The recordings in the format of the recorder (16-bit WAV), rendered once and copied for every clip."""
+    import librosa
+    import soundfile as sf
+
+    paths = sorted(p for p in glob.glob(os.path.join(audios, "*")) if p.lower().endswith((".wav", ".flac")))
+    if not paths:
+        raise SystemExit(f"No recordings in {audios}")
+    rendered = []
+    for path in paths:
+        y, _ = librosa.load(path, sr=rate, mono=False, duration=seconds)
+        y = np.atleast_2d(y)
+        y = np.resize(y, (channels, y.shape[1]))  # repeat or drop channels
+        out = os.path.join(cache_dir, os.path.splitext(os.path.basename(path))[0] + ".wav")
+        sf.write(out, y.T, rate, subtype="PCM_16")
+        rendered.append(out)
+    return rendered
+
+class Recorder(threading.Thread):
+    """Writes the next clip into data_temp/Audios every CLIP_SECONDS / speed seconds, like record_upload.py."""
+
+    def __init__(self, sources, audios_dir, start, speed, clips):
+        super().__init__(name="recorder", daemon=True)
+        self.sources = sources
+        self.audios_dir = audios_dir
+        self.start_time = start
+        self.speed = speed
+        self.clips = clips
+        self.written = 0
+        self.stop_event = threading.Event()
+
+    def run(self):
+        t0 = time.monotonic()
+        for i in range(self.clips):
+            # Behind schedule (slow disk) the clips are written back to back, the clock is not slowed down
+            if self.stop_event.wait(max(0.0, t0 + i * CLIP_SECONDS / self.speed - time.monotonic())):
+                return
+            stamp = (self.start_time + timedelta(seconds=i * CLIP_SECONDS)).strftime("%Y-%m-%d_%H-%M-%S")
+            shutil.copyfile(self.sources[i % len(self.sources)], os.path.join(self.audios_dir, f"{stamp}.wav"))
+            self.written = i + 1
+
+    def stop(self):
+        self.stop_event.set()
+
+def process_tree(pid):
+    """Descendants of pid as (pid, state), from /proc."""
+    parents = {}
+    for stat in glob.glob("/proc/[0-9]*/stat"):
+        try:
+            with open(stat) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue  # exited meanwhile
+        parents.setdefault(int(fields[1]), []).append((int(stat.split("/")[2]), fields[0]))
+    tree, todo = [], [pid]
+    while todo:
+        for child in parents.get(todo.pop(), []):
+            tree.append(child)
+            todo.append(child[0])
+    return tree
+
+def proc_status(pid):
+    """VmRSS in MB and threads of a process (0, 0 once it exited)."""
+    rss = threads = 0
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) / 1024
+                elif line.startswith("Threads:"):
+                    threads = int(line.split()[1])
+    except OSError:
+        pass
+    return rss, threads
+
+def disk_usage(root):
+    """MB used under root, in total and by group of folders (runs: runs/ and Code/runs/ of the station)."""
+    usage = dict.fromkeys(DISK_GROUPS + ["other"], 0)
+    for folder, _, files in os.walk(root):
+        relative = os.path.relpath(folder, root).split(os.sep)
+        group = "runs" if "runs" in relative[:2] else relative[0] if relative[0] in DISK_GROUPS else "other"
+        for name in files:
+            try:
+                usage[group] += os.lstat(os.path.join(folder, name)).st_blocks * 512
+            except OSError:
+                pass
+    usage = {group: size / 2**20 for group, size in usage.items()}
+    return sum(usage.values()), usage
+
+def sample(station, root, recorder, t0, speed):
+    tree = process_tree(station.pid)
+    rss, threads = proc_status(station.pid)
+    try:
+        fds = len(os.listdir(f"/proc/{station.pid}/fd"))
+    except OSError:
+        fds = 0
+    audios = os.path.join(root, "data_temp", "Audios")
+    disk, groups = disk_usage(root)
+    elapsed = time.monotonic() - t0
+    row = {
+        "wall_s": round(elapsed, 1),
+        "sim_days": round(elapsed * speed / 86400, 4),
+        "clips": recorder.written,
+        "queue": max(0, len([f for f in os.listdir(audios) if f.endswith(".wav")]) - 1),
+        "rss_mb": round(rss, 1),
+        "tree_rss_mb": round(rss + sum(proc_status(pid)[0] for pid, state in tree if state != "Z"), 1),
+        "fds": fds,
+        "threads": threads,
+        "children": sum(state != "Z" for _, state in tree),
+        "zombies": sum(state == "Z" for _, state in tree),
+        "disk_mb": round(disk, 2),
+    }
+    row.update({f"disk_{group}_mb": round(size, 2) for group, size in groups.items()})
+    return row
+
+def check(rows, args):
+    """(metric, start, end, growth per day or max, limit, ok) of the samples after the warm-up."""
+    steady = [r for r in rows if r["wall_s"] >= rows[-1]["wall_s"] * args.warmup]
+    checks = []
+    if len(steady) >= 3 and steady[-1]["sim_days"] > steady[0]["sim_days"]:
+        days = np.array([r["sim_days"] for r in steady])
+        for metric, limit in (("rss_mb", args.max_rss_growth), ("tree_rss_mb", args.max_rss_growth),
+                              ("fds", args.max_fd_growth), ("disk_mb", args.max_disk_growth)):
+            values = np.array([r[metric] for r in steady], dtype=float)
+            slope = float(np.polyfit(days, values, 1)[0])
+            checks.append((f"{metric} per day", values[0], values[-1], slope, limit, slope <= limit))
+    for metric, limit in (("children", args.max_children), ("queue", args.max_queue)):
+        values = [r[metric] for r in steady]
+        checks.append((f"{metric} max", values[0], values[-1], max(values), limit, max(values) <= limit))
+    return checks
+
+def prepare_station(root):
+    for folder in STATION_DIRS:
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+    shutil.copy2(os.path.join(HERE, "convert.sh"), root)
+
+def wait_until_ready(station, log_path, timeout=600):
+    """Wait for the model to be loaded, the recorder starts then (the first clips would only queue up)."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if station.poll() is not None:
+            return False
+        with open(log_path, errors="replace") as f:
+            if "Model ready" in f.read():
+                return True
+        time.sleep(0.5)
+    return False
+
+def measure_clip_seconds(station, sources, audios_dir, metrics_dir, start, clips=CALIBRATION_CLIPS, timeout=600):
+    """
+    Median seconds the station takes per clip, from its "clip" trace events: clips recordings stamped before the
+    simulated start are queued at once. None when the station did not process them.
+    """
+    # One more, the newest clip is taken as still being recorded
+    for i in range(clips + 1):
+        stamp = (start - timedelta(seconds=(clips + 1 - i) * CLIP_SECONDS)).strftime("%Y-%m-%d_%H-%M-%S")
+        shutil.copyfile(sources[i % len(sources)], os.path.join(audios_dir, f"{stamp}.wav"))
+    traces = os.path.join(metrics_dir, "traces.jsonl")
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and station.poll() is None:
+        time.sleep(0.5)
+        if not os.path.exists(traces):
+            continue
+        with open(traces) as f:
+            durations = [event["duration"] for event in map(json.loads, f) if event["stage"] == "clip"]
+        if len(durations) >= clips:
+            return float(np.median(durations))
+    return None
+
+def stop_station(station):
+    try:
+        os.killpg(station.pid, signal.SIGTERM)
+        station.wait(10)
+    except subprocess.TimeoutExpired:
+        os.killpg(station.pid, signal.SIGKILL)
+        station.wait()
+    except ProcessLookupError:
+        pass
+
+def main():
+    args = parse_args()
+    root = os.path.abspath(args.root) if args.root else tempfile.mkdtemp(prefix="station_")
+    prepare_station(root)
+    cache_dir = tempfile.mkdtemp(prefix="station_clips_")  # outside the station folder, not in its disk use
+    sources = render_sources(args.audios, cache_dir, args.rate, args.channels, args.clip_seconds)
+
+    s3 = S3StandIn(latency=0.0, keep_bodies=False)
+    threading.Thread(target=s3.serve_forever, daemon=True).start()
+    env = dict(os.environ, STATION_ROOT=root, METRICS_DIR=os.path.join(root, "metrics"), METRICS_PORT=str(free_port()),
+               POLL_SECONDS=str(max(0.05, 30 / args.speed) if args.speed else 0.25), S3_ENDPOINT=f"http://127.0.0.1:{s3.server_address[1]}",
+               S3_BUCKET="station-sim", AWS_ACCESS_KEY_ID="sim", AWS_SECRET_ACCESS_KEY="sim", AWS_REGION="auto",
+               PYTHONUNBUFFERED="1",
+               # The clip names follow the simulated clock, not the real one the lag is measured with
+               LAG_BUDGET="0")
+    log_path = os.path.join(root, "output.log")
+    log = open(log_path, "w")
+    # Started from the station folder like the nohup of the stations, in a session of its own to stop every process
+    station = subprocess.Popen([sys.executable, STATION], cwd=root, env=env, stdout=log, stderr=subprocess.STDOUT,
+                               start_new_session=True)
+    clips = int(args.days * 86400 / CLIP_SECONDS)
+    start = datetime.strptime(args.start, "%Y-%m-%d_%H-%M-%S")
+    audios_dir = os.path.join(root, "data_temp", "Audios")
+
+    rows, died = [], False
+    recorder = None
+    try:
+        if not wait_until_ready(station, log_path):
+            raise SystemExit(f"The station did not start, see {log_path}")
+        if not args.speed:
+            clip_seconds = measure_clip_seconds(station, sources, audios_dir, env["METRICS_DIR"], start)
+            if clip_seconds is None:
+                raise SystemExit(f"The station did not process the calibration clips, see {log_path}")
+            args.speed = UTILISATION * CLIP_SECONDS / clip_seconds
+            print(f"{clip_seconds:.2f}s per clip, speed {args.speed:.1f}x")
+        print(f"Station {station.pid} in {root}, {len(sources)} recordings of {args.clip_seconds:.0f}s at "
+              f"{args.rate} Hz x {args.channels}, {clips} clips over {args.days:g} simulated days at {args.speed:g}x "
+              f"(~{clips * CLIP_SECONDS / args.speed / 3600:.1f} h)")
+        recorder = Recorder(sources, audios_dir, start, args.speed, clips)
+        recorder.start()
+        t0 = time.monotonic()
+        with open(args.output, "w", newline="") as f:
+            writer = None
+            while recorder.is_alive():
+                time.sleep(args.sample_interval)
+                if station.poll() is not None:
+                    died = True
+                    print(f"The station exited with code {station.returncode}")
+                    break
+                row = sample(station, root, recorder, t0, args.speed)
+                if writer is None:
+                    writer = csv.DictWriter(f, fieldnames=list(row))
+                    writer.writeheader()
+                writer.writerow(row)
+                f.flush()
+                rows.append(row)
+                print(f"day {row['sim_days']:6.2f}: {row['clips']} clips, queue {row['queue']}, RSS {row['rss_mb']:.0f} MB "
+                      f"({row['tree_rss_mb']:.0f} MB with children), {row['fds']} fds, {row['children']} children, "
+                      f"{row['zombies']} zombies, disk {row['disk_mb']:.1f} MB")
+    except KeyboardInterrupt:
+        print("\nInterrupted, checking the samples so far")
+    finally:
+        if recorder:
+            recorder.stop()
+        stop_station(station)
+        log.close()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        s3.shutdown()
+
+    failed = died
+    if rows:
+        print(f"\n{rows[-1]['sim_days']:.2f} simulated days in {rows[-1]['wall_s'] / 60:.1f} min, {rows[-1]['clips']} clips, "
+              f"{len(s3.objects)} objects ({s3.counts['bytes'] / 2**20:.0f} MB) uploaded, samples in {args.output}")
+        print(f"{'check':20} {'start':>9} {'end':>9} {'value':>9} {'limit':>7}")
+        for metric, start, end, value, limit, ok in check(rows, args):
+            failed |= not ok
+            print(f"{metric:20} {start:9.1f} {end:9.1f} {value:9.2f} {limit:7g}  {'ok' if ok else 'FAIL'}")
+    if died or failed:
+        with open(log_path, errors="replace") as f:
+            print("\nEnd of the station log:\n" + "".join(f.readlines()[-20:]))
+    if args.keep or failed:
+        print(f"Station folder kept: {root}")
+    else:
+        shutil.rmtree(root, ignore_errors=True)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -3,35 +3,51 @@
 Upload a local directory to S3 (or S3-compatible) with:
 - "only-missing" behavior (skip if object already exists),
 - optional deletion of local files after successful upload,
-- env-var defaults so you can just `export ...` then run.
+- env-var defaults so you can just `export ...` then run,
+- optional content index (--index): identical bytes are uploaded once, whatever their file name, and the file
+  name -> hash -> key mapping of every run is uploaded as index/<host>/<time>_<random>.jsonl. Objects keep their name keys
+  unless --content-addressed keys them by their SHA-256 (objects/ab/abcd....flac).
 
 ENV (all optional except AWS creds):
   S3_BUCKET         # e.g., birdsound
   S3_PREFIX         # e.g., uploaded_files
   S3_ENDPOINT       # e.g., https://<r2-or-minio-endpoint>
   AWS_REGION        # e.g., ap-southeast-1 (or AWS_DEFAULT_REGION)
+  CONTENT_INDEX     # e.g., /opt/bird-files/record/content_index.sqlite
+  S3_CONTENT_ADDRESSED  # 1 to key objects by content hash
+  UPLOAD_ENGINE     # threads (default) or async (asyncio + aiobotocore, see async_upload.py)
 
 Examples:
   python upload_to_s3.py --dir data --delete
   python upload_to_s3.py --dir data_temp/Audios --workers 4 --dry-run
   python upload_to_s3.py --dir data --prefix uploaded_files/ --endpoint https://<endpoint>
+  python upload_to_s3.py --dir data --delete --index content_index.sqlite --content-addressed
+  python upload_to_s3.py --dir data --delete --engine async --max-inflight 32
 """
 
 
 import argparse
 import concurrent.futures as cf
+import json
 import mimetypes
 import os
 from pathlib import Path
+import socket
 import sys
 import time
+import uuid
 
-import boto3
-from botocore.config import Config as BotoConfig
-from boto3.s3.transfer import TransferConfig
-from botocore.exceptions import ClientError
+# Shared pipeline modules (metrics) live in Code/
+sys.path.insert(0, str(Path(__file__).resolve().parent / "Code"))
+import metrics
+from content_index import ContentIndex, content_key, file_sha256
 
-def parse_args():
+# boto3 takes most of the start-up time, it is imported by the functions that use it, so --help and a run with
+# nothing to upload return at once. predict_on_audio.py preloads BOTO3_MODULES once in its forkserver instead of
+# importing them again for every periodic upload.
+BOTO3_MODULES = ["boto3", "boto3.s3.transfer", "botocore.config", "botocore.exceptions"]
+
+def parse_args(argv=None):
     p = argparse.ArgumentParser(description="Upload a directory to S3 (only-missing; optional delete).")
     # Now optional flags; fall back to env
     p.add_argument("--bucket", default=os.getenv("S3_BUCKET"), help="S3 bucket name (env S3_BUCKET)")
@@ -47,10 +63,23 @@ def parse_args():
                    help="Disable the only-missing behavior.")
     p.add_argument("--delete", action="store_true", help="Delete local file after successful upload.")
     p.add_argument("--workers", type=int, default=4, help="Concurrent upload workers (default: 4).")
+    p.add_argument("--engine", choices=("threads", "async"), default=os.getenv("UPLOAD_ENGINE", "threads"),
+                   help="threads: thread pool of --workers; async: pipelined asyncio uploads (env UPLOAD_ENGINE).")
+    p.add_argument("--max-inflight", type=int, default=32,
+                   help="Async engine: upper bound of the adaptive number of requests in flight (default: 32).")
     p.add_argument("--dry-run", action="store_true", help="Print actions without uploading.")
-    return p.parse_args()
+    p.add_argument("--metrics-dir", default=os.getenv("METRICS_DIR", ""),
+                   help="Publish upload metrics (upload.prom) and trace events there (env METRICS_DIR).")
+    p.add_argument("--index", default=os.getenv("CONTENT_INDEX", ""),
+                   help="Content index (SQLite): skip content already uploaded under any name (env CONTENT_INDEX).")
+    p.add_argument("--content-addressed", action="store_true", default=os.getenv("S3_CONTENT_ADDRESSED") == "1",
+                   help="Key objects by the SHA-256 of their content (requires --index; env S3_CONTENT_ADDRESSED=1).")
+    return p.parse_args(argv)
 
 def build_s3_client(endpoint: str, region: str):
+    import boto3
+    from botocore.config import Config as BotoConfig
+
     cfg = BotoConfig(
         retries={"max_attempts": 6, "mode": "standard"},
         connect_timeout=10,
@@ -63,12 +92,19 @@ def build_s3_client(endpoint: str, region: str):
         kwargs["endpoint_url"] = endpoint
     return boto3.client("s3", **kwargs)
 
-TRANSFER_CFG = TransferConfig(
-    multipart_threshold=8 * 1024 * 1024,  # 8 MB
-    multipart_chunksize=8 * 1024 * 1024,
-    max_concurrency=4,
-    use_threads=True,
-)
+_transfer_cfg = None
+
+def transfer_config():
+    global _transfer_cfg
+    if _transfer_cfg is None:
+        from boto3.s3.transfer import TransferConfig
+        _transfer_cfg = TransferConfig(
+            multipart_threshold=8 * 1024 * 1024,  # 8 MB
+            multipart_chunksize=8 * 1024 * 1024,
+            max_concurrency=4,
+            use_threads=True,
+        )
+    return _transfer_cfg
 
 def guess_content_type(path: Path) -> str:
     ctype, _ = mimetypes.guess_type(str(path))
@@ -87,6 +123,8 @@ def key_for(local_base: Path, file_path: Path, prefix: str) -> str:
     return f"{prefix}{rel}"
 
 def object_exists(s3, bucket: str, key: str) -> bool:
+    from botocore.exceptions import ClientError
+
     try:
         s3.head_object(Bucket=bucket, Key=key)
         return True
@@ -108,25 +146,39 @@ def upload_one(s3, bucket: str, path: Path, key: str, dry_run: bool, delete: boo
         Bucket=bucket,
         Key=key,
         ExtraArgs=extra_args,
-        Config=TRANSFER_CFG,
+        Config=transfer_config(),
     )
     print(f"[OK ] Uploaded: {path} -> s3://{bucket}/{key}")
 
     if delete:
-        try:
-            path.unlink()
-            print(f"[DEL] Removed local: {path}")
-        except Exception as e:
-            print(f"[WARN] Uploaded but failed to delete local {path}: {e}", file=sys.stderr)
+        delete_local(path)
     return "OK"
 
+def delete_local(path: Path):
+    try:
+        path.unlink()
+        print(f"[DEL] Removed local: {path}")
+    except Exception as e:
+        print(f"[WARN] Failed to delete local {path}: {e}", file=sys.stderr)
+
+def upload_name_index(s3, bucket: str, prefix: str, names: list):
+    """Upload the file name -> content hash mapping of this run, so the bucket can be searched by file name."""
+    if prefix and not prefix.endswith("/"):
+        prefix += "/"
+    # Two runs can end in the same second (periodic uploads of the station)
+    key = f"{prefix}index/{socket.gethostname()}/{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.jsonl"
+    body = "".join(json.dumps(entry) + "\n" for entry in names).encode()
+    s3.put_object(Bucket=bucket, Key=key, Body=body, ContentType="application/x-ndjson")
+    print(f"[OK ] Uploaded name index ({len(names)} files) -> s3://{bucket}/{key}")
+
 def walk_files(root: Path):
     for p in root.rglob("*"):
-        if p.is_file():
+        # *.tmp are still being written (convert.sh, detection_codec.py) and renamed when complete
+        if p.is_file() and p.suffix != ".tmp":
             yield p
 
-def main():
-    args = parse_args()
+def main(argv=None):
+    args = parse_args(argv)
 
     if not args.bucket:
         print("ERROR: S3 bucket is not set. Provide --bucket or set env S3_BUCKET.", file=sys.stderr)
@@ -137,7 +189,16 @@ def main():
         print(f"ERROR: directory not found: {local_base}", file=sys.stderr)
         sys.exit(3)
 
-    s3 = build_s3_client(args.endpoint, args.region)
+    if args.metrics_dir:
+        # Keep counting from the totals of the previous runs
+        metrics.restore_textfile(os.path.join(args.metrics_dir, "upload.prom"))
+        metrics.configure(os.path.join(args.metrics_dir, "traces.jsonl"))
+
+    if args.content_addressed and not args.index:
+        print("ERROR: --content-addressed requires --index (or env CONTENT_INDEX).", file=sys.stderr)
+        sys.exit(2)
+    index = ContentIndex(args.index) if args.index else None
+    names = []  # (name, hash, key) of this run, for the remote name index
 
     tasks = []
     for f in walk_files(local_base):
@@ -149,6 +210,7 @@ def main():
         return
 
     print(f"Found {len(tasks)} files under {local_base}")
+    s3 = build_s3_client(args.endpoint, args.region)
     t0 = time.time()
 
     uploaded = skipped = failed = 0
@@ -157,29 +219,70 @@ def main():
         nonlocal uploaded, skipped, failed
         f, k = item
         try:
+            if index is not None:
+                digest = file_sha256(f)
+                index.add_name(f.name, digest=digest)
+                if args.content_addressed:
+                    k = content_key(digest, f.suffix, args.prefix)
+                uploaded_key = index.uploaded_key(digest)
+                # A duplicate is found under the key its content was uploaded to
+                names.append({"name": f.relative_to(local_base).as_posix(), "hash": digest, "key": uploaded_key or k})
+                if uploaded_key and not args.dry_run:
+                    # Same bytes already uploaded (under this or another name): no HEAD, no PUT
+                    print(f"[SKP] Same content already uploaded as s3://{args.bucket}/{uploaded_key}: {f}")
+                    metrics.UPLOADS.inc(result="skip")
+                    if args.delete:
+                        delete_local(f)
+                    return "SKIP"
             if args.only_missing and not args.dry_run:
                 if object_exists(s3, args.bucket, k):
                     print(f"[SKP] Exists remotely, skipping: {f}")
+                    if index is not None:
+                        index.add_object(digest, f.stat().st_size, k)
+                    metrics.UPLOADS.inc(result="skip")
                     return "SKIP"
-            return upload_one(s3, args.bucket, f, k, args.dry_run, args.delete)
+            size = f.stat().st_size
+            with metrics.trace("upload", key=k, bytes=size):
+                result = upload_one(s3, args.bucket, f, k, args.dry_run, args.delete)
+            if index is not None and result == "OK":
+                index.add_object(digest, size, k)
+            metrics.UPLOADS.inc(result="ok")
+            return result
         except KeyboardInterrupt:
             raise
         except Exception as e:
             print(f"[ERR] {f} -> s3://{args.bucket}/{k}: {e}", file=sys.stderr)
+            metrics.UPLOADS.inc(result="error")
             return "ERR"
 
     try:
-        with cf.ThreadPoolExecutor(max_workers=max(1, args.workers)) as ex:
-            for result in ex.map(work, tasks):
-                if result in ("OK", "DRY"):
-                    uploaded += 1
-                elif result == "SKIP":
-                    skipped += 1
-                else:
-                    failed += 1
+        if args.engine == "async":
+            from async_upload import upload_async
+            uploaded, skipped, failed = upload_async(args, tasks, local_base, index, names, guess_content_type, delete_local)
+        else:
+            with cf.ThreadPoolExecutor(max_workers=max(1, args.workers)) as ex:
+                for result in ex.map(work, tasks):
+                    if result in ("OK", "DRY"):
+                        uploaded += 1
+                    elif result == "SKIP":
+                        skipped += 1
+                    else:
+                        failed += 1
     except KeyboardInterrupt:
         print("\nInterrupted. Exiting early…", file=sys.stderr)
 
+    # Without it, a duplicate skipped under a new name could not be found in the bucket by that name
+    if names and not args.dry_run:
+        try:
+            upload_name_index(s3, args.bucket, args.prefix, names)
+        except Exception as e:
+            print(f"[ERR] Name index upload failed: {e}", file=sys.stderr)
+    if index is not None:
+        index.close()
+
+    if args.metrics_dir:
+        metrics.write_textfile(os.path.join(args.metrics_dir, "upload.prom"))
+
     dt = time.time() - t0
     print(f"\nDone. Uploaded: {uploaded}, Skipped: {skipped}, Failed: {failed}. Elapsed: {dt:.1f}s")
 